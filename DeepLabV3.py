@@ -1,10 +1,12 @@
 import torch
+import torch.nn.functional as F
 from torchvision.models.segmentation import deeplabv3_mobilenet_v3_large
 
 
 class DeepLabV3(torch.nn.Module):
     def __init__(self, num_classes, pretrained=True):
         super(DeepLabV3, self).__init__()
+        self.pretrained = pretrained
         self.deeplabv3 = deeplabv3_mobilenet_v3_large(
             weights='COCO_WITH_VOC_LABELS_V1' if pretrained else None,
             weights_backbone='IMAGENET1K_V1' if pretrained else None,
@@ -20,5 +22,17 @@ class DeepLabV3(torch.nn.Module):
             for param in self.deeplabv3.classifier.parameters():
                 param.requires_grad = True
 
+    def backbone_features(self, x):
+        # The MobileNetV3 features fed to the classifier, at 1/16 of the input resolution. The backbone takes RGB
+        # images: the grayscale slices are repeated over the three channels
+        if x.shape[1] == 1:
+            x = x.expand(-1, 3, -1, -1)
+        return self.deeplabv3.backbone(x)['out']
+
+    def head(self, features, size):
+        # Same as the torchvision forward: classifier, then bilinear upsampling back to the input size
+        return F.interpolate(self.deeplabv3.classifier(features), size=size, mode='bilinear', align_corners=False)
+
     def forward(self, x):
-        return self.deeplabv3(x)['out']
\ No newline at end of file
+        # The auxiliary classifier of the pretrained model is skipped, its output was never used
+        return self.head(self.backbone_features(x), x.shape[-2:])
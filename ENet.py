@@ -22,6 +22,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from typing import Any, Sequence
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -127,8 +129,8 @@ class BottleNeckDownSampling(nn.Module):
                 do = self.do(b2)
 
                 _, c, _, _ = maxpool_output.shape
-                output = do
-                output[:, :c, :, :] += maxpool_output
+                # Out of place (no write into the dropout output), so that the graph can be captured by torch.compile
+                output = torch.cat((do[:, :c, :, :] + maxpool_output, do[:, c:, :, :]), dim=1)
 
                 final_output = self.PReLU(output)
 
@@ -172,53 +174,87 @@ class BottleNeckUpSampling(nn.Module):
                 return output
 
 
+# Dilation schedule of the bottlenecks of stages 2 and 3: one entry per block, either its dilation (1 for a regular
+# bottleneck) or "asym" for an asymmetric (5x1 then 1x5) one. The regular and asymmetric blocks use more dropout.
+ENET_SCHEDULE: tuple[int | str, ...] = (1, 2, "asym", 4, 1, 8, "asym", 16)
+
+# The depth of every stage, as number of bottlenecks:
+#   - stage0: before the first downsampling (the `more` variant adds one)
+#   - stage1: after the first downsampling, at K * 4 channels
+#   - stage2, stage3: after the second downsampling, at K * 8 channels, given as dilation schedules
+#   - stage4, stage5: after the first and second upsampling (the last block of stage 4 goes down to K channels)
+# The other hyper-parameters are the width (`kernels`, K), the projection factor (`factor`) and the kernel size of
+# the initial convolution (`kernelsize`).
+ENET_PRESETS: dict[str, dict[str, Any]] = {}
+ENET_PRESETS["normal"] = {"stage0": 0, "stage1": 4, "stage2": ENET_SCHEDULE, "stage3": ENET_SCHEDULE,
+                          "stage4": 2, "stage5": 1}
+ENET_PRESETS["more"] = ENET_PRESETS["normal"] | {"stage0": 1, "stage4": 4}
+ENET_PRESETS["less"] = ENET_PRESETS["normal"] | {"stage1": 2, "stage5": 0}
+
+
+def scheduled_bottlenecks(in_dim: int, out_dim: int, F: int, schedule: Sequence[int | str],
+                          **kwargs) -> list[BottleNeck]:
+        """
+        One bottleneck per entry of the schedule, all at in_dim channels but the last one (to out_dim).
+        """
+        blocks: list[BottleNeck] = []
+        for i, block in enumerate(schedule):
+                dim: int = out_dim if i == len(schedule) - 1 else in_dim
+                last_kwargs: dict[str, Any] = kwargs if i == len(schedule) - 1 else {}
+                if block == "asym":
+                        blocks.append(BottleNeck(in_dim, dim, F, dropoutRate=0.1, asym=True, **last_kwargs))
+                elif block == 1:
+                        blocks.append(BottleNeck(in_dim, dim, F, dropoutRate=0.1, **last_kwargs))
+                else:
+                        blocks.append(BottleNeck(in_dim, dim, F, dilation=int(block), **last_kwargs))
+
+        return blocks
+
+
 class ENet(nn.Module):
+        """
+        ENet, with the depth of every stage, the width and the initial kernel size set by the keyword arguments.
+        `preset` (normal, more or less, see ENET_PRESETS) gives the stages not set explicitly. The modules keep the
+        names of the original ENet, so the state dicts of the former ENet, kernel_ENet, more_ENet and less_ENet
+        load into the matching preset.
+        """
         def __init__(self, in_dim: int, out_dim: int, **kwargs):
                 super().__init__()
-                F: int = kwargs["factor"] if "factor" in kwargs else 4  # Projecting factor
-                K: int = kwargs["kernels"] if "kernels" in kwargs else 16  # n_kernels
-
-                # from models.enet import (BottleNeck,
-                #                          BottleNeckDownSampling,
-                #                          BottleNeckUpSampling,
-                #                          conv_block)
+                config: dict[str, Any] = ENET_PRESETS[kwargs.get("preset", "normal")] | kwargs
+                F: int = config.get("factor", 4)  # Projecting factor
+                K: int = config.get("kernels", 16)  # n_kernels
+                k: int = config.get("kernelsize", 3)  # Kernel size of the initial convolution
+                assert len(config["stage3"]) >= 1 and config["stage4"] >= 1, config  # They change the width
 
                 # Initial operations
-                self.conv0 = nn.Conv2d(in_dim, K - 1, kernel_size=3, stride=2, padding=1)
+                self.conv0 = nn.Conv2d(in_dim, K - 1, kernel_size=k, stride=2, padding=(k - 1) // 2)
                 self.maxpool0 = nn.MaxPool2d(2, return_indices=False, ceil_mode=False)
 
                 # Downsampling half
-                self.bottleneck1_0 = BottleNeckDownSampling(K, K * 4, F)
-                self.bottleneck1_1 = nn.Sequential(BottleNeck(K * 4, K * 4, F),
-                                                   BottleNeck(K * 4, K * 4, F),
-                                                   BottleNeck(K * 4, K * 4, F),
-                                                   BottleNeck(K * 4, K * 4, F))
+                # A Sequential returns the output of its last module, so the (output, indices) of the downsampling
+                self.bottleneck1_0: nn.Module
+                if config["stage0"]:
+                        self.bottleneck1_0 = nn.Sequential(*[BottleNeck(K, K, F, dropoutRate=0.1)
+                                                             for _ in range(config["stage0"])],
+                                                           BottleNeckDownSampling(K, K * 4, F))
+                else:
+                        self.bottleneck1_0 = BottleNeckDownSampling(K, K * 4, F)
+                self.bottleneck1_1 = nn.Sequential(*[BottleNeck(K * 4, K * 4, F) for _ in range(config["stage1"])])
                 self.bottleneck2_0 = BottleNeckDownSampling(K * 4, K * 8, F)
-                self.bottleneck2_1 = nn.Sequential(BottleNeck(K * 8, K * 8, F, dropoutRate=0.1),
-                                                   BottleNeck(K * 8, K * 8, F, dilation=2),
-                                                   BottleNeck(K * 8, K * 8, F, dropoutRate=0.1, asym=True),
-                                                   BottleNeck(K * 8, K * 8, F, dilation=4),
-                                                   BottleNeck(K * 8, K * 8, F, dropoutRate=0.1),
-                                                   BottleNeck(K * 8, K * 8, F, dilation=8),
-                                                   BottleNeck(K * 8, K * 8, F, dropoutRate=0.1, asym=True),
-                                                   BottleNeck(K * 8, K * 8, F, dilation=16))
+                self.bottleneck2_1 = nn.Sequential(*scheduled_bottlenecks(K * 8, K * 8, F, config["stage2"]))
 
                 # Middle operations
-                self.bottleneck3 = nn.Sequential(BottleNeck(K * 8, K * 8, F, dropoutRate=0.1),
-                                                 BottleNeck(K * 8, K * 8, F, dilation=2),
-                                                 BottleNeck(K * 8, K * 8, F, dropoutRate=0.1, asym=True),
-                                                 BottleNeck(K * 8, K * 8, F, dilation=4),
-                                                 BottleNeck(K * 8, K * 8, F, dropoutRate=0.1),
-                                                 BottleNeck(K * 8, K * 8, F, dilation=8),
-                                                 BottleNeck(K * 8, K * 8, F, dropoutRate=0.1, asym=True),
-                                                 BottleNeck(K * 8, K * 4, F, dilation=16, dilate_last=True))
+                self.bottleneck3 = nn.Sequential(*scheduled_bottlenecks(K * 8, K * 4, F, config["stage3"],
+                                                                        dilate_last=True))
 
                 # Upsampling half
                 self.bottleneck4 = nn.Sequential(BottleNeckUpSampling(K * 8, K * 4, F),
-                                                 BottleNeck(K * 4, K * 4, F, dropoutRate=0.1),
+                                                 *[BottleNeck(K * 4, K * 4, F, dropoutRate=0.1)
+                                                   for _ in range(config["stage4"] - 1)],
                                                  BottleNeck(K * 4, K, F, dropoutRate=0.1))
                 self.bottleneck5 = nn.Sequential(BottleNeckUpSampling(K * 2, K, F),
-                                                 BottleNeck(K, K, F, dropoutRate=0.1))
+                                                 *[BottleNeck(K, K, F, dropoutRate=0.1)
+                                                   for _ in range(config["stage5"])])
 
                 # Final upsampling and covolutions
                 self.final = nn.Sequential(conv_block(K, K, kernel_size=3, padding=1, bias=False, stride=1),
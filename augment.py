@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# MIT License
+
+# Copyright (c) 2024 Hoel Kervadec
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def uniform(low: float, high: float, n: int, device: torch.device) -> Tensor:
+    return torch.empty(n, device=device).uniform_(low, high)
+
+
+def gaussian_kernels(sigmas: Tensor, radius: int) -> Tensor:
+    """
+    One normalized 1D gaussian kernel per sigma, all of the same (2 * radius + 1) size: (B, 2 * radius + 1)
+    """
+    x: Tensor = torch.arange(-radius, radius + 1, device=sigmas.device, dtype=torch.float32)
+    kernels: Tensor = torch.exp(-x[None, :] ** 2 / (2 * sigmas[:, None] ** 2))
+
+    return kernels / kernels.sum(dim=1, keepdim=True)
+
+
+def separable_blur(x: Tensor, kernels: Tensor, padding_mode: str = "replicate") -> Tensor:
+    """
+    Blur every sample of the (B, C, H, W) batch with its own gaussian kernel (B, k), as two 1D convolutions.
+    The samples (and channels) are folded into the groups of a single convolution.
+    """
+    B, C, H, W = x.shape
+    _, k = kernels.shape
+    r: int = k // 2
+
+    weights: Tensor = kernels.repeat_interleave(C, dim=0)  # (B * C, k)
+    folded: Tensor = x.reshape(1, B * C, H, W)
+
+    folded = F.conv2d(F.pad(folded, (r, r, 0, 0), mode=padding_mode), weights[:, None, None, :], groups=B * C)
+    folded = F.conv2d(F.pad(folded, (0, 0, r, r), mode=padding_mode), weights[:, None, :, None], groups=B * C)
+
+    return folded.reshape(B, C, H, W)
+
+
+class BatchAugmenter:
+    """
+    On-the-fly augmentation of a whole training batch, on its device. It replaces the augmented copies written
+    to disk by preprocess_augment/spatial_augmentation.py and intensity_augmentation.py, with the same kinds of
+    transformations, but with fresh parameters drawn for every sample at every epoch:
+    - spatial: rotation (degrees), scaling and translation (pixels), plus an optional elastic deformation. The
+      image and its label are warped by the same sampling grid, bilinear for the image, nearest for the label;
+    - intensity, on the image only: gaussian noise then percentile contrast stretching, and gaussian blur then
+      gamma correction.
+    Each of the four groups is applied to a sample with its own probability.
+
+    Images are (B, 1, H, W) floats in [0, 1], labels the (B, H, W) uint8 class maps shipped by the datasets.
+    """
+    def __init__(self,
+                 rotation: float = 5, scale: float = 0.05, translation: float = 5,
+                 elastic_alpha: float = 20, elastic_sigma: float = 4,
+                 noise_std: tuple[float, float] = (0.01, 0.03),
+                 contrast_low: tuple[float, float] = (1, 5), contrast_high: tuple[float, float] = (95, 99),
+                 blur_sigma: tuple[float, float] = (0.5, 1.5), gamma: tuple[float, float] = (0.7, 1.3),
+                 p_spatial: float = 0.5, p_elastic: float = 0.5,
+                 p_noise_contrast: float = 0.5, p_blur_gamma: float = 0.5):
+        self.rotation = rotation
+        self.scale = scale
+        self.translation = translation
+        self.elastic_alpha = elastic_alpha
+        self.elastic_sigma = elastic_sigma
+        self.noise_std = noise_std
+        self.contrast_low = contrast_low
+        self.contrast_high = contrast_high
+        self.blur_sigma = blur_sigma
+        self.gamma = gamma
+
+        self.p_spatial = p_spatial
+        self.p_elastic = p_elastic
+        self.p_noise_contrast = p_noise_contrast
+        self.p_blur_gamma = p_blur_gamma
+
+    def draw(self, p: float, n: int, device: torch.device) -> Tensor:
+        return torch.rand(n, device=device) < p
+
+    @torch.no_grad()
+    def __call__(self, img: Tensor, gt: Tensor) -> tuple[Tensor, Tensor]:
+        assert img.ndim == 4 and gt.ndim == 3, (img.shape, gt.shape)
+
+        img, gt = self.spatial(img, gt)
+        img = self.intensity(img)
+
+        return img, gt
+
+    def affine_grid(self, B: int, H: int, W: int, device: torch.device) -> Tensor:
+        on: Tensor = self.draw(self.p_spatial, B, device)
+
+        # Identity parameters for the samples left untouched
+        angle: Tensor = torch.deg2rad(uniform(-self.rotation, self.rotation, B, device)) * on
+        zoom: Tensor = 1 + uniform(-self.scale, self.scale, B, device) * on
+        tx: Tensor = uniform(-self.translation, self.translation, B, device) * on
+        ty: Tensor = uniform(-self.translation, self.translation, B, device) * on
+
+        # The grid maps the output to the input coordinates, normalized to [-1, 1] along each axis: the rotation
+        # is corrected for the aspect ratio, and the translation converted from pixels
+        cos: Tensor = torch.cos(angle) / zoom
+        sin: Tensor = torch.sin(angle) / zoom
+        theta: Tensor = torch.stack([torch.stack([cos, -sin * H / W, 2 * tx / W], dim=1),
+                                     torch.stack([sin * W / H, cos, 2 * ty / H], dim=1)], dim=1)
+
+        return F.affine_grid(theta, [B, 1, H, W], align_corners=False)
+
+    def elastic_field(self, B: int, H: int, W: int, device: torch.device) -> Tensor:
+        on: Tensor = self.draw(self.p_elastic, B, device)
+
+        # Smoothed uniform noise, as spatial_augmentation.elastic_transform, in pixels
+        noise: Tensor = torch.rand(B, 2, H, W, device=device) * 2 - 1
+        radius: int = int(4 * self.elastic_sigma + 0.5)
+        kernels: Tensor = gaussian_kernels(torch.full((B,), float(self.elastic_sigma), device=device), radius)
+        field: Tensor = separable_blur(noise, kernels, padding_mode="constant") * self.elastic_alpha
+
+        field = field * on[:, None, None, None]
+        # To the normalized coordinates of the sampling grid, (B, H, W, 2) with x first
+        scale: Tensor = torch.tensor([2 / W, 2 / H], device=device)
+
+        return field.permute(0, 2, 3, 1) * scale
+
+    def spatial(self, img: Tensor, gt: Tensor) -> tuple[Tensor, Tensor]:
+        B, _, H, W = img.shape
+        device = img.device
+
+        grid: Tensor = self.affine_grid(B, H, W, device)
+        if self.p_elastic > 0:
+            grid = grid + self.elastic_field(B, H, W, device)
+
+        # Same grid for both, so that the label stays aligned with the image
+        warped_img: Tensor = F.grid_sample(img, grid, mode="bilinear", padding_mode="border", align_corners=False)
+        warped_gt: Tensor = F.grid_sample(gt[:, None].float(), grid, mode="nearest", padding_mode="border",
+                                          align_corners=False)
+
+        return warped_img.clamp(0, 1), warped_gt[:, 0].round().to(gt.dtype)
+
+    def intensity(self, img: Tensor) -> Tensor:
+        B, *_ = img.shape
+        device = img.device
+
+        # Gaussian noise, then contrast stretching between two random percentiles of each image
+        on: Tensor = self.draw(self.p_noise_contrast, B, device)[:, None, None, None]
+        std: Tensor = uniform(*self.noise_std, B, device)[:, None, None, None]
+        noisy: Tensor = (img + torch.randn_like(img) * std).clamp(0, 1)
+
+        flat: Tensor = noisy.flatten(1).sort(dim=1).values
+        N: int = flat.shape[1]
+        low: Tensor = (uniform(*self.contrast_low, B, device) / 100 * (N - 1)).long()
+        high: Tensor = (uniform(*self.contrast_high, B, device) / 100 * (N - 1)).long()
+        lo: Tensor = flat.gather(1, low[:, None])[:, :, None, None]
+        hi: Tensor = flat.gather(1, high[:, None])[:, :, None, None]
+        stretched: Tensor = ((noisy - lo) / (hi - lo).clamp_min(1e-6)).clamp(0, 1)
+
+        img = torch.where(on, stretched, img)
+
+        # Gaussian blur, then gamma correction
+        on = self.draw(self.p_blur_gamma, B, device)[:, None, None, None]
+        sigmas: Tensor = uniform(*self.blur_sigma, B, device)
+        radius: int = math.ceil(4 * self.blur_sigma[1])
+        blurred: Tensor = separable_blur(img, gaussian_kernels(sigmas, radius))
+        gammas: Tensor = uniform(*self.gamma, B, device)[:, None, None, None]
+
+        img = torch.where(on, blurred.clamp(0, 1) ** gammas, img)
+
+        return img
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# MIT License
+
+# Copyright (c) 2024 Hoel Kervadec
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import hashlib
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+
+class BuildCache:
+    """
+    Manifest of the outputs of a dataset build (slicing, preprocessing, ...). Every entry records the outputs
+    produced from some source files, with a key made of the content hash of those sources and of the parameters
+    used. A later build only recomputes the entries whose key changed, and reuses the outputs of the others.
+
+    The manifest is a JSON file in the destination folder. It also remembers the hash of every source file
+    along with its size and mtime, so that unchanged files are not hashed again.
+    """
+    def __init__(self, dest: Path, name: str = "build_manifest.json"):
+        self.dest: Path = Path(dest)
+        self.path: Path = self.dest / name
+
+        manifest: dict[str, Any] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+
+        self.entries: dict[str, dict[str, Any]] = manifest.get("entries", {})
+        self.files: dict[str, dict[str, Any]] = manifest.get("files", {})
+
+    def file_hash(self, path: Path) -> str:
+        stat = path.stat()
+        known: Optional[dict[str, Any]] = self.files.get(str(path))
+        if known and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            return known["sha256"]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+
+        self.files[str(path)] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": sha.hexdigest()}
+        return sha.hexdigest()
+
+    def key(self, sources: Iterable[Path], params: dict[str, Any]) -> str:
+        sha = hashlib.sha256()
+        for source in sources:
+            sha.update(self.file_hash(Path(source)).encode())
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+        return sha.hexdigest()
+
+    def get(self, name: str, key: str) -> Optional[dict[str, Any]]:
+        """
+        The entry `name`, if it was built with the same key and all its outputs are still there.
+        """
+        entry: Optional[dict[str, Any]] = self.entries.get(name)
+        if not entry or entry["key"] != key:
+            return None
+        if not all((self.dest / output).exists() for output in entry["outputs"]):
+            return None
+
+        return entry
+
+    def put(self, name: str, key: str, outputs: Iterable[Path], **extra) -> None:
+        self.entries[name] = {"key": key,
+                              "outputs": [str(Path(output).relative_to(self.dest)) for output in outputs],
+                              **extra}
+
+    def discard(self, name: str) -> None:
+        """
+        Forget the entry `name`, and delete its outputs.
+        """
+        entry: Optional[dict[str, Any]] = self.entries.pop(name, None)
+        if entry:
+            for output in entry["outputs"]:
+                (self.dest / output).unlink(missing_ok=True)
+
+    def save(self) -> None:
+        self.dest.mkdir(parents=True, exist_ok=True)
+
+        tmp_path: Path = self.path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"entries": self.entries, "files": self.files}, f)
+        tmp_path.replace(self.path)
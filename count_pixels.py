@@ -7,24 +7,13 @@ import matplotlib.pyplot as plt
 from torchvision import transforms
 from torchvision.transforms import InterpolationMode
 import torch
-from torch.utils.data import DataLoader
-from tqdm import tqdm
 from dataset import SliceDataset
-from utils import class2one_hot
-from operator import itemgetter
 
-def count_pixels_per_class(dataloader, K):
+def count_pixels_per_class(dataset, K):
     """
-    Count the total number of pixels for each class in the dataset.
+    Count the total number of pixels for each class in the dataset, from its class histogram index.
     """
-    class_counts = np.zeros(K)
-    
-    for batch in tqdm(dataloader, desc="Processing batches"):
-        gts = torch.argmax(batch['gts'], dim=1)  # Ground truth masks
-        for k in range(K):
-            class_counts[k] += (gts == k).sum().item()
-    
-    return class_counts
+    return dataset.class_counts(K).sum(axis=0)
 
 def plot_class_counts(class_counts, class_names, output_file):
     """
@@ -57,7 +46,6 @@ def main():
 
     root_dir = Path("data") / "SEGTHORCORRECT"
     target_size = (256, 256)
-    batch_size = 64
 
     img_transform = transforms.Compose([
         transforms.Resize(target_size),  # Resize the image to the target size
@@ -71,15 +59,12 @@ def main():
         transforms.Resize(target_size, interpolation=InterpolationMode.NEAREST),
         lambda img: np.array(img)[...],
         lambda nd: nd / 63,  # Normalize the image for SEGTHOR
-        lambda nd: torch.tensor(nd, dtype=torch.int64)[None, ...],
-        lambda t: class2one_hot(t, K=K),
-        itemgetter(0)
+        lambda nd: torch.tensor(nd, dtype=torch.uint8)
     ])
 
     dataset = SliceDataset('train', root_dir, img_transform=img_transform, gt_transform=gt_transform, debug=False)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
 
-    class_counts = count_pixels_per_class(dataloader, K)
+    class_counts = count_pixels_per_class(dataset, K)
     plot_class_counts(class_counts, class_names, args.output_file)
 
 if __name__ == '__main__':
@@ -22,8 +22,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import pickle
+import warnings
 from pathlib import Path
-from typing import Callable, Union, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Union, List, Tuple
+
+import torch
 from torch import Tensor
 from PIL import Image
 from torch.utils.data import Dataset
@@ -43,6 +48,176 @@ def make_dataset(root, subset) -> list[tuple[Path, Path]]:
 
     return list(zip(images, full_labels))
 
+# Slice metadata index: for every label slice, the histogram of its raw uint8 values (hence the foreground flag
+# and the pixel counts per class), its patient and z index, and the mtime and size of the file it was computed
+# from. It is written next to the labels when the dataset is built (slice_segthor.py), and refreshed on load for
+# the files that changed, so that the class statistics and the background-only filtering need no PNG decoding.
+SLICE_INDEX: str = "slice_index.npz"
+
+
+def png_label_scale(K: int) -> float:
+    # The class encoding of the PNG labels, as undone by the gt_transform of main.py: class k is stored as k * scale
+    return 63 if K == 5 else 255 / (K - 1)
+
+
+def parse_stem(stem: str) -> tuple[str, int]:
+    # Patient_01_0042 (possibly with an augmentation suffix) -> (Patient_01, 42)
+    parts: list[str] = stem.split('_')
+    z: int = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else -1
+
+    return '_'.join(parts[:2]), z
+
+
+def batched_histograms(labels: np.ndarray) -> np.ndarray:
+    """
+    (n, 256) histograms of a (n, ...) uint8 stack of labels, in a single bincount (each slice is offset to its own
+    256 bins).
+    """
+    flat: np.ndarray = labels.reshape(len(labels), -1)
+    offsets: np.ndarray = (np.arange(len(flat)) * 256)[:, None]
+
+    return np.bincount((flat + offsets).ravel(), minlength=256 * len(flat)).reshape(-1, 256)
+
+
+def slice_metadata(gt_path: Path) -> dict[str, np.ndarray]:
+    stat = gt_path.stat()
+    hist: np.ndarray = np.bincount(np.asarray(Image.open(gt_path), dtype=np.uint8).ravel(), minlength=256)
+    patient, z = parse_stem(gt_path.stem)
+
+    return {"stems": gt_path.stem, "hists": hist, "foreground": hist[1:].sum() > 0, "patients": patient, "zs": z,
+            "mtimes": stat.st_mtime_ns, "sizes": stat.st_size}
+
+
+def load_index(index_path: Path) -> dict[str, np.ndarray]:
+    # Columns of the index, one row per slice (the "stems" column naming them)
+    if not index_path.exists():
+        return {}
+
+    with np.load(index_path) as index:
+        # Each access to an npz member reads it again: read them all once
+        return {f: index[f] for f in index.files}
+
+
+def save_index(index_path: Path, index: dict[str, np.ndarray]) -> None:
+    if not len(index.get("stems", ())):  # No slice left to describe
+        index_path.unlink(missing_ok=True)
+        return
+
+    order: np.ndarray = np.argsort(index["stems"])
+    columns: dict[str, np.ndarray] = {f: values[order] for f, values in index.items()}
+    columns["hists"] = columns["hists"].astype(np.uint32)
+
+    np.savez_compressed(index_path, **columns)
+
+
+def cache_index(index_path: Path, index: dict[str, np.ndarray]) -> None:
+    # save_index, for the indexes the datasets refresh when they load: on a read-only dataset folder, the index is
+    # only kept in memory (and computed again by every run)
+    try:
+        save_index(index_path, index)
+    except OSError as e:
+        warnings.warn(f"Could not write the slice index {index_path}, keeping it in memory: {e}")
+
+
+def empty_index() -> dict[str, np.ndarray]:
+    # The columns of slice_metadata, without any row
+    return {"hists": np.zeros((0, 256), dtype=np.int64), "foreground": np.zeros(0, dtype=bool),
+            "patients": np.zeros(0, dtype=str), "zs": np.zeros(0, dtype=np.int64),
+            "mtimes": np.zeros(0, dtype=np.int64), "sizes": np.zeros(0, dtype=np.int64)}
+
+
+def index_rows(index: dict[str, np.ndarray], stems: Iterable[str]) -> np.ndarray:
+    # Row of each stem in the index, -1 for those it does not have
+    stems = np.asarray(list(stems), dtype=str)
+    if not index or not len(index["stems"]):
+        return np.full(len(stems), -1)
+
+    sorter: np.ndarray = np.argsort(index["stems"])
+    found: np.ndarray = sorter[np.minimum(np.searchsorted(index["stems"], stems, sorter=sorter), len(sorter) - 1)]
+
+    return np.where(index["stems"][found] == stems, found, -1)
+
+
+def merge_index(index: dict[str, np.ndarray], update: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    # The rows of the update replace those of the index for the same stems
+    if not index:
+        return update
+
+    kept: np.ndarray = ~np.isin(index["stems"], update["stems"])
+    return {f: np.concatenate([index[f][kept], update[f]]) for f in index}
+
+
+def slice_index(gt_paths: list[Path], workers: int = 8) -> dict[str, np.ndarray]:
+    """
+    The metadata of the given PNG label files, one row per file, from the index of their folders. The files that
+    are not in an index, or whose mtime or size changed since, are decoded again (in parallel threads, the PNG
+    decoding releasing the GIL), and the index is updated.
+    """
+    by_folder: dict[Path, list[int]] = {}
+    for i, gt_path in enumerate(gt_paths):
+        by_folder.setdefault(Path(gt_path).parent, []).append(i)
+
+    order: list[int] = []
+    columns: list[dict[str, np.ndarray]] = []
+    for folder, idxes in by_folder.items():
+        index_path: Path = folder / SLICE_INDEX
+        index: dict[str, np.ndarray] = load_index(index_path)
+
+        paths: list[Path] = [Path(gt_paths[i]) for i in idxes]
+        stats = [p.stat() for p in paths]
+        rows: np.ndarray = index_rows(index, (p.stem for p in paths))
+
+        fresh: np.ndarray = rows >= 0
+        if index:
+            fresh &= index["mtimes"][rows] == np.array([stat.st_mtime_ns for stat in stats])
+            fresh &= index["sizes"][rows] == np.array([stat.st_size for stat in stats])
+
+        if not fresh.all():
+            stale: list[Path] = [p for p, f in zip(paths, fresh) if not f]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                metadata: list[dict[str, np.ndarray]] = list(pool.map(slice_metadata, stale))
+            index = merge_index(index, {f: np.stack([m[f] for m in metadata]) for f in metadata[0]})
+            cache_index(index_path, index)
+            rows = index_rows(index, (p.stem for p in paths))
+
+        order += idxes
+        columns.append({f: values[rows] for f, values in index.items() if f != "stems"})
+
+    if not columns:
+        return empty_index()
+
+    # Back to the order of gt_paths
+    inverse: np.ndarray = np.argsort(order)
+    return {f: np.concatenate([c[f] for c in columns])[inverse] for f in columns[0]}
+
+
+def build_slice_index(gt_folder: Path, workers: int = 8) -> None:
+    """
+    Write (or refresh) the index of a label folder, dropping the slices that are gone. Called once the folder is
+    built, so that the datasets find it up to date.
+    """
+    gt_paths: list[Path] = sorted(Path(gt_folder).glob("*.png"))
+    index_path: Path = Path(gt_folder) / SLICE_INDEX
+
+    index: dict[str, np.ndarray] = load_index(index_path)
+    if index:
+        kept: np.ndarray = np.isin(index["stems"], [p.stem for p in gt_paths])
+        if not kept.all():
+            save_index(index_path, {f: values[kept] for f, values in index.items()})
+
+    slice_index(gt_paths, workers=workers)
+
+
+def histograms_to_classes(hists: np.ndarray, K: int, scale: float = 1) -> np.ndarray:
+    """
+    (N, 256) raw value histograms to (N, K) pixel counts per class, a raw value v being class int(v / scale)
+    """
+    classes: np.ndarray = (np.arange(256) / scale).astype(np.int64)
+    one_hot: np.ndarray = classes[:, None] == np.arange(K)[None, :]  # (256, K), values out of range are dropped
+
+    return hists @ one_hot.astype(np.int64)
+
+
 class SliceDataset(Dataset):
     def __init__(self, subset, root_dir, img_transform=None,
                  gt_transform=None, augment=False, equalize=False, debug=False, remove_background=False):
@@ -70,23 +245,30 @@ class SliceDataset(Dataset):
         """
         Filter out the image-ground truth pairs where the ground truth contains only background (label 0).
         """
-        filtered_files = []
-        for img_path, gt_path in self.files:
-            gt = np.array(Image.open(gt_path))  # Load ground truth image
-            if np.any(gt > 0):  # Keep if any pixel in the ground truth is not background (label > 0)
-                filtered_files.append((img_path, gt_path))
-        
-        return filtered_files
+        # Keep if any pixel in the ground truth is not background (label > 0), from the slice index
+        foreground: np.ndarray = slice_index([gt_path for _, gt_path in self.files])["foreground"]
+
+        return [pair for pair, keep in zip(self.files, foreground) if keep]
+
+    def class_counts(self, K: int) -> np.ndarray:
+        """
+        (N, K) number of pixels of each class in each slice, from the slice index.
+        """
+        return histograms_to_classes(slice_index([gt_path for _, gt_path in self.files])["hists"], K,
+                                     png_label_scale(K))
+
+    def load_gt(self, index) -> Tensor:
+        # Compact class map, one-hot encoded per batch
+        return self.gt_transform(Image.open(self.files[index][1]))
 
     def __getitem__(self, index) -> dict[str, Union[Tensor, int, str]]:
-        img_path, gt_path = self.files[index]
+        img_path, _ = self.files[index]
 
         img: Tensor = self.img_transform(Image.open(img_path))
-        gt: Tensor = self.gt_transform(Image.open(gt_path))
+        gt: Tensor = self.load_gt(index)
 
         _, W, H = img.shape
-        K, _, _ = gt.shape
-        assert gt.shape == (K, W, H)
+        assert gt.shape == (W, H)
 
         return {"images": img,
                 "gts": gt,
@@ -144,27 +326,201 @@ class SliceDatasetWithTransforms(Dataset):
         """
         Filter out the image-ground truth pairs where the ground truth contains only background (label 0).
         """
-        filtered_files = []
-        for img_path, gt_path in self.files:
-            gt = np.array(Image.open(gt_path))  # Load ground truth image
-            if np.any(gt > 0):  # Keep if any pixel in the ground truth is not background (label > 0)
-                filtered_files.append((img_path, gt_path))
-        
-        return filtered_files
+        # Keep if any pixel in the ground truth is not background (label > 0), from the slice index
+        foreground: np.ndarray = slice_index([gt_path for _, gt_path in self.files])["foreground"]
+
+        return [pair for pair, keep in zip(self.files, foreground) if keep]
+
+    def class_counts(self, K: int) -> np.ndarray:
+        """
+        (N, K) number of pixels of each class in each slice, from the slice index.
+        """
+        return histograms_to_classes(slice_index([gt_path for _, gt_path in self.files])["hists"], K,
+                                     png_label_scale(K))
 
     def __len__(self):
         return len(self.files)
 
+    def load_gt(self, index) -> Tensor:
+        # Compact class map, one-hot encoded per batch
+        return self.gt_transform(Image.open(self.files[index][1]))
+
     def __getitem__(self, index) -> dict[str, Union[Tensor, int, str]]:
-        img_path, gt_path = self.files[index]
+        img_path, _ = self.files[index]
 
         img: Tensor = self.img_transform(Image.open(img_path))
-        gt: Tensor = self.gt_transform(Image.open(gt_path))
+        gt: Tensor = self.load_gt(index)
+
+        _, W, H = img.shape
+        assert gt.shape == (W, H)
+
+        return {"images": img,
+                "gts": gt,
+                "stems": img_path.stem}
+
+
+# Packed slice store: one contiguous uint8 array for the images and one for the labels (class indices, not
+# the x63 PNG encoding), plus the list of stems. Written once by slice_segthor.py --packed, then read through
+# np.memmap so that loading a sample is a page-cache read instead of two PNG decodes.
+PACKED_DIR: str = "packed"
+
+
+def packed_index(packed_path: Path, stems: list[str], hists: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    The slice index of a packed store, validated against the mtime and size of its label array.
+    """
+    stat = (packed_path / "gt.u8").stat()
+    patients, zs = zip(*map(parse_stem, stems)) if stems else ((), ())
+
+    return {"stems": np.array(stems, dtype=str), "hists": hists, "foreground": hists[:, 1:].sum(axis=1) > 0,
+            "patients": np.array(patients, dtype=str), "zs": np.array(zs, dtype=np.int64),
+            "mtimes": np.full(len(stems), stat.st_mtime_ns), "sizes": np.full(len(stems), stat.st_size)}
+
+
+class PackedWriter:
+    def __init__(self, dest: Path, shape: tuple[int, int]):
+        self.dest: Path = Path(dest)
+        self.shape: tuple[int, int] = tuple(shape)  # type: ignore
+        self.stems: list[str] = []
+        self.hists: list[np.ndarray] = []
+
+        self.dest.mkdir(parents=True, exist_ok=True)
+        self.img_file = open(self.dest / "img.u8", 'wb')
+        self.gt_file = open(self.dest / "gt.u8", 'wb')
+
+    def append(self, stems: Iterable[str], imgs: np.ndarray, gts: np.ndarray) -> None:
+        stems = list(stems)
+        assert imgs.shape == gts.shape == (len(stems), *self.shape), (imgs.shape, gts.shape, self.shape)
+        assert imgs.dtype == gts.dtype == np.uint8, (imgs.dtype, gts.dtype)
+
+        self.img_file.write(np.ascontiguousarray(imgs).tobytes())
+        self.gt_file.write(np.ascontiguousarray(gts).tobytes())
+        self.stems += stems
+        self.hists.append(batched_histograms(gts))  # For the slice index, while the labels are at hand
+
+    def close(self) -> None:
+        self.img_file.close()
+        self.gt_file.close()
+
+        with open(self.dest / "index.pkl", 'wb') as f:
+            pickle.dump({"stems": self.stems, "shape": self.shape}, f, pickle.HIGHEST_PROTOCOL)
+
+        hists: np.ndarray = np.concatenate(self.hists) if self.hists else np.zeros((0, 256), dtype=np.int64)
+        save_index(self.dest / SLICE_INDEX, packed_index(self.dest, self.stems, hists))
+
+    def __enter__(self) -> "PackedWriter":
+        return self
+
+    def __exit__(self, *args, **kwargs) -> None:
+        self.close()
+
+
+def load_packed(root, subset) -> tuple[np.memmap, np.memmap, list[str]]:
+    assert subset in ['train', 'val', 'test']
+
+    packed_path: Path = Path(root) / subset / PACKED_DIR
+    with open(packed_path / "index.pkl", 'rb') as f:
+        index = pickle.load(f)
+
+    stems: list[str] = index["stems"]
+    shape: tuple[int, ...] = (len(stems), *index["shape"])
+
+    if not stems:  # Empty files cannot be mapped
+        return np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=np.uint8), stems  # type: ignore
+
+    imgs = np.memmap(packed_path / "img.u8", dtype=np.uint8, mode='r', shape=shape)
+    gts = np.memmap(packed_path / "gt.u8", dtype=np.uint8, mode='r', shape=shape)
+
+    return imgs, gts, stems
+
+
+class PackedSliceDataset(Dataset):
+    def __init__(self, subset, root_dir, debug=False, remove_background=False):
+        self.root_dir: str = root_dir
+        self.subset: str = subset
+        self.remove_background: bool = remove_background
+
+        # The memmaps are opened lazily, so that each DataLoader worker gets its own file handles
+        self._arrays: Union[tuple[np.memmap, np.memmap], None] = None
+
+        _, _, self.stems = load_packed(root_dir, subset)
+        self.indexes: np.ndarray = np.arange(len(self.stems))
+        if debug:
+            self.indexes = self.indexes[:10]
+
+        # If the flag to remove background-only slices is set, filter the indexes
+        if self.remove_background:
+            self.indexes = self._filter_background_only_slices()
+
+        print(f">> Created {subset} packed dataset with {len(self)} images...")
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getstate__(self):
+        # Never pickle the memmaps themselves, that would copy the whole array
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self) -> tuple[np.memmap, np.memmap]:
+        if self._arrays is None:
+            imgs, gts, _ = load_packed(self.root_dir, self.subset)
+            self._arrays = (imgs, gts)
+        return self._arrays
+
+    def metadata(self, chunk: int = 512) -> dict[str, np.ndarray]:
+        """
+        The slice index of the store (see SLICE_INDEX), one row per slice. Written by the PackedWriter; if it is
+        missing or older than the labels, it is rebuilt in one chunked pass over them.
+        """
+        packed_path: Path = Path(self.root_dir) / self.subset / PACKED_DIR
+        stat = (packed_path / "gt.u8").stat()
+
+        index: dict[str, np.ndarray] = load_index(packed_path / SLICE_INDEX)
+        rows: np.ndarray = index_rows(index, self.stems)
+        if not index or len(index["stems"]) != len(self.stems) or (rows < 0).any() \
+                or (index["mtimes"] != stat.st_mtime_ns).any() or (index["sizes"] != stat.st_size).any():
+            _, gts = self.arrays
+            hists: np.ndarray = np.concatenate([batched_histograms(np.asarray(gts[i:i + chunk]))
+                                                for i in range(0, len(self.stems), chunk)]
+                                               or [np.zeros((0, 256), dtype=np.int64)])
+            index = packed_index(packed_path, self.stems, hists)
+            cache_index(packed_path / SLICE_INDEX, index)
+            rows = index_rows(index, self.stems)
+
+        return {f: values[rows] for f, values in index.items() if f != "stems"}
+
+    def _filter_background_only_slices(self) -> np.ndarray:
+        """
+        Filter out the slices where the ground truth contains only background (label 0), from the slice index.
+        """
+        foreground: np.ndarray = self.metadata()["foreground"][self.indexes]
+
+        return self.indexes[foreground]
+
+    def class_counts(self, K: int) -> np.ndarray:
+        """
+        (N, K) number of pixels of each class in each slice; the packed labels are already class indices.
+        """
+        return histograms_to_classes(self.metadata()["hists"][self.indexes].astype(np.int64), K)
+
+    def load_gt(self, index) -> Tensor:
+        # Compact class map, one-hot encoded per batch
+        _, gts = self.arrays
+        return torch.from_numpy(np.array(gts[int(self.indexes[index])]))
+
+    def __getitem__(self, index) -> dict[str, Union[Tensor, int, str]]:
+        imgs, _ = self.arrays
+        i: int = int(self.indexes[index])
+
+        img: Tensor = torch.from_numpy(imgs[i].astype(np.float32) / 255)[None, ...]
+        gt: Tensor = self.load_gt(index)
 
         _, W, H = img.shape
-        K, _, _ = gt.shape
-        assert gt.shape == (K, W, H)
+        assert gt.shape == (W, H)
 
         return {"images": img,
                 "gts": gt,
-                "stems": img_path.stem}
\ No newline at end of file
+                "stems": self.stems[i]}
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# MIT License
+
+# Copyright (c) 2024 Hoel Kervadec
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Cost of ENet configurations: parameters, FLOPs and latency of the forward pass, e.g.
+#   python enet_report.py --presets normal more less --kernels 16 32 --gpu
+# Every preset (see ENet.ENET_PRESETS) is reported at every width, with the stages overridden by the options.
+
+import time
+import argparse
+from itertools import product
+from pprint import pprint
+from typing import Any
+
+import torch
+from torch import nn, Tensor
+from torch.utils.flop_counter import FlopCounterMode
+
+from ENet import ENET_PRESETS, ENet
+
+
+def schedule(value: str) -> int | str:
+    # One block of a dilation schedule: its dilation (1: regular bottleneck), or asym
+    return value if value == "asym" else int(value)
+
+
+def count_flops(net: nn.Module, sample: Tensor) -> int:
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        net(sample)
+
+    return counter.get_total_flops()
+
+
+def latency(net: nn.Module, sample: Tensor, runs: int, warmup: int) -> float:
+    """
+    Median time of a forward pass, in seconds.
+    """
+    times: list[float] = []
+    with torch.inference_mode():
+        for r in range(warmup + runs):
+            start: float = time.perf_counter()
+            net(sample)
+            if sample.is_cuda:
+                torch.cuda.synchronize()
+            if r >= warmup:
+                times.append(time.perf_counter() - start)
+
+    return sorted(times)[len(times) // 2]
+
+
+def report(config: dict[str, Any], args: argparse.Namespace, device: torch.device) -> dict[str, float]:
+    net: nn.Module = ENet(1, args.num_classes, **config).eval().to(device)
+
+    sample: Tensor = torch.rand((args.batch_size, 1, *args.shape), device=device)
+    params: int = sum(p.numel() for p in net.parameters())
+    flops: int = count_flops(net, sample[:1])
+    seconds: float = latency(net, sample, args.runs, args.warmup)
+
+    return {"params": params, "gflops": flops / 1e9, "ms": 1000 * seconds, "slices/s": args.batch_size / seconds}
+
+
+def main(args: argparse.Namespace) -> None:
+    device = torch.device("cuda") if args.gpu and torch.cuda.is_available() else torch.device("cpu")
+    overrides: dict[str, Any] = {f"stage{i}": getattr(args, f"stage{i}") for i in range(6)
+                                 if getattr(args, f"stage{i}") is not None}
+
+    results: list[tuple[str, dict[str, float]]] = []
+    for preset, kernels in product(args.presets, args.kernels):
+        config: dict[str, Any] = {"preset": preset, "kernels": kernels, "kernelsize": args.kernelsize,
+                                  "factor": args.factor} | overrides
+        results.append((f"{preset} K={kernels}", report(config, args, device)))
+
+    print(f">> {device}, batches of {args.batch_size} slices of {args.shape}, GFLOPs per slice")
+    print(f"{'':>16} {'params':>10} {'GFLOPs':>8} {'ms/batch':>10} {'slices/s':>10}")
+    for name, r in results:
+        print(f"{name:>16} {r['params']:>10,} {r['gflops']:>8.2f} {r['ms']:>10.1f} {r['slices/s']:>10.1f}")
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Parameters, FLOPs and latency of ENet configurations")
+    parser.add_argument('--presets', nargs='+', default=list(ENET_PRESETS), choices=list(ENET_PRESETS))
+    parser.add_argument('--kernels', type=int, nargs='+', default=[16], help="Widths (K) to report")
+    parser.add_argument('--kernelsize', type=int, default=3)
+    parser.add_argument('--factor', type=int, default=4, help="Projection factor of the bottlenecks")
+    for i in [0, 1, 4, 5]:
+        parser.add_argument(f'--stage{i}', type=int, help=f"Number of bottlenecks of stage {i}")
+    for i in [2, 3]:
+        parser.add_argument(f'--stage{i}', type=schedule, nargs='+',
+                            help=f"Dilation schedule of stage {i}, e.g. 1 2 asym 4")
+
+    parser.add_argument('--num_classes', type=int, default=5)
+    parser.add_argument('--shape', type=int, nargs=2, default=[256, 256])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--gpu', action='store_true')
+
+    args = parser.parse_args()
+
+    pprint(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
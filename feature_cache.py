@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# MIT License
+
+# Copyright (c) 2024 Hoel Kervadec
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pickle
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Union
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+from torch.utils.data import DataLoader, Dataset
+
+from dataset import PackedSliceDataset
+from utils import tqdm_
+
+# Cache of the frozen backbone features of the pretrained DeepLabV3 (--feature_cache), so that the fine-tuning only
+# runs the classifier head. The features of every (un-augmented) slice are computed once, in eval mode, and stored
+# as one fp16 array `<root>/<subset>/features/<source>/features.f16` (N, C, h, w), with its stems and shape in
+# `index.pkl`. The cache is rebuilt whenever those no longer match the dataset.
+FEATURES_DIR: str = "features"
+
+
+def dataset_stems(dataset: Dataset) -> list[str]:
+    # The stems of the slices, in the order of the dataset, without loading them
+    if isinstance(dataset, PackedSliceDataset):
+        return [dataset.stems[i] for i in dataset.indexes]
+
+    return [img_path.stem for img_path, _ in dataset.files]  # type: ignore
+
+
+class FeatureCache:
+    """
+    The memory-mapped features, read one slice at a time. The last `lru_size` slices read are kept in memory (one
+    such tier per DataLoader worker), as torch tensors.
+    """
+    def __init__(self, path: Path, lru_size: int = 1024):
+        self.path: Path = Path(path)
+        self.lru_size: int = lru_size
+
+        with open(self.path / "index.pkl", 'rb') as f:
+            index: dict[str, Any] = pickle.load(f)
+        self.stems: list[str] = index["stems"]
+        self.shape: tuple[int, ...] = tuple(index["shape"])
+
+        # Opened lazily, so that each DataLoader worker gets its own file handle
+        self._features: Union[np.memmap, None] = None
+        self.lru: OrderedDict[int, Tensor] = OrderedDict()
+
+    def __getstate__(self):
+        # Never pickle the memmap, nor the in-memory tier
+        state = self.__dict__.copy()
+        state["_features"] = None
+        state["lru"] = OrderedDict()
+        return state
+
+    def __len__(self) -> int:
+        return len(self.stems)
+
+    @property
+    def features(self) -> np.memmap:
+        if self._features is None:
+            self._features = np.memmap(self.path / "features.f16", dtype=np.float16, mode='r',
+                                       shape=(len(self.stems), *self.shape))
+        return self._features
+
+    def __getitem__(self, i: int) -> Tensor:
+        if i in self.lru:
+            self.lru.move_to_end(i)
+            return self.lru[i]
+
+        feature: Tensor = torch.from_numpy(np.array(self.features[i]))  # fp16, converted on the device
+        self.lru[i] = feature
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+        return feature
+
+    @staticmethod
+    def valid(path: Path, stems: list[str]) -> bool:
+        if not (path / "index.pkl").exists() or not (path / "features.f16").exists():
+            return False
+
+        with open(path / "index.pkl", 'rb') as f:
+            index: dict[str, Any] = pickle.load(f)
+        expected: int = len(stems) * int(np.prod(index["shape"])) * np.dtype(np.float16).itemsize
+
+        return index["stems"] == stems and (path / "features.f16").stat().st_size == expected
+
+    @classmethod
+    def build(cls, path: Path, net: nn.Module, dataset: Dataset, device: torch.device, batch_size: int = 32,
+              num_workers: int = 0, lru_size: int = 1024) -> "FeatureCache":
+        """
+        The cache of the `net.backbone_features` of every slice of `dataset`, in its order, computed now unless an
+        up-to-date one is already in `path`.
+        """
+        path = Path(path)
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+
+        stems: list[str] = dataset_stems(dataset)
+        if cls.valid(path, stems):
+            print(f">> Reusing the backbone features of {path}")
+            return cls(path, lru_size=lru_size)
+
+        # Written next to the final folder, which is only replaced once complete
+        tmp_path: Path = path.with_name(path.name + ".tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+
+        training: bool = net.training
+        net.eval()  # The frozen backbone normalizes with its running statistics
+        shape: tuple[int, ...] = ()
+        with open(tmp_path / "features.f16", 'wb') as f, torch.inference_mode():
+            for data in tqdm_(loader, desc=f">> Caching the backbone features in {path}"):
+                features: Tensor = net.backbone_features(data['images'].to(device))
+                shape = tuple(features.shape[1:])
+                f.write(features.to(torch.float16).cpu().numpy().tobytes())
+        net.train(training)
+
+        with open(tmp_path / "index.pkl", 'wb') as f:
+            pickle.dump({"stems": stems, "shape": shape}, f, pickle.HIGHEST_PROTOCOL)
+
+        if path.exists():
+            for old in path.iterdir():
+                old.unlink()
+            path.rmdir()
+        tmp_path.rename(path)
+
+        return cls(path, lru_size=lru_size)
+
+
+class FeatureDataset(Dataset):
+    """
+    The labels of the slices of `dataset`, each one along with its cached backbone features (`features`) instead
+    of the image, which is never loaded.
+    """
+    def __init__(self, dataset: Dataset, cache: FeatureCache):
+        assert cache.stems == dataset_stems(dataset), "The cache does not hold the slices of the dataset"
+        self.dataset: Dataset = dataset
+        self.cache: FeatureCache = cache
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __getitem__(self, index) -> dict[str, Any]:
+        return {"gts": self.dataset.load_gt(index),  # type: ignore
+                "stems": self.cache.stems[index],  # Checked against those of the dataset when the cache is loaded
+                "features": self.cache[index]}
+
+    def class_counts(self, K: int) -> np.ndarray:
+        return self.dataset.class_counts(K)  # type: ignore
+
+
+def cached_features(dataset: Dataset, root: Path, subset: str, source: str, net: nn.Module, device: torch.device,
+                    **kwargs) -> FeatureDataset:
+    """
+    `dataset` along with the backbone features of its slices, cached in `<root>/<subset>/features/<source>`
+    (`source` telling apart the datasets of a same split, e.g. the transformation).
+    """
+    cache: FeatureCache = FeatureCache.build(Path(root) / subset / FEATURES_DIR / source, net, dataset, device,
+                                             **kwargs)
+
+    return FeatureDataset(dataset, cache)
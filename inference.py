@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# MIT License
+
+# Copyright (c) 2024 Hoel Kervadec
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# NIfTI to NIfTI inference: replaces the slice_segthor_for_test_set.py -> test_predictions.py ->
+# renaming_script.py -> stitch.py chain, without writing or reading any PNG in between.
+
+import copy
+import time
+import argparse
+from pathlib import Path
+from pprint import pprint
+from typing import Optional
+
+import numpy as np
+import nibabel as nib
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from ENet import ENET_PRESETS, ENet
+from postprocessing import DEFAULT_STEPS, postprocess
+from slice_segthor import norm_arr
+from utils import compile_net, pad_batch, tqdm_
+
+
+def prepare_volume(ct: np.ndarray, shape: tuple[int, int]) -> Tensor:
+    """
+    Same normalization and resizing as slice_segthor.py, for the whole (X, Y, Z) volume at once.
+    Returns the (Z, 1, *shape) network input, in [0, 1].
+    """
+    norm_ct: Tensor = torch.from_numpy(norm_arr(ct))  # uint8, [0, 255]
+    slices: Tensor = norm_ct.permute(2, 0, 1)[:, None, ...].float()
+
+    # Bilinear without anti-aliasing, as the skimage resize of the slicing, then the same uint8 truncation
+    resized: Tensor = F.interpolate(slices, size=shape, mode="bilinear", align_corners=False)
+
+    return resized.to(torch.uint8).float() / 255
+
+
+def predict_slices(net: nn.Module, slices: Tensor, batch_size: int, device: torch.device,
+                   out_shape: Optional[tuple[int, int]] = None, pad: bool = False) -> Tensor:
+    """
+    Run the network on a (Z, 1, H, W) stack of slices, `batch_size` slices at a time.
+    Returns the (Z, H, W) uint8 predicted classes, on the CPU. With `out_shape`, the logits are first resized
+    (bilinear) to it, batch by batch, and the classes are predicted at that resolution instead.
+    With `pad`, the last batch is padded to `batch_size` slices (for a compiled network, with static shapes).
+    """
+    preds: list[Tensor] = []
+    with torch.inference_mode():
+        for b in range(0, len(slices), batch_size):
+            batch: Tensor = slices[b:b + batch_size]
+            logits: Tensor = net((pad_batch(batch, batch_size) if pad else batch).to(device, non_blocking=True))
+            logits = logits[:len(batch)]
+            if out_shape is not None:
+                logits = F.interpolate(logits, size=out_shape, mode="bilinear", align_corners=False)
+            # The softmax is monotonic, the argmax of the logits gives the same classes
+            preds.append(logits.argmax(dim=1).to(torch.uint8).cpu())
+
+    return torch.cat(preds)
+
+
+def resize_labels(labels: Tensor, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Resize a (Z, H, W) stack of labels back to the original (X, Y) in-plane shape, with nearest neighbour
+    (center-aligned, as the skimage resize of stitch.py). Returns the (X, Y, Z) volume.
+    """
+    resized: Tensor = F.interpolate(labels[:, None, ...].float(), size=shape, mode="nearest-exact")
+
+    return resized[:, 0].permute(1, 2, 0).to(torch.uint8).numpy()
+
+
+def segment_volume(net: nn.Module, ct: np.ndarray, shape: tuple[int, int], batch_size: int,
+                   device: torch.device, resize_logits: bool = False, pad: bool = False) -> np.ndarray:
+    """
+    Segment a whole (X, Y, Z) CT volume: normalized and resized once, as the training slices, predicted
+    `batch_size` slices at a time, and brought back to (X, Y, Z), either by resizing the predicted labels
+    (nearest) or, with `resize_logits`, the logits (bilinear) before the argmax.
+    """
+    X, Y, _ = ct.shape
+
+    slices: Tensor = prepare_volume(ct, shape)
+    if resize_logits:
+        return predict_slices(net, slices, batch_size, device, out_shape=(X, Y), pad=pad).permute(1, 2, 0).numpy()
+
+    preds: Tensor = predict_slices(net, slices, batch_size, device, pad=pad)
+
+    return resize_labels(preds, (X, Y))
+
+
+def fold_batchnorms(module: nn.Module) -> tuple[int, int]:
+    """
+    In place, on a module in eval mode: every BatchNorm2d directly following a Conv2d in a Sequential (conv_block,
+    conv_block_asym, convBatch, the torchvision Conv2dNormActivation and DeepLabHead, ...) is folded into the
+    convolution weights and replaced by an Identity, as every Dropout. Returns the numbers of both.
+    """
+    folded: int = 0
+    dropouts: int = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.modules.dropout._DropoutNd):
+            setattr(module, name, nn.Identity())
+            dropouts += 1
+        else:
+            child_folded, child_dropouts = fold_batchnorms(child)
+            folded += child_folded
+            dropouts += child_dropouts
+
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(conv, bn)
+                module[i + 1] = nn.Identity()
+                folded += 1
+
+    return folded, dropouts
+
+
+def optimize_for_inference(net: nn.Module, sample: Optional[Tensor] = None, tolerance: float = 1e-3) -> nn.Module:
+    """
+    A copy of `net`, in eval mode, with its BatchNorms folded into the convolutions and without Dropout (see
+    fold_batchnorms); `net` itself, and its train/eval mode, are left untouched. With a `sample` batch, check that
+    the copy predicts the same classes as `net` in eval mode. The folding is exact but for the float rounding,
+    which may still flip the index kept by a max pooling between two nearly equal values; the ENet max unpooling
+    then moves that value elsewhere. At most a `tolerance` fraction of the pixels may thus change class.
+    """
+    optimized: nn.Module = copy.deepcopy(net).eval()
+    # What the folding is checked against: the eval-mode network, whatever the mode `net` is in
+    reference: Optional[nn.Module] = copy.deepcopy(optimized) if sample is not None else None
+
+    folded, dropouts = fold_batchnorms(optimized)
+    print(f">> Folded {folded} BatchNorms into their convolutions, removed {dropouts} Dropouts")
+
+    if reference is not None:
+        with torch.inference_mode():
+            classes: Tensor = reference(sample).argmax(dim=1)
+            optimized_classes: Tensor = optimized(sample).argmax(dim=1)
+        changed: float = (classes != optimized_classes).float().mean().item()
+        assert changed <= tolerance, f"{changed:.3%} of the pixels predicted differently after the BatchNorm folding"
+
+    return optimized
+
+
+def load_net(args: argparse.Namespace, device: torch.device) -> nn.Module:
+    net: nn.Module
+    if args.model_checkpoint.suffix == ".pkl":  # Whole pickled model (bestmodel.pkl)
+        net = torch.load(args.model_checkpoint, map_location=device, weights_only=False)
+    else:  # State dict (bestweights.pt)
+        net = ENet(1, args.num_classes, preset=args.architecture, kernels=args.kernels, kernelsize=args.kernelsize)
+        net.load_state_dict(torch.load(args.model_checkpoint, map_location=device))
+
+    return net.eval().to(device)
+
+
+def compile_for_inference(net: nn.Module, shape: tuple[int, int], batch_size: int,
+                          device: torch.device) -> nn.Module:
+    """
+    Compile `net` for batches of `batch_size` slices of `shape`, and run it once on a dummy batch, so that the
+    compilation time is reported apart from the inference. The batches should then be padded (`pad=True`).
+    """
+    sample: Tensor = torch.zeros((batch_size, 1, *shape), device=device)
+    compiled: nn.Module = compile_net(net, sample[:1])
+
+    start: float = time.perf_counter()
+    predict_slices(compiled, sample, batch_size, device)
+    print(f">> Compiled {net.__class__.__name__} in {time.perf_counter() - start:.1f}s")
+
+    return compiled
+
+
+def main(args: argparse.Namespace) -> None:
+    device = torch.device("cuda") if args.gpu and torch.cuda.is_available() else torch.device("cpu")
+    net: nn.Module = optimize_for_inference(load_net(args, device),
+                                            torch.rand((2, 1, *args.shape), device=device))
+    if args.compile:
+        net = compile_for_inference(net, tuple(args.shape), args.batch_size, device)
+
+    scans: list[Path] = sorted(args.source_dir.glob("*.nii.gz"))
+    print(f">> Found {len(scans)} scans in {args.source_dir}")
+
+    args.dest_folder.mkdir(parents=True, exist_ok=True)
+    for scan in tqdm_(scans):
+        orig_nib = nib.load(str(scan))
+        ct: np.ndarray = np.asarray(orig_nib.dataobj)
+
+        res_arr: np.ndarray = segment_volume(net, ct, tuple(args.shape), args.batch_size, device,
+                                             resize_logits=args.resize_logits, pad=args.compile).astype(np.int16)
+        assert res_arr.shape == ct.shape, (res_arr.shape, ct.shape)
+
+        if args.post_processing:
+            res_arr = postprocess(res_arr, steps=DEFAULT_STEPS)  # Dilation, largest component, smoothing
+
+        new_nib = nib.nifti1.Nifti1Image(res_arr, affine=orig_nib.affine, header=orig_nib.header)
+        nib.save(new_nib, args.dest_folder / scan.name)
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Segment whole CT volumes, from NIfTI to NIfTI')
+    parser.add_argument('--source_dir', type=Path, required=True,
+                        help="The folder containing the .nii.gz scans to segment")
+    parser.add_argument('--dest_folder', type=Path, required=True)
+    parser.add_argument('--model_checkpoint', type=Path, required=True,
+                        help="Either a pickled model (bestmodel.pkl) or a state dict (bestweights.pt)")
+
+    parser.add_argument('--num_classes', type=int, default=5)
+    parser.add_argument('--kernels', type=int, default=25,
+                        help="Number of kernels of the ENet, when loading a state dict")
+    parser.add_argument('--architecture', default='normal', choices=list(ENET_PRESETS),
+                        help="Depth of the ENet (as main.py --architecture), when loading a state dict")
+    parser.add_argument('--kernelsize', type=int, default=3,
+                        help="Initial kernel size of the ENet, when loading a state dict")
+    parser.add_argument('--shape', type=int, nargs=2, default=[256, 256],
+                        help="The slice shape the network was trained on")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--resize_logits', action='store_true',
+                        help="Resize the logits (bilinear) to the original shape before the argmax, instead of the "
+                             "predicted labels (nearest)")
+    parser.add_argument('--post_processing', action='store_true')
+    parser.add_argument('--compile', action='store_true',
+                        help="torch.compile the network, the last batch of every volume being padded")
+
+    args = parser.parse_args()
+
+    pprint(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -37,6 +37,7 @@ class CrossEntropy():
 
     def __call__(self, pred_softmax, weak_target):
         assert pred_softmax.shape == weak_target.shape
+        assert pred_softmax.dtype == torch.float32, pred_softmax.dtype  # The 1e-10 guards vanish in 16 bits
         assert simplex(pred_softmax)
         assert sset(weak_target, [0, 1])
     
@@ -57,6 +58,7 @@ class FocalLoss():
     
     def __call__(self, pred_softmax, weak_target):
         assert pred_softmax.shape == weak_target.shape
+        assert pred_softmax.dtype == torch.float32, pred_softmax.dtype
 
         b, _, h, w = pred_softmax.shape
 
@@ -86,6 +88,7 @@ class JaccardLoss():
 
     def __call__(self, pred_softmax, weak_target):
         assert pred_softmax.shape == weak_target.shape
+        assert pred_softmax.dtype == torch.float32, pred_softmax.dtype
         assert simplex(pred_softmax)
         assert sset(weak_target, [0, 1])
 
@@ -111,6 +114,7 @@ class DiceLoss():
 
     def __call__(self, pred_softmax, weak_target):
         assert pred_softmax.shape == weak_target.shape
+        assert pred_softmax.dtype == torch.float32, pred_softmax.dtype
         assert simplex(pred_softmax)
         assert sset(weak_target, [0, 1])
 
@@ -159,6 +163,7 @@ class LovaszSoftmaxLoss():
         :return: scalar loss value
         """
         assert pred_softmax.shape == target.shape, "Predictions and targets must have the same shape"
+        assert pred_softmax.dtype == torch.float32, pred_softmax.dtype
 
         # Select only the relevant classes using fancy indexing
         pred = pred_softmax[:, self.idk, ...]  # [Batch, Relevant Classes, Height, Width]
@@ -205,6 +210,7 @@ class CustomLoss():
 
     def __call__(self, pred_softmax, weak_target):
         assert pred_softmax.shape == weak_target.shape
+        assert pred_softmax.dtype == torch.float32, pred_softmax.dtype
         assert simplex(pred_softmax)
         assert sset(weak_target, [0, 1])
 
@@ -22,55 +22,46 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import math
+import time
+import random
 import argparse
 import warnings
 from datetime import datetime
-from operator import itemgetter
 from pathlib import Path
 from plot import run as plot
 from pprint import pprint
 from shutil import copytree, rmtree
-from typing import Any
+from typing import Any, Optional
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import DataLoader, Dataset, WeightedRandomSampler
 from torchvision import transforms
 from torchvision.transforms import InterpolationMode
 from torch.optim.lr_scheduler import ExponentialLR, StepLR 
 
-from dataset import SliceDataset, SliceDatasetWithTransforms
+from augment import BatchAugmenter
+from dataset import PackedSliceDataset, SliceDataset, SliceDatasetWithTransforms
+from feature_cache import cached_features
 from DeepLabV3 import DeepLabV3
-from ENet import ENet
+from ENet import ENET_PRESETS, ENet
 from ShallowNet import shallowCNN
+from metrics import MetricLog, MetricsWorker, compute_metrics
 from losses import (CrossEntropy, JaccardLoss, DiceLoss, LovaszSoftmaxLoss, CustomLoss, FocalLoss)
-from ENet_less_layers import less_ENet
-from ENet_more_layers import more_ENet
-from ENet_kernelsize import kernel_ENet
-from utils import (
-    Dcm,
-    class2one_hot,
-    dice_coef,
-    probs2class,
-    probs2one_hot,
-    save_images,
-    tqdm_
-)
-from torch.utils.data import WeightedRandomSampler
-
 from utils import (Dcm,
+                   checks_enabled,
+                   compile_net,
+                   pad_batch,
+                   set_validation,
+                   validation_step,
                    class2one_hot,
                    probs2one_hot,
                    probs2class,
                    tqdm_,
-                   dice_coef,
-                   save_images,
-                   iou_coef,
-                   assd_coef,
-                   vol_sim_coef,
-                   hausdorff_coef)
+                   save_images)
 
 
 def compute_class_weights(train_set, K):
@@ -78,19 +69,57 @@ def compute_class_weights(train_set, K):
     Compute class weights for the training dataset.
     This ensures that underrepresented classes (like classes 1 and 4) are sampled more frequently.
     """
-    class_counts = np.zeros(K)
-
-    # Loop through the dataset and count the number of pixels for each class
-    for _, data in enumerate(train_set):
-        gt = data['gts']  # Ground truth mask
-        for k in range(K):
-            class_counts[k] += (gt == k).sum().item()
+    # Number of pixels for each class, from the class histogram index of the dataset (no PNG decoding)
+    class_counts = train_set.class_counts(K).sum(axis=0)
 
     # Compute class weights (inverse of class frequencies)
     class_weights = 1.0 / np.maximum(class_counts, 1)  # Avoid division by zero
 
     return class_weights
 
+def save_checkpoint(path: Path, epoch: int, best_dice: float, net: nn.Module, optimizer, scheduler,
+                    scaler=None) -> None:
+    """
+    Everything needed to resume the training after `epoch`. The metric logs of the finished epochs are already on
+    disk, so only the RNG states are needed on top of the model, optimizer and scheduler.
+    """
+    state: dict[str, Any] = {"epoch": epoch,
+                             "best_dice": best_dice,
+                             "net": net.state_dict(),
+                             "optimizer": optimizer.state_dict(),
+                             "scheduler": scheduler.state_dict() if scheduler else None,
+                             "scaler": scaler.state_dict() if scaler else None,
+                             "rng": {"python": random.getstate(),
+                                     "numpy": np.random.get_state(),
+                                     "torch": torch.get_rng_state(),
+                                     "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}}
+
+    # Write then rename, so that a job killed while saving does not leave a corrupted checkpoint
+    tmp_path: Path = path.with_suffix(".tmp")
+    torch.save(state, tmp_path)
+    tmp_path.replace(path)
+
+
+def load_checkpoint(path: Path, net: nn.Module, optimizer, scheduler, device, scaler=None) -> tuple[int, float]:
+    state: dict[str, Any] = torch.load(path, map_location=device, weights_only=False)
+
+    net.load_state_dict(state["net"])
+    optimizer.load_state_dict(state["optimizer"])
+    if scheduler:
+        scheduler.load_state_dict(state["scheduler"])
+    if scaler and state.get("scaler"):
+        scaler.load_state_dict(state["scaler"])
+
+    random.setstate(state["rng"]["python"])
+    np.random.set_state(state["rng"]["numpy"])
+    torch.set_rng_state(state["rng"]["torch"].cpu())
+    if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["rng"]["cuda"]])
+
+    # Returns the epoch to start from
+    return state["epoch"] + 1, state["best_dice"]
+
+
 datasets_params: dict[str, dict[str, Any]] = {}
 # K for the number of classes
 # Avoids the clases with C (often used for the number of Channel)
@@ -105,20 +134,16 @@ def setup(args) -> tuple[nn.Module, Any, Any, DataLoader, DataLoader, int]:
     print(f">> Picked {device} to run experiments")
 
     K: int = datasets_params[args.dataset]['K']
-    if args.architecture == "normal":
-        net = kernel_ENet(1, K, kernels = args.channels, kernelsize = args.kernelsize)
-    elif args.architecture == "more":
-        net = more_ENet(1, K, kernels = args.channels, kernelsize = args.kernelsize)
-    elif args.architecture == "less":
-        net = less_ENet(1, K, kernels = args.channels, kernelsize = args.kernelsize)
-
+    net: nn.Module
     if args.deeplabv3:
         net = DeepLabV3(K, pretrained=args.pretrained)
-        net.to(device)
+    elif datasets_params[args.dataset]['net'] is ENet:
+        net = ENet(1, K, preset=args.architecture, kernels=args.channels, kernelsize=args.kernelsize)
+        net.init_weights()
     else:
         net = datasets_params[args.dataset]['net'](1, K)
         net.init_weights()
-        net.to(device)
+    net.to(device)
 
     lr = args.lr
     if args.optimizer == 'sgd':
@@ -159,12 +184,18 @@ def setup(args) -> tuple[nn.Module, Any, Any, DataLoader, DataLoader, int]:
         # {0, 51, 102, 153, 204, 255} for 6 classes
         # Very sketchy but that works here and that simplifies visualization
         lambda nd: nd / (255 / (K - 1)) if K != 5 else nd / 63,  # max <= 1 # Normalize the image
-        lambda nd: torch.tensor(nd, dtype=torch.int64)[None, ...],  # Add one dimension to simulate batch
-        lambda t: class2one_hot(t, K=K), # Convert to one-hot encoding
-        itemgetter(0)
+        # Keep a compact uint8 class map: the one-hot encoding is done once per batch, on the device
+        lambda nd: torch.tensor(nd, dtype=torch.uint8)
     ])
 
-    if args.transformation == 'none':
+    if args.packed:
+        if args.transformation != 'none':
+            raise ValueError(f"--packed only stores the original slices, not the {args.transformation} ones")
+        train_set = PackedSliceDataset('train',
+                                       root_dir,
+                                       debug=args.debug,
+                                       remove_background=args.remove_background)
+    elif args.transformation == 'none':
         train_set = SliceDataset('train',
                              root_dir,
                              img_transform=img_transform,
@@ -194,19 +225,23 @@ def setup(args) -> tuple[nn.Module, Any, Any, DataLoader, DataLoader, int]:
             remove_background=args.remove_background
         )
 
+    # The pretrained backbone is frozen: its features are computed once per slice, and only the head is trained
+    if args.feature_cache:
+        if not (args.deeplabv3 and args.pretrained):
+            raise ValueError("--feature_cache needs the frozen backbone of --deeplabv3 --pretrained")
+        if args.online_augment or args.compile:
+            raise ValueError("--feature_cache only runs the head, on the features of the un-augmented slices: "
+                             "it cannot be combined with --online_augment nor --compile")
+        source: str = 'packed' if args.packed else args.transformation
+        train_set = cached_features(train_set, root_dir, 'train', source, net, device,
+                                    num_workers=args.num_workers, lru_size=args.feature_cache_lru)
+
     if args.class_aware_sampling:
         # Compute class weights for class-aware sampling
         class_weights = compute_class_weights(train_set, K)
 
         # Create sample weights for each image in the dataset based on the presence of each class
-        sample_weights = []
-        for data in train_set:
-            gt = data['gts']
-            sample_weight = 0
-            for k in range(K):
-                if torch.any(gt == k):
-                    sample_weight += class_weights[k]
-            sample_weights.append(sample_weight)
+        sample_weights = (train_set.class_counts(K) > 0) @ class_weights
 
         sampler = WeightedRandomSampler(weights=sample_weights, num_samples=len(train_set), replacement=True)
 
@@ -216,22 +251,36 @@ def setup(args) -> tuple[nn.Module, Any, Any, DataLoader, DataLoader, int]:
             batch_size=B,
             num_workers=args.num_workers,
             sampler=sampler,
+            drop_last=args.last_batch == 'drop',
+            pin_memory=gpu,
         )
     else:
         train_loader = DataLoader(train_set,
                                 batch_size=B,
                                 num_workers=args.num_workers,
-                                shuffle=True)
-
-    val_set = SliceDataset('val',
-                           root_dir,
-                           img_transform=img_transform,
-                           gt_transform=gt_transform,
-                           debug=args.debug)
+                                shuffle=True,
+                                drop_last=args.last_batch == 'drop',
+                                pin_memory=gpu)
+
+    val_set: Dataset
+    if args.packed:
+        val_set = PackedSliceDataset('val',
+                                     root_dir,
+                                     debug=args.debug)
+    else:
+        val_set = SliceDataset('val',
+                               root_dir,
+                               img_transform=img_transform,
+                               gt_transform=gt_transform,
+                               debug=args.debug)
+    if args.feature_cache:
+        val_set = cached_features(val_set, root_dir, 'val', 'packed' if args.packed else 'none', net, device,
+                                  num_workers=args.num_workers, lru_size=args.feature_cache_lru)
     val_loader = DataLoader(val_set,
                             batch_size=B,
                             num_workers=args.num_workers,
-                            shuffle=False)
+                            shuffle=False,
+                            pin_memory=gpu)
 
     args.dest.mkdir(parents=True, exist_ok=True)
 
@@ -244,12 +293,24 @@ def setup(args) -> tuple[nn.Module, Any, Any, DataLoader, DataLoader, int]:
 
 def runTraining(args):
     print(f">>> Setting up to train on {args.dataset} with {args.mode}")
+    set_validation(args.validation, every=args.validation_every)
     if args.scheduler == "None": #ME
         net, optimizer, device, train_loader, val_loader, K = setup(args) #ME
+        scheduler = None
     else:   #ME
         net, optimizer, device, train_loader, val_loader, K, scheduler =setup(args) #ME -> added scheduler
 
 
+    # Reduced precision: autocast for the forward passes (training and validation). The fp16 gradients can
+    # underflow, hence the gradient scaling; bf16 has the range of fp32 and needs none.
+    amp_dtype: Optional[torch.dtype] = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[args.precision]
+    if args.precision == "fp16" and device.type != "cuda":
+        raise ValueError("fp16 autocast needs a GPU, use --precision bf16 on CPU")
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == "fp16")
+
+    if args.channels_last:
+        net.to(memory_format=torch.channels_last)  # In place, the optimizer still holds the same parameters
+
     if args.mode == "full":
         idk = list(range(K))
     elif args.mode in ["partial"] and args.dataset in ['SEGTHOR', 'SEGTHOR_STUDENTS']:
@@ -273,24 +334,44 @@ def runTraining(args):
         raise ValueError(args.loss)
 
     # Notice one has the length of the _loader_, and the other one of the _dataset_
-    log_loss_tra: Tensor = torch.zeros((args.epochs, len(train_loader)))
-    log_dice_tra: Tensor = torch.zeros((args.epochs, len(train_loader.dataset), K))
-    log_loss_val: Tensor = torch.zeros((args.epochs, len(val_loader)))
-    log_dice_val: Tensor = torch.zeros((args.epochs, len(val_loader.dataset), K))
+    # Only the current epoch is kept in memory: each finished epoch is appended as args.dest/<name>/<epoch>.npy
+    log_loss_tra = MetricLog(args.dest, "loss_tra", (len(train_loader),))
+    log_dice_tra = MetricLog(args.dest, "dice_tra", (len(train_loader.dataset), K))
+    log_loss_val = MetricLog(args.dest, "loss_val", (len(val_loader),))
+    log_dice_val = MetricLog(args.dest, "dice_val", (len(val_loader.dataset), K))
 
     # Additional metrics
-    log_iou_tra = torch.zeros((args.epochs, len(train_loader.dataset), K))
-    log_hausdorff_tra = torch.zeros((args.epochs, len(train_loader.dataset), K))
-    log_assd_tra = torch.zeros((args.epochs, len(train_loader.dataset), K))
-    log_volsim_tra = torch.zeros((args.epochs, len(train_loader.dataset), K))
-    log_iou_val = torch.zeros((args.epochs, len(val_loader.dataset), K))
-    log_hausdorff_val = torch.zeros((args.epochs, len(val_loader.dataset), K))
-    log_assd_val = torch.zeros((args.epochs, len(val_loader.dataset), K))
-    log_volsim_val = torch.zeros((args.epochs, len(val_loader.dataset), K))
+    log_iou_tra = MetricLog(args.dest, "iou_tra", (len(train_loader.dataset), K))
+    log_hausdorff_tra = MetricLog(args.dest, "hausdorff_tra", (len(train_loader.dataset), K))
+    log_assd_tra = MetricLog(args.dest, "assd_tra", (len(train_loader.dataset), K))
+    log_volsim_tra = MetricLog(args.dest, "volsim_tra", (len(train_loader.dataset), K))
+    log_iou_val = MetricLog(args.dest, "iou_val", (len(val_loader.dataset), K))
+    log_hausdorff_val = MetricLog(args.dest, "hausdorff_val", (len(val_loader.dataset), K))
+    log_assd_val = MetricLog(args.dest, "assd_val", (len(val_loader.dataset), K))
+    log_volsim_val = MetricLog(args.dest, "volsim_val", (len(val_loader.dataset), K))
+    all_logs: list[MetricLog] = [log_loss_tra, log_dice_tra, log_loss_val, log_dice_val,
+                                 log_iou_tra, log_hausdorff_tra, log_assd_tra, log_volsim_tra,
+                                 log_iou_val, log_hausdorff_val, log_assd_val, log_volsim_val]
 
     best_dice: float = 0
-
-    for e in range(args.epochs):
+    start_epoch: int = 0
+    if args.resume:
+        start_epoch, best_dice = load_checkpoint(args.dest / "checkpoint.pt", net, optimizer, scheduler, device,
+                                                 scaler=scaler)
+        for log in all_logs:
+            log.truncate(start_epoch)
+        print(f">>> Resuming {args.dest} at epoch {start_epoch}, best DSC so far {best_dice:05.3f}")
+
+    # The compiled module shares the parameters of net, which is still the one saved and checkpointed
+    forward: nn.Module = net
+    if args.compile:
+        forward = compile_net(net, train_loader.dataset[0]['images'][None].to(device))
+
+    worker: Optional[MetricsWorker] = MetricsWorker(K, workers=args.metrics_workers) if args.async_metrics else None
+    # Fresh augmentations of every training batch, on the device
+    augmenter: Optional[BatchAugmenter] = BatchAugmenter() if args.online_augment else None
+
+    for e in range(start_epoch, args.epochs):
         for m in ['train', 'val']:
             if m == 'train':
                 net.train()
@@ -316,90 +397,128 @@ def runTraining(args):
                 log_hausdorff = log_hausdorff_val
                 log_assd = log_assd_val
                 log_volsim = log_volsim_val
+            logs: dict[str, MetricLog] = {"dice": log_dice,
+                                          "iou": log_iou,
+                                          "hausdorff": log_hausdorff,
+                                          "assd": log_assd,
+                                          "volsim": log_volsim}
+            for log in [log_loss, *logs.values()]:
+                log.start_epoch(e)
+            # Static shapes: the short last batch is padded (the validation one is never dropped)
+            pad: bool = args.last_batch == 'pad' or (args.last_batch == 'drop' and m == 'val')
 
             with cm():  # Either dummy context manager, or the torch.no_grad for validation
                 j = 0
                 tq_iter = tqdm_(enumerate(loader), total=len(loader), desc=desc)
+                first_step: float = 0
+                steps_time: float = 0
                 for i, data in tq_iter:
-                    img = data['images'].to(device)
-                    gt = data['gts'].to(device)
+                    step_start: float = time.perf_counter()
+                    # No image with --feature_cache, only the backbone features
+                    img = data['images'].to(device, non_blocking=True) if 'images' in data else None
+                    gt_class = data['gts'].to(device, non_blocking=True)
+                    if augmenter and opt:  # Only for training
+                        img, gt_class = augmenter(img, gt_class)
+                    # The loader only ships uint8 class maps, expanded to one-hot once for the whole batch
+                    gt = class2one_hot(gt_class.long(), K)
 
                     if opt:  # So only for training
                         opt.zero_grad()
 
                     # Sanity tests to see we loaded and encoded the data correctly
-                    assert 0 <= img.min() and img.max() <= 1
-                    B, _, W, H = img.shape
-
-                    pred_logits = net(img)
-                    pred_probs = F.softmax(1 * pred_logits, dim=1)  # 1 is the temperature parameter
+                    assert not checks_enabled() or img is None or (0 <= img.min() and img.max() <= 1)
+                    B, W, H = gt_class.shape
+
+                    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                        if 'features' in data:  # --feature_cache: only the head runs, on the backbone features
+                            pred_logits = net.head(data['features'].to(device, non_blocking=True).float(), (W, H))
+                        else:
+                            net_in: Tensor = pad_batch(img, loader.batch_size) if pad else img
+                            if args.channels_last:
+                                net_in = net_in.contiguous(memory_format=torch.channels_last)
+                            pred_logits = forward(net_in)[:B]  # Without the padding
+                    # The softmax, and so the losses and metrics, stay in fp32 whatever the precision of the
+                    # network: the logs, the 1e-10 guards and the sums over the whole batch are not safe in 16 bits
+                    pred_probs = F.softmax(1 * pred_logits.float(), dim=1)  # 1 is the temperature parameter
 
                     # Metrics computation, not used for training
-                    pred_seg = probs2one_hot(pred_probs)
-                    log_dice[e, j:j + B, :] = dice_coef(pred_seg, gt)  # One DSC value per sample and per class
-
-                    # IoU (Jaccard Index)
-                    log_iou[e, j:j + B, :] = iou_coef(pred_seg, gt)
-
-                    # Hausdorff Distance
-                    log_hausdorff[e, j:j + B, :] = hausdorff_coef(pred_seg, gt).transpose(0, 1)
-
-                    # ASSD (Average Symmetric Surface Distance)
-                    log_assd[e, j:j + B, :] = assd_coef(pred_seg, gt).transpose(0, 1)
-
-                    # Volumetric Similarity
-                    log_volsim[e, j:j + B, :] = vol_sim_coef(pred_seg, gt)
+                    # Dice, IoU, Hausdorff, ASSD and VolSim. The surface distances are CPU-bound, so they can be
+                    # restricted to every Nth training batch (or to the validation only, with 0)
+                    surface: bool = m == 'val' or (args.train_surface_every > 0
+                                                   and i % args.train_surface_every == 0)
+                    if worker:  # Hand compact class maps to the background threads
+                        worker.submit(probs2class(pred_probs).to(torch.uint8).cpu(), gt_class.cpu(),
+                                      logs, j, surface=surface)
+                    else:
+                        pred_seg = probs2one_hot(pred_probs)
+                        for name, values in compute_metrics(pred_seg, gt, surface=surface).items():
+                            logs[name][j:j + B] = values
 
                     loss = loss_fn(pred_probs, gt)
-                    log_loss[e, i] = loss.item()  # One loss value per batch (averaged in the loss)
+                    loss_value: float = loss.item()
+                    log_loss[i] = loss_value  # One loss value per batch (averaged in the loss)
+                    assert not checks_enabled() or math.isfinite(loss_value), \
+                        f"Non-finite {args.loss} loss ({loss_value}) with --precision {args.precision}"
 
                     if opt:  # Only for training
-                        loss.backward()
-                        opt.step()
+                        # No-ops, unless fp16: the loss is scaled up, and the step skipped if the gradients overflowed
+                        scaler.scale(loss).backward()
+                        scaler.step(opt)
+                        scaler.update()
 
                     if m == 'val':
                         with warnings.catch_warnings():
                             warnings.filterwarnings('ignore', category=UserWarning)
                             predicted_class: Tensor = probs2class(pred_probs)
                             mult: int = 63 if K == 5 else (255 / (K - 1))
-                            if not args.dont_save_predictions and log_dice[e, :, 1:].mean().item() > best_dice:
+                            if worker and not args.dont_save_predictions:
+                                worker.wait()  # The running mean must include this batch, as without the worker
+                            if not args.dont_save_predictions and log_dice.mean()[1:].mean().item() > best_dice:
                                 save_images(predicted_class * mult,
                                             data['stems'],
                                             args.dest / f"iter{e:03d}" / m)
 
+                    if opt:
+                        validation_step()
+
+                    step_time: float = time.perf_counter() - step_start
+                    if i == 0:
+                        first_step = step_time
+                    else:
+                        steps_time += step_time
+
                     j += B  # Keep in mind that _in theory_, each batch might have a different size
                     # For the DSC average: do not take the background class (0) into account:
-                    postfix_dict: dict[str, str] = {"Dice": f"{log_dice[e, :j, 1:].mean():05.3f}",
-                                                    "IoU": f"{log_iou[e, :j, 1:].mean():05.3f}",
-                                                    "Hausdorff": f"{log_hausdorff[e, :j, 1:].mean():05.3f}",
-                                                    "ASSD": f"{log_assd[e, :j, 1:].mean():05.3f}",
-                                                    "VolSim": f"{log_volsim[e, :j, 1:].mean():05.3f}",
-                                                    "Loss": f"{log_loss[e, :i + 1].mean():5.2e}"}
+                    # Running means, kept up to date by the logs themselves
+                    dice_means: Tensor = log_dice.mean()
+                    postfix_dict: dict[str, str] = {"Dice": f"{dice_means[1:].mean():05.3f}",
+                                                    "IoU": f"{log_iou.mean()[1:].mean():05.3f}",
+                                                    "Hausdorff": f"{log_hausdorff.mean()[1:].mean():05.3f}",
+                                                    "ASSD": f"{log_assd.mean()[1:].mean():05.3f}",
+                                                    "VolSim": f"{log_volsim.mean()[1:].mean():05.3f}",
+                                                    "Loss": f"{log_loss.mean():5.2e}"}
                     if K > 2:
-                        postfix_dict |= {f"Dice-{k}": f"{log_dice[e, :j, k].mean():05.3f}"
+                        postfix_dict |= {f"Dice-{k}": f"{dice_means[k]:05.3f}"
                                          for k in range(1, K)}
                     tq_iter.set_postfix(postfix_dict)
 
+            if worker:  # The whole epoch of logs is needed from here on
+                worker.wait()
+
+            if args.compile and e == start_epoch:  # The graphs (one per mode) are compiled on the first step
+                print(f"{desc}: first step {first_step:.1f}s (with the compilation), "
+                      f"then {1000 * steps_time / max(len(loader) - 1, 1):.0f}ms/step")
+
         
         if args.scheduler != "None":
             scheduler.step()
 
         # I save it at each epochs, in case the code crashes or I decide to stop it early
-        np.save(args.dest / "loss_tra.npy", log_loss_tra)
-        np.save(args.dest / "dice_tra.npy", log_dice_tra)
-        np.save(args.dest / "loss_val.npy", log_loss_val)
-        np.save(args.dest / "dice_val.npy", log_dice_val)
-
-        np.save(args.dest / "iou_tra.npy", log_iou_tra)
-        np.save(args.dest / "hausdorff_tra.npy", log_hausdorff_tra)
-        np.save(args.dest / "assd_tra.npy", log_assd_tra)
-        np.save(args.dest / "volsim_tra.npy", log_volsim_tra)
-        np.save(args.dest / "iou_val.npy", log_iou_val)
-        np.save(args.dest / "hausdorff_val.npy", log_hausdorff_val)
-        np.save(args.dest / "assd_val.npy", log_assd_val)
-        np.save(args.dest / "volsim_val.npy", log_volsim_val)
-
-        current_dice: float = log_dice_val[e, :, 1:].mean().item()
+        # Only this epoch's chunk is written, the previous ones are already on disk
+        for log in all_logs:
+            log.flush()
+
+        current_dice: float = log_dice_val.mean()[1:].mean().item()
         if current_dice > best_dice:
             print(f">>> Improved dice at epoch {e}: {best_dice:05.3f}->{current_dice:05.3f} DSC")
             best_dice = current_dice
@@ -415,6 +534,12 @@ def runTraining(args):
             torch.save(net, args.dest / "bestmodel.pkl")
             torch.save(net.state_dict(), args.dest / "bestweights.pt")
 
+        if (e + 1) % args.checkpoint_every == 0 or e == args.epochs - 1:
+            save_checkpoint(args.dest / "checkpoint.pt", e, best_dice, net, optimizer, scheduler, scaler=scaler)
+
+    if worker:
+        worker.close()
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -422,24 +547,64 @@ def main():
     parser.add_argument('--epochs', default=25, type=int)
     parser.add_argument('--dataset', default='TOY2', choices=datasets_params.keys())
     parser.add_argument('--mode', default='full', choices=['partial', 'full'])
-    parser.add_argument('--dest', type=Path, required=True,
+    parser.add_argument('--dest', type=Path,
                         help="Destination directory to save the results (predictions and weights).")
+    parser.add_argument('--resume', type=Path,
+                        help="Resume the run saved in this directory (a previous timestamped --dest folder) "
+                             "from its last checkpoint.")
+    parser.add_argument('--checkpoint_every', type=int, default=1,
+                        help="Save a full checkpoint (model, optimizer, scheduler, RNG states) every N epochs.")
 
     parser.add_argument('--num_workers', type=int, default=5)
+    parser.add_argument('--validation', default='full', choices=['off', 'sampled', 'full'],
+                        help="How often the invariant checks (simplex, one-hot, ...) run on the training hot path.")
+    parser.add_argument('--validation_every', type=int, default=100,
+                        help="With --validation sampled, run the checks on one training step out of this many.")
     parser.add_argument('--gpu', action='store_true')
     parser.add_argument('--debug', action='store_true',
                         help="Keep only a fraction (10 samples) of the datasets, "
                              "to test the logic around epochs and logging easily.")
     parser.add_argument('--deeplabv3', action='store_true', help="Use DeepLabV3 instead of the default model")
     parser.add_argument('--pretrained', action='store_true', help="Use a pretrained deeplabv3 model")
+    parser.add_argument('--feature_cache', action='store_true',
+                        help="With --deeplabv3 --pretrained, compute the features of the frozen backbone once per "
+                             "slice (fp16, memory-mapped, under <split>/features/) and only train the head on them")
+    parser.add_argument('--feature_cache_lru', type=int, default=1024,
+                        help="Number of slices of cached features kept in memory, per data loader worker")
     parser.add_argument('--lr', type=float, default=0.0005)
     parser.add_argument('--optimizer', default='adam', choices=['adam', 'sgd', 'adamw'])
     parser.add_argument('--remove_background', action='store_true', default=False,
                         help="If set, remove slices that contain only background.")
     parser.add_argument('--transformation', default='none', choices=['none', 'preprocessed', 'augmented', 'preprocess_augment'])
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help="Autocast the forward passes to bf16 (CPU or GPU) or fp16 (GPU only, with gradient "
+                             "scaling). The losses are computed in fp32.")
+    parser.add_argument('--channels_last', action='store_true', default=False,
+                        help="Run the network on channels-last (NHWC) tensors")
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help="torch.compile the network (static shapes: implies --last_batch drop by default)")
+    parser.add_argument('--last_batch', choices=['keep', 'drop', 'pad'],
+                        help="What to do with the short last batch: keep it (default without --compile), drop it "
+                             "(training only, the validation then pads; default with --compile) or pad it (repeating "
+                             "its last slice; the padding is left out of the losses and metrics, but in training the "
+                             "repeated slices still enter the BatchNorm batch statistics and running averages).")
+    parser.add_argument('--online_augment', action='store_true', default=False,
+                        help="Augment every training batch on the fly (see augment.py), instead of the augmented "
+                             "copies on disk of --transformation augmented")
+    parser.add_argument('--packed', action='store_true', default=False,
+                        help="Read the slices from the packed store written by slice_segthor.py --packed, "
+                             "instead of decoding the PNG files.")
 
     parser.add_argument('--class_aware_sampling', action='store_true', default=False,
                         help="If set, samples batches so that every batch has a balanced representation of all classes.")
+    parser.add_argument('--async_metrics', action='store_true', default=False,
+                        help="Compute the metrics in background threads, so that the optimizer step does not wait "
+                             "on them.")
+    parser.add_argument('--metrics_workers', type=int, default=2,
+                        help="Number of background threads used by --async_metrics.")
+    parser.add_argument('--train_surface_every', type=int, default=1,
+                        help="Compute the Hausdorff and ASSD metrics on every Nth training batch only "
+                             "(0: on the validation only). Skipped values are logged as NaN.")
     parser.add_argument('--plot_results', action='store_true', default=False)
     parser.add_argument('--dont_save_predictions', action='store_true', default=False)
     parser.add_argument('--focal_loss_gamma', type=float, default=2.0)
@@ -448,21 +613,31 @@ def main():
     parser.add_argument("--loss", type=str, choices=["ce", "jaccard", "dice", "lovasz", "custom", "focal"],default='ce',
                         help="Loss function to be used.")
     
-    parser.add_argument('--architecture', default='normal', choices=['normal', 'more', 'less'])
+    parser.add_argument('--architecture', default='normal', choices=list(ENET_PRESETS),
+                        help="Depth of the ENet, see ENET_PRESETS in ENet.py")
     parser.add_argument('--scheduler', default='None', choices=['None', 'exp', 'steps'])
     parser.add_argument('--kernelsize', default=3, type=int)
     parser.add_argument('--channels', default=16, type=int)
 
     args = parser.parse_args()
 
-    args.dest = Path(args.dest) / datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    if args.resume:
+        args.dest = args.resume
+    elif args.dest:
+        args.dest = Path(args.dest) / datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    else:
+        parser.error("one of --dest or --resume is required")
+
+    if args.last_batch is None:
+        # Padding the training batches would skew the BatchNorm statistics; in eval mode, it changes nothing
+        args.last_batch = 'drop' if args.compile else 'keep'
 
     pprint(args)
 
     runTraining(args)
     
     if args.plot_results:
-        plot_args = argparse.Namespace(metric_file=args.dest / "dice_val.npy", dest=args.dest / "dice_val.png", headless=True)
+        plot_args = argparse.Namespace(metric_file=args.dest / "dice_val", dest=args.dest / "dice_val.png", headless=True)
         plot(plot_args)
 
 
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# MIT License
+
+# Copyright (c) 2024 Hoel Kervadec
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from utils import (class2one_hot,
+                   dice_coef,
+                   iou_coef,
+                   surface_coef,
+                   vol_sim_coef)
+
+
+METRICS: tuple[str, ...] = ("dice", "iou", "hausdorff", "assd", "volsim")
+
+
+def compute_metrics(pred_seg: Tensor, gt: Tensor, surface: bool = True) -> dict[str, Tensor]:
+    """
+    All the monitoring metrics of a batch, one value per sample and per class (B, K).
+    When `surface` is False, the (CPU-bound) surface distances are skipped and set to NaN.
+    """
+    metrics: dict[str, Tensor] = {"dice": dice_coef(pred_seg, gt),  # One DSC value per sample and per class
+                                  "iou": iou_coef(pred_seg, gt),
+                                  "volsim": vol_sim_coef(pred_seg, gt)}
+
+    if surface:
+        hausdorff, _, assd = surface_coef(pred_seg, gt)
+    else:
+        hausdorff = torch.full(metrics["dice"].shape, float("nan"))
+        assd = torch.full(metrics["dice"].shape, float("nan"))
+
+    return metrics | {"hausdorff": hausdorff, "assd": assd}
+
+
+class MetricLog:
+    """
+    Append-only log of one metric. Only the current epoch (N, *shape) is kept in memory, and every finished epoch
+    is written as its own chunk `<dest>/<name>/<epoch>.npy`, so neither the memory nor the I/O grow with the
+    number of epochs. Running sums (ignoring NaN, for the skipped values) back the progress bar.
+    """
+    def __init__(self, dest: Path, name: str, shape: tuple[int, ...]):
+        self.name: str = name
+        self.dir: Path = Path(dest) / name
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+        self.epoch: int = -1
+        self.values: Tensor = torch.full(shape, float("nan"))
+        self.sums: Tensor = torch.zeros(shape[1:])
+        self.counts: Tensor = torch.zeros(shape[1:])
+        self.lock = Lock()  # Filled concurrently by the MetricsWorker threads
+
+    def start_epoch(self, e: int) -> None:
+        with self.lock:
+            self.epoch = e
+            self.values.fill_(float("nan"))  # Not yet computed
+            self.sums.zero_()
+            self.counts.zero_()
+
+    def __setitem__(self, index, values) -> None:
+        values = torch.as_tensor(values, dtype=torch.float32).detach().cpu()
+        flat: Tensor = values.reshape(-1, *self.values.shape[1:])
+        finite: Tensor = ~flat.isnan()
+
+        with self.lock:
+            self.values[index] = values
+            self.sums += flat.nansum(dim=0)
+            self.counts += finite.sum(dim=0)
+
+    def mean(self) -> Tensor:
+        # Running mean over the samples seen so far in the epoch, one value per class
+        with self.lock:
+            return self.sums / self.counts
+
+    def truncate(self, epochs: int) -> None:
+        # Drop the chunks from epoch `epochs` onward, e.g. written by a run killed before its last checkpoint
+        for chunk in self.dir.glob("*.npy"):
+            if int(chunk.stem) >= epochs:
+                chunk.unlink()
+
+    def flush(self) -> Path:
+        dest: Path = self.dir / f"{self.epoch:04d}.npy"
+        with self.lock:
+            np.save(dest, self.values.numpy())
+
+        return dest
+
+
+class MetricsWorker:
+    """
+    Computes the metrics of the batches in a background thread pool, so that the optimizer step does not wait on
+    them. Batches are handed over as compact CPU class maps, and the results are written into the metric logs
+    (`logs[name][j:j + B]`) once done. Call `wait` before reading a whole epoch of logs.
+    """
+    def __init__(self, K: int, workers: int = 2):
+        self.K: int = K
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending: list[Future] = []
+
+    def submit(self, pred_class: Tensor, gt_class: Tensor, logs: dict[str, MetricLog], j: int,
+               surface: bool = True) -> None:
+        self.pending.append(self.pool.submit(self._run, pred_class, gt_class, logs, j, surface))
+
+    def _run(self, pred_class: Tensor, gt_class: Tensor, logs: dict[str, MetricLog], j: int,
+             surface: bool) -> None:
+        B, *_ = pred_class.shape
+
+        pred_seg: Tensor = class2one_hot(pred_class.long(), self.K)
+        gt: Tensor = class2one_hot(gt_class.long(), self.K)
+
+        for name, values in compute_metrics(pred_seg, gt, surface=surface).items():
+            logs[name][j:j + B] = values
+
+    def wait(self) -> None:
+        # result() re-raises in the main thread any exception raised by a worker, once
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self) -> None:
+        self.wait()
+        self.pool.shutdown()
@@ -24,19 +24,34 @@
 
 import argparse
 from pathlib import Path
+from typing import Iterator
 
 import numpy as np
 import matplotlib.pyplot as plt
 
 
+def load_epochs(metric_file: Path) -> Iterator[np.ndarray]:
+    """
+    Lazily yield the metric values, one epoch at a time. `metric_file` is either a directory of per-epoch chunks
+    (<epoch>.npy, as written by main.py), or a single (E, N[, K]) .npy file from older runs.
+    """
+    if metric_file.is_dir():
+        for chunk in sorted(metric_file.glob("*.npy")):
+            yield np.load(chunk, mmap_mode='r')
+    else:
+        yield from np.load(metric_file, mmap_mode='r')
+
+
 def run(args: argparse.Namespace) -> None:
-    metrics: np.ndarray = np.load(args.metric_file)
+    # Average over the samples one epoch at a time, so that the full log never has to fit in memory
+    # Skipped values (e.g. surface distances) are NaN
+    metrics: np.ndarray = np.stack([np.nanmean(epoch, axis=0) for epoch in load_epochs(args.metric_file)])
     match metrics.ndim:
-        case 2:
-            E, N = metrics.shape
+        case 1:
+            E, = metrics.shape
             K = 1
-        case 3:
-            E, N, K = metrics.shape
+        case 2:
+            E, K = metrics.shape
 
     fig = plt.figure()
     ax = fig.gca()
@@ -47,14 +62,14 @@ def run(args: argparse.Namespace) -> None:
     class_names = ["background", "esophagus", "heart", "trachea", "aorta"]
 
     for k in range(1, K):
-        y = metrics[:, :, k].mean(axis=1)
+        y = metrics[:, k]
         ax.plot(epcs, y, label=class_names[k], linewidth=1.5)
 
     if K > 2:
-        ax.plot(epcs, metrics.mean(axis=1).mean(axis=1), label="All classes", linewidth=3)
+        ax.plot(epcs, metrics.mean(axis=1), label="All classes", linewidth=3)
         ax.legend()
     else:
-        ax.plot(epcs, metrics.mean(axis=1), linewidth=3)
+        ax.plot(epcs, metrics, linewidth=3)
 
     fig.tight_layout()
     if args.dest:
@@ -66,8 +81,8 @@ def run(args: argparse.Namespace) -> None:
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Plot data over time')
-    parser.add_argument('--metric_file', type=Path, required=True, metavar="METRIC_MODE.npy",
-                        help="The metric file to plot.")
+    parser.add_argument('--metric_file', type=Path, required=True, metavar="METRIC_MODE",
+                        help="The metric to plot: a directory of per-epoch chunks, or a single .npy file.")
     parser.add_argument('--dest', type=Path, metavar="METRIC_MODE.png",
                         help="Optional: save the plot to a .png file")
     parser.add_argument("--headless", action="store_true",
@@ -1,37 +1,180 @@
+import os
 import numpy as np
 from scipy.ndimage import binary_dilation, binary_erosion
 from skimage.morphology import dilation, erosion, disk, ball, opening, closing
 import nibabel as nib
 import argparse
 import torch
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from scipy.ndimage import label
+from scipy.ndimage import label, find_objects, distance_transform_edt
 from scipy.ndimage import gaussian_filter
 
+# The chain of stitch.py and inference.py: dilation, largest connected component, then smoothing
+DEFAULT_STEPS = [("dilation", 1), ("largest", None), ("smooth", 2)]
+
+
+MORPHOLOGY = ["dilation", "erosion", "closing", "opening"]
+
+
+def step_margin(step, ndim, backend="skimage", spacing=None):
+    """
+    How far (in voxels, per axis) around the bounding box of a label the step looks, so that on a crop with this
+    margin it gives the same result as on the whole volume.
+    """
+    name, param = step
+    match name:
+        case _ if name in MORPHOLOGY:
+            if backend == "edt" and spacing is not None:  # The radius is in the units of the spacing (mm)
+                return tuple(int(np.ceil(param / d)) + 1 for d in spacing)
+            return (int(np.ceil(param)) + 1,) * ndim
+        case "smooth":
+            return (int(4 * param + 0.5),) * ndim  # Radius of the scipy gaussian kernel (truncate=4)
+        case "largest":
+            return (0,) * ndim
+        case _:
+            raise ValueError(f"Unknown postprocessing step {name}")
+
+
+def crop_slices(bbox, margins, shape):
+    return tuple(slice(max(0, s.start - m), min(n, s.stop + m)) for s, m, n in zip(bbox, margins, shape))
+
+
+def edt_dilation(mask, radius, spacing=None):
+    # Within radius of the mask. With a unit spacing, this is exactly the dilation by ball(radius)
+    if not mask.any():  # Without any zero in ~mask, the transform would be the distance to the array border
+        return mask.copy()
+    return distance_transform_edt(~mask, sampling=spacing) <= radius
+
+
+def edt_erosion(mask, radius, spacing=None):
+    # Further than radius from the background
+    if mask.all():  # No background to be far from: as the structuring element, nothing is eroded
+        return mask.copy()
+    return distance_transform_edt(mask, sampling=spacing) > radius
+
+
+def morphology(mask, operation, radius, backend="skimage", spacing=None):
+    """
+    Binary morphology with a ball of the given radius. The "skimage" backend uses the ball (disk in 2D)
+    structuring element in voxels, so its cost grows with the volume of the ball. The "edt" backend thresholds
+    a Euclidean distance transform instead, whose cost does not depend on the radius, and takes the voxel
+    spacing into account (the radius being then in mm).
+    """
+    match backend:
+        case "skimage":
+            struct_elem = ball(radius) if mask.ndim == 3 else disk(radius)
+            dilate = lambda m: dilation(m, struct_elem)  # noqa: E731
+            erode = lambda m: erosion(m, struct_elem)  # noqa: E731
+        case "edt":
+            dilate = lambda m: edt_dilation(m, radius, spacing)  # noqa: E731
+            erode = lambda m: edt_erosion(m, radius, spacing)  # noqa: E731
+        case _:
+            raise ValueError(f"Unknown morphology backend {backend}")
+
+    match operation:
+        case "dilation":
+            return dilate(mask)
+        case "erosion":
+            return erode(mask)
+        case "closing":
+            return erode(dilate(mask))
+        case "opening":
+            return dilate(erode(mask))
+        case _:
+            raise ValueError(f"Operation should be one of {MORPHOLOGY}")
+
+
+def apply_step(mask, step, backend="skimage", spacing=None):
+    """
+    One step on the binary crop of one label. Returns the resulting mask, and its bounding box within the crop
+    (None when nothing is left).
+    """
+    name, param = step
+    match name:
+        case _ if name in MORPHOLOGY:
+            result = morphology(mask, name, param, backend=backend, spacing=spacing)
+        case "largest":
+            labeled_array, _ = label(mask)
+            largest = np.argmax(np.bincount(labeled_array.flat)[1:]) + 1
+            # The labeling already gives the bounding box of the component, no need for another pass
+            return labeled_array == largest, find_objects(labeled_array)[largest - 1]
+        case "smooth":
+            result = gaussian_filter(mask.astype(float), sigma=param) > 0.5
+        case _:
+            raise ValueError(f"Unknown postprocessing step {name}")
+
+    objects = find_objects(result.astype(np.uint8))
+    return result, objects[0] if objects else None
+
+
+def postprocess_label(volume, value, bbox, step, backend="skimage", spacing=None):
+    crop = crop_slices(bbox, step_margin(step, volume.ndim, backend, spacing), volume.shape)
+    mask = volume[crop] == value
+    if not mask.any():  # Entirely overwritten by higher labels at the previous step
+        return None
+
+    result, inner = apply_step(mask, step, backend=backend, spacing=spacing)
+    if inner is None:
+        return None
+
+    # Back to the coordinates of the volume, tight around what is left of the label
+    tight = tuple(slice(c.start + i.start, c.start + i.stop) for c, i in zip(crop, inner))
+    return tight, result[inner]
+
+
+def postprocess(volume, steps=DEFAULT_STEPS, backend="skimage", spacing=None, workers=None):
+    """
+    Apply a chain of postprocessing steps to a labeled segmentation volume, each step being applied label by
+    label as keep_largest_components, smooth_labels and morphological_postprocessing do (the labels are
+    written back in increasing order, so the higher label wins where two overlap).
+
+    Steps are (name, parameter) pairs:
+    - ("dilation", radius), ("erosion", radius), ("closing", radius) and ("opening", radius), with the given
+      morphology backend (see `morphology`). With the "edt" backend and a voxel spacing, the radius is in mm;
+    - ("largest", None), to keep the largest connected component;
+    - ("smooth", sigma), a gaussian smoothing of the mask, thresholded at 0.5.
+
+    Instead of a full-volume mask per label and per step, every label is only processed within its bounding
+    box, plus the margin the step needs. The boxes are found once, in a single pass over the volume, and then
+    carried over from step to step (the result of a step gives the box of the next one). The labels of a step
+    are processed in parallel threads.
+    """
+    if spacing is not None:
+        spacing = tuple(float(d) for d in spacing[:volume.ndim])
+
+    int_volume = volume if np.issubdtype(volume.dtype, np.integer) else volume.astype(np.int64)
+    bboxes = {value: bbox for value, bbox in enumerate(find_objects(np.maximum(int_volume, 0)), start=1)
+              if bbox is not None}
+    workers = workers or min(len(bboxes), os.cpu_count() or 1) or 1
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for step in steps:
+            values = sorted(bboxes)
+            # Everything the labels need is bound now, as volume and bboxes are replaced at the end of the step
+            process = partial(postprocess_label, volume, step=step, backend=backend, spacing=spacing)
+            results = pool.map(process, values, [bboxes[value] for value in values])
+
+            refined_volume = np.zeros_like(volume)
+            next_bboxes = {}
+            for value, result in zip(values, results):
+                if result is None:  # Nothing left of this label
+                    continue
+                bbox, mask = result
+                refined_volume[bbox][mask] = value
+                next_bboxes[value] = bbox  # Superset of the label once composed, as higher labels may overwrite it
+            volume, bboxes = refined_volume, next_bboxes
+
+    return volume
+
 
 def keep_largest_components(volume):
-    refined_volume = np.zeros_like(volume)
-    for label_value in np.unique(volume):
-        if label_value == 0:
-            continue  # Skip background
-        # Binary mask for the current label
-        mask = (volume == label_value)
-        labeled_array, num_features = label(mask)
-        # Find the largest connected component
-        largest_component = (labeled_array == np.argmax(np.bincount(labeled_array.flat)[1:]) + 1)
-        refined_volume[largest_component] = label_value
-    return refined_volume
+    return postprocess(volume, [("largest", None)])
 
 
 def smooth_labels(volume, sigma=1):
-    smoothed_volume = np.zeros_like(volume)
-    for label_value in np.unique(volume):
-        if label_value == 0:
-            continue  # Skip background
-        mask = (volume == label_value).astype(float)
-        smoothed_mask = gaussian_filter(mask, sigma=sigma) > 0.5
-        smoothed_volume[smoothed_mask] = label_value
-    return smoothed_volume
+    return postprocess(volume, [("smooth", sigma)])
 
 
 def load_nifti(file_path):
@@ -44,46 +187,24 @@ def save_nifti(data, affine, output_path):
     new_img = nib.Nifti1Image(data, affine)
     nib.save(new_img, output_path)
 
-def morphological_postprocessing(volume, operation="dilation", structure_size=2):
+def morphological_postprocessing(volume, operation="dilation", structure_size=2, backend="skimage", spacing=None):
     """
     Apply morphological operations to a labeled 3D segmentation volume.
 
     Parameters:
     - volume: 3D numpy array of segmented labels [H, W, D].
-    - operation: The type of morphological operation to apply ("dilation", "erosion").
+    - operation: The type of morphological operation to apply ("dilation", "erosion", "closing", "opening").
     - structure_size: Size of the structuring element (affects how much the operation influences boundaries).
+    - backend: "skimage" (structuring element) or "edt" (thresholded distance transform, see `morphology`).
+    - spacing: Voxel spacing, for the "edt" backend. The structure size is then in mm.
     
     Returns:
     - Refined 3D segmentation volume.
     """
-    refined_volume = np.zeros_like(volume)
+    if operation not in MORPHOLOGY:
+        raise ValueError(f"Operation should be one of {MORPHOLOGY}")
 
-    # Choose a structuring element suitable for 3D
-    struct_elem = ball(structure_size) if volume.ndim == 3 else disk(structure_size)
-    
-    for label in np.unique(volume):
-        if label == 0:  # Skip background label
-            continue
-
-        # Create a binary mask for the current label
-        binary_mask = (volume == label)
-        
-        # Apply the specified morphological operation
-        if operation == "dilation":
-            refined_mask = dilation(binary_mask, struct_elem)
-        elif operation == "erosion":
-            refined_mask = erosion(binary_mask, struct_elem)
-        elif operation == "closing":
-            refined_mask = erosion(binary_mask, struct_elem)
-        elif operation == "opening":
-            refined_mask = erosion(binary_mask, struct_elem)
-        else:
-            raise ValueError("Operation should be 'dilation' or 'erosion'")
-        
-        # Add the refined mask back to the refined volume
-        refined_volume[refined_mask] = label
-
-    return refined_volume
+    return postprocess(volume, [(operation, structure_size)], backend=backend, spacing=spacing)
 
 # def main(args):
 #     # Load the trained model checkpoint
@@ -125,6 +246,17 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--annotation', type=str, default="data/segthor_train/train/Patient_13/GT_corrected.nii.gz", help="help")
     parser.add_argument('--output', type=str, default="crf/Patient_13_morpho.nii.gz", help="help")
     parser.add_argument('--checkpoint', type=str, default="results/segthor/preprocessed/bestmodel.pkl", help="help")
+    parser.add_argument('--backend', type=str, default="edt", choices=["skimage", "edt"],
+                        help="Morphology backend: structuring element, or thresholded distance transform (same result in voxels, cost independent of the radius)")
+    parser.add_argument('--radius', type=float, default=5, help="Radius of the dilation")
+    parser.add_argument('--physical_radius', action='store_true',
+                        help="With the edt backend, the radius is in mm, using the voxel spacing of the NIfTI header")
+    parser.add_argument('--shape', type=int, nargs=2, default=[256, 256],
+                        help="The slice shape the network was trained on")
+    parser.add_argument('--batch_size', type=int, default=64, help="Number of slices per forward pass")
+    parser.add_argument('--resize_logits', action='store_true',
+                        help="Resize the logits (bilinear) to the original shape before the argmax, instead of the "
+                             "predicted labels (nearest)")
 
     args = parser.parse_args()
 
@@ -133,40 +265,28 @@ def get_args() -> argparse.Namespace:
     return args
 
 def main(args):
-    # Load image and annotation from NIfTI files
-    img, affine = load_nifti(args.image)  # img is [H, W, D]
-    anno, _ = load_nifti(args.annotation)
-
-    # Initialize list to store predictions for each slice
-    predictions = []
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = torch.load(args.checkpoint)
-    model.eval().to(device)
+    from inference import optimize_for_inference, segment_volume  # Not at the top: inference.py imports this module
 
-    # Process each slice individually
-    for i in range(img.shape[2]):
-        img_slice = img[:, :, i]
-        img_tensor = torch.from_numpy(img_slice).unsqueeze(0).unsqueeze(0).float().to(device)  # Shape [1, 1, H, W]
+    # Load the image from its NIfTI file
+    orig_nib = nib.load(args.image)
+    ct = np.asarray(orig_nib.dataobj)  # [H, W, D]
 
-        with torch.no_grad():
-            output = model(img_tensor)
-            pred_slice = torch.argmax(output, dim=1).squeeze().cpu().numpy()  # Shape [H, W]
-            predictions.append(pred_slice)
-
-    # Stack predictions to form 3D volume
-    output_volume = np.stack(predictions, axis=-1)  # Shape [H, W, D]
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = torch.load(args.checkpoint, map_location=device, weights_only=False)
+    model = optimize_for_inference(model.eval().to(device), torch.rand((2, 1, *args.shape), device=device))
 
-    # Calculate n_labels using both output_volume and anno
-    unique_labels = np.unique(np.concatenate((output_volume, anno)))
-    n_labels = len(unique_labels)
+    # Normalized and resized once as the training slices, then args.batch_size slices per forward pass
+    output_volume = segment_volume(model, ct, tuple(args.shape), args.batch_size, device,
+                                   resize_logits=args.resize_logits)  # Shape [H, W, D]
 
     # Apply morphological post-processing or DenseCRF on the entire 3D volume
-    refined_volume = morphological_postprocessing(output_volume, operation="dilation", structure_size=5)
-    refined_volume = keep_largest_components(refined_volume)
-    refined_volume = smooth_labels(refined_volume, sigma=2)
+    spacing = orig_nib.header.get_zooms()[:3] if args.physical_radius else None
+    radius = args.radius if args.backend == "edt" else int(args.radius)  # Structuring elements are in whole voxels
+    refined_volume = postprocess(output_volume, steps=[("dilation", radius), ("largest", None), ("smooth", 2)],
+                                 backend=args.backend, spacing=spacing)
     
     # Save the refined volume
-    save_nifti(refined_volume, affine, args.output)
+    save_nifti(refined_volume, orig_nib.affine, args.output)
 
 if __name__ == "__main__":
     main(get_args())
\ No newline at end of file
@@ -10,7 +10,9 @@ import random
 import argparse
 from skimage.exposure import adjust_gamma
 from skimage.exposure import rescale_intensity
-from tqdm import tqdm
+from functools import partial
+
+from parallel import pmap
 
 def add_gaussian_noise(image, mean=0, std=0.05):
     """
@@ -66,9 +68,34 @@ def augment_blur_brightness(image):
 
     return image
 
-def augment_and_save(image_dir, gt_dir, aug_image_dir, aug_gt_dir, num_augmentations=3):
+def augment_pair(paths, aug_image_dir, aug_gt_dir, num_augmentations=3):
+    """
+    Augment one image with num_augmentations noise+contrast and blur+brightness transformations, and save them.
+    """
+    img_path, gt_path = paths
+    img = np.array(imread(img_path))
+    gt = np.array(imread(gt_path))  # Ground truth doesn't need intensity transformations
+
+    # Apply 3 noise + contrast augmentations
+    for i in range(num_augmentations):
+        aug_img = augment_noise_contrast(img)
+        img_filename = img_path.stem + f"_noise_contrast_aug{i:03d}.png"
+        gt_filename = gt_path.stem + f"_noise_contrast_aug{i:03d}.png"
+        imsave(str(aug_image_dir / img_filename), aug_img)
+        imsave(str(aug_gt_dir / gt_filename), gt)
+
+    # Apply 3 blur + brightness augmentations
+    for i in range(num_augmentations):
+        aug_img = augment_blur_brightness(img)
+        img_filename = img_path.stem + f"_blur_brightness_aug{i:03d}.png"
+        gt_filename = gt_path.stem + f"_blur_brightness_aug{i:03d}.png"
+        imsave(str(aug_image_dir / img_filename), aug_img)
+        imsave(str(aug_gt_dir / gt_filename), gt)
+
+def augment_and_save(image_dir, gt_dir, aug_image_dir, aug_gt_dir, num_augmentations=3, process=1, seed=0):
     """
     Augment the dataset with 3 noise+contrast and 3 blur+brightness transformations and save.
+    The slices are spread over `process` workers (-1: all the cores), each slice being seeded with seed + its index.
     """
     # Ensure the output directories exist
     aug_image_dir.mkdir(parents=True, exist_ok=True)
@@ -77,25 +104,9 @@ def augment_and_save(image_dir, gt_dir, aug_image_dir, aug_gt_dir, num_augmentat
     image_paths = sorted(list(image_dir.glob("*.png")))
     gt_paths = sorted(list(gt_dir.glob("*.png")))
 
-    for img_path, gt_path in tqdm(zip(image_paths, gt_paths), total=len(image_paths), desc="Augmenting Intensity"):
-        img = np.array(imread(img_path))
-        gt = np.array(imread(gt_path))  # Ground truth doesn't need intensity transformations
-
-        # Apply 3 noise + contrast augmentations
-        for i in range(num_augmentations):
-            aug_img = augment_noise_contrast(img)
-            img_filename = img_path.stem + f"_noise_contrast_aug{i:03d}.png"
-            gt_filename = gt_path.stem + f"_noise_contrast_aug{i:03d}.png"
-            imsave(str(aug_image_dir / img_filename), aug_img)
-            imsave(str(aug_gt_dir / gt_filename), gt)
-
-        # Apply 3 blur + brightness augmentations
-        for i in range(num_augmentations):
-            aug_img = augment_blur_brightness(img)
-            img_filename = img_path.stem + f"_blur_brightness_aug{i:03d}.png"
-            gt_filename = gt_path.stem + f"_blur_brightness_aug{i:03d}.png"
-            imsave(str(aug_image_dir / img_filename), aug_img)
-            imsave(str(aug_gt_dir / gt_filename), gt)
+    pfun = partial(augment_pair, aug_image_dir=aug_image_dir, aug_gt_dir=aug_gt_dir,
+                   num_augmentations=num_augmentations)
+    pmap(pfun, list(zip(image_paths, gt_paths)), process=process, seed=seed, desc="Augmenting Intensity")
 
 
 def main():
@@ -103,6 +114,8 @@ def main():
     parser.add_argument('--data_dir', type=str, required=True, help='Base directory containing the SEGTHOR dataset')
     parser.add_argument('--num_augmentations', type=int, default=3, help='Number of augmentations per image')
     parser.add_argument('--run_on_preprocessed', action='store_true', help='Run the augmentations on the preprocessed data.')
+    parser.add_argument('--process', '-p', type=int, default=1, help='The number of cores to use for processing (-1: all)')
+    parser.add_argument('--seed', type=int, default=0, help='Base seed of the augmentations (seed + index of the slice)')
 
     args = parser.parse_args()
 
@@ -125,7 +138,7 @@ def main():
 
     # Augment and save the training set
     print("Augmenting training set...")
-    augment_and_save(train_img_dir, train_gt_dir, aug_train_img_dir, aug_train_gt_dir, args.num_augmentations)
+    augment_and_save(train_img_dir, train_gt_dir, aug_train_img_dir, aug_train_gt_dir, args.num_augmentations, process=args.process, seed=args.seed)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
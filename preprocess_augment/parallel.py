@@ -0,0 +1,41 @@
+import random
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from tqdm import tqdm
+
+
+def seeded_call(fn, seed, indexed_item):
+    """
+    Call fn on one item, after seeding `random` and `np.random` with seed + index of the item. The random draws
+    of an item then only depend on its position, not on the worker nor on the chunk it ends up in.
+    """
+    i, item = indexed_item
+    if seed is not None:
+        random.seed(seed + i)
+        np.random.seed((seed + i) % 2**32)
+    return fn(item)
+
+
+def pmap(fn, items, process=1, seed=0, chunksize=None, desc=None):
+    """
+    Apply fn to all the items, in a pool of `process` workers (-1: all the cores; 1: in this process), and
+    return the results in the order of the items. fn must be picklable (a top-level function or a partial).
+
+    The items are sent to the workers in chunks, to amortize the inter-process communication over many slices.
+    """
+    items = list(items)
+    workers = cpu_count() if process == -1 else process
+    if chunksize is None:
+        chunksize = max(1, len(items) // (4 * workers))  # A few chunks per worker, for load balancing
+
+    call = partial(seeded_call, fn, seed)
+    indexed = list(enumerate(items))
+
+    match process:
+        case 1:
+            return [call(item) for item in tqdm(indexed, desc=desc)]
+        case _:
+            with Pool(workers) as pool:
+                return list(tqdm(pool.imap(call, indexed, chunksize=chunksize), total=len(items), desc=desc))
@@ -4,13 +4,18 @@ from skimage.transform import resize
 import numpy as np
 from pathlib import Path
 import argparse
-from tqdm import tqdm
 from scipy.ndimage import gaussian_filter
 import os
+import sys
+from functools import partial
 from PIL import Image
 from skimage import measure
 from skimage.morphology import remove_small_objects
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # Run as a script, from the repository root
+from build_cache import BuildCache
+from parallel import pmap
+
 VALID_LABELS = {0, 1, 2, 3, 4} # background esophagus heart trachea aorta
 
 def resize_image_and_label(image, label, target_size=(256, 256)):
@@ -147,10 +152,32 @@ def preprocess_image_and_label(image, label, padding=10, target_size=256, body_t
     return image_clahe, label_cropped
 
 
+def preprocess_pair(paths, output_img_dir, output_label_dir, padding=10, target_size=256, body_threshold=7, min_size=500, crop=False):
+    """
+    Pre-process and save one image and its label. Returns the paths of the two saved files.
+    """
+    img_path, label_path = paths
+    img = np.array(imread(img_path))
+    label = np.array(imread(label_path))
+
+    # Apply the full pre-processing pipeline
+    img_preprocessed, label_preprocessed = preprocess_image_and_label(img, label, padding=padding, target_size=target_size, body_threshold=body_threshold, min_size=min_size, crop=crop)
+
+    # Save the pre-processed image and label
+    img_filename = output_img_dir / img_path.name
+    label_filename = output_label_dir / label_path.name
+
+    imsave(str(img_filename), (img_preprocessed * 255).astype(np.uint8))  # Rescale intensity back to [0, 255] for saving
+    imsave(str(label_filename), label_preprocessed)
+
+    return img_filename, label_filename
+
+
 # Pre-process and save the dataset
-def preprocess_and_save(image_dir, label_dir, output_img_dir, output_label_dir, padding=10, target_size=256, body_threshold=7, min_size=500, crop=False):
+def preprocess_and_save(image_dir, label_dir, output_img_dir, output_label_dir, padding=10, target_size=256, body_threshold=7, min_size=500, crop=False, process=1):
     """
     Pre-process all images and segmentation labels (ground truths), and save them to the specified output directories.
+    The slices are spread over `process` workers (-1: all the cores).
     """
     output_img_dir.mkdir(parents=True, exist_ok=True)
     output_label_dir.mkdir(parents=True, exist_ok=True)
@@ -158,19 +185,29 @@ def preprocess_and_save(image_dir, label_dir, output_img_dir, output_label_dir,
     image_paths = sorted(list(image_dir.glob("*.png")))
     label_paths = sorted(list(label_dir.glob("*.png")))
 
-    for img_path, label_path in tqdm(zip(image_paths, label_paths), total=len(image_paths), desc="Pre-processing dataset"):
-        img = np.array(imread(img_path))
-        label = np.array(imread(label_path))
+    # Only the slices whose source PNGs or parameters changed since the last run are processed again
+    cache = BuildCache(output_img_dir.parent, name="preprocessing_manifest.json")
+    params = dict(padding=padding, target_size=target_size, body_threshold=body_threshold, min_size=min_size, crop=crop)
+
+    todo = []
+    keys = []
+    for img_path, label_path in zip(image_paths, label_paths):
+        key = cache.key([img_path, label_path], params)
+        if cache.get(img_path.name, key) is None:
+            todo.append((img_path, label_path))
+            keys.append(key)
+    for name in set(cache.entries) - {p.name for p in image_paths}:  # Slices removed from the source folders
+        cache.discard(name)
+    print(f"Pre-processing {len(todo)} slices, reusing {len(image_paths) - len(todo)} up-to-date ones")
 
-        # Apply the full pre-processing pipeline
-        img_preprocessed, label_preprocessed = preprocess_image_and_label(img, label, padding=padding, target_size=target_size, body_threshold=body_threshold, min_size=min_size, crop=crop)
+    pfun = partial(preprocess_pair, output_img_dir=output_img_dir, output_label_dir=output_label_dir, **params)
+    outputs = pmap(pfun, todo, process=process, desc="Pre-processing dataset")
 
-        # Save the pre-processed image and label
-        img_filename = output_img_dir / img_path.name
-        label_filename = output_label_dir / label_path.name
+    # The outputs come back in order, and only the parent process writes the manifest
+    for (img_path, _), key, saved in zip(todo, keys, outputs):
+        cache.put(img_path.name, key, saved)
 
-        imsave(str(img_filename), (img_preprocessed * 255).astype(np.uint8))  # Rescale intensity back to [0, 255] for saving
-        imsave(str(label_filename), label_preprocessed)
+    cache.save()
 
 
 def main():
@@ -181,6 +218,7 @@ def main():
     parser.add_argument('--body_threshold', type=int, default=7, help='Padding around the body cavity during cropping')
     parser.add_argument('--min_size', type=int, default=500, help='Padding around the body cavity during cropping')
     parser.add_argument('--crop', action='store_true', help='Use crop and resize, otherwise just resize')
+    parser.add_argument('--process', '-p', type=int, default=1, help='The number of cores to use for processing (-1: all)')
 
     args = parser.parse_args()
 
@@ -195,7 +233,7 @@ def main():
 
     # Pre-process and save the training set
     print("Pre-processing training set...")
-    preprocess_and_save(train_img_dir, train_gt_dir, preprocessed_train_img_dir, preprocessed_train_gt_dir, padding=args.padding, target_size=args.target_size, body_threshold=args.body_threshold, min_size=args.min_size, crop=args.crop)
+    preprocess_and_save(train_img_dir, train_gt_dir, preprocessed_train_img_dir, preprocessed_train_gt_dir, padding=args.padding, target_size=args.target_size, body_threshold=args.body_threshold, min_size=args.min_size, crop=args.crop, process=args.process)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
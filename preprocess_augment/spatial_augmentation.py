@@ -5,28 +5,78 @@ from scipy.ndimage import gaussian_filter, shift
 from skimage.io import imsave, imread
 from scipy.ndimage.interpolation import map_coordinates
 from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage import zoom
+from functools import lru_cache, partial
 from pathlib import Path
 import random
 import argparse
-from tqdm import tqdm
 
-# Function for elastic deformation
-def elastic_transform(image, alpha, sigma, random_state=None):
-    """Elastic deformation of images as described in [Simard2003]_ (with modifications).
-    alpha: Control the intensity of the deformation
-    sigma: Standard deviation for the Gaussian filter
+from parallel import pmap
+
+@lru_cache(maxsize=8)
+def base_grid(shape):
+    """
+    The (2, *shape) identity coordinates, shared (read-only) by all the warps of the same shape.
+    """
+    grid = np.stack(np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')).astype(np.float32)
+    grid.flags.writeable = False
+    return grid
+
+def displacement_fields(n, shape, alpha, sigma, random_state, step=None):
+    """
+    n smooth random (2, *shape) displacement fields, as the ones of [Simard2003]_, but drawn and filtered at
+    1/step of the resolution, then upsampled. The field is smooth at the scale of sigma, so little is lost, and
+    filtering at the lower resolution is much cheaper. The filtered noise is step times stronger at the lower
+    resolution, hence alpha / step.
+    """
+    if step is None:
+        step = max(1, int(sigma // 2))
+    small = tuple(-(-d // step) for d in shape)  # Ceil
+
+    noise = random_state.rand(n, 2, *small) * 2 - 1
+    fields = gaussian_filter(noise, (0, 0, sigma / step, sigma / step), mode="constant", cval=0) * (alpha / step)
+    if step > 1:
+        fields = zoom(fields, (1, 1, shape[0] / small[0], shape[1] / small[1]), order=1)
+    assert fields.shape == (n, 2, *shape), (fields.shape, shape)
+
+    return fields.astype(np.float32)
+
+def elastic_transform_batch(images, labels, alpha, sigma, random_state=None, step=None):
+    """
+    Elastic deformation of a (N, H, W) stack of slices and of their labels, each slice with its own random field.
+    Image and label of a slice are warped by the same field, linear for the image and nearest for the label,
+    in one map_coordinates call per stack (the slice index being an exact, integer, coordinate).
     """
     if random_state is None:
         random_state = np.random.RandomState(None)
 
-    shape = image.shape
-    dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-    dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    n, *shape = images.shape
+    assert labels.shape == images.shape, (labels.shape, images.shape)
+
+    coords = base_grid(tuple(shape))[None] + displacement_fields(n, tuple(shape), alpha, sigma, random_state, step)
+    z = np.broadcast_to(np.arange(n, dtype=np.float32)[:, None, None], (n, *shape))
+    indices = np.stack([z, coords[:, 0], coords[:, 1]])
 
-    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
-    indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1))
+    warped_images = map_coordinates(images, indices, order=1, mode='reflect').astype(images.dtype)
+    warped_labels = map_coordinates(labels, indices, order=0, mode='reflect')
 
-    return map_coordinates(image, indices, order=1, mode='reflect').reshape(shape)
+    return warped_images, warped_labels
+
+def elastic_transform_pair(image, label, alpha, sigma, random_state=None, step=None):
+    """
+    Elastic deformation of one image and its label, with a single field.
+    """
+    warped_images, warped_labels = elastic_transform_batch(image[None], label[None], alpha, sigma, random_state, step)
+    return warped_images[0], warped_labels[0]
+
+# Function for elastic deformation
+def elastic_transform(image, alpha, sigma, random_state=None):
+    """Elastic deformation of images as described in [Simard2003]_ (with modifications).
+    alpha: Control the intensity of the deformation
+    sigma: Standard deviation for the Gaussian filter
+    """
+    warped, _ = elastic_transform_pair(image, np.zeros_like(image), alpha, sigma, random_state)
+    return warped
 
 def augment_image(img, gt, rotation_angle=5, scale_factor=1.05, translation=(5, 5), elastic=True):
     """
@@ -46,16 +96,58 @@ def augment_image(img, gt, rotation_angle=5, scale_factor=1.05, translation=(5,
 
     # Optional elastic deformation (simulating breathing or heart movements)
     if elastic:
-        img_elastic = elastic_transform(img_translated, alpha=20, sigma=4)
-        gt_elastic = elastic_transform(gt_translated, alpha=20, sigma=4)
+        # One field for both, nearest neighbour for the label
+        img_elastic, gt_elastic = elastic_transform_pair(img_translated, gt_translated, alpha=20, sigma=4)
     else:
         img_elastic, gt_elastic = img_translated, gt_translated
 
     return img_elastic, gt_elastic
 
-def augment_and_save(image_dir, gt_dir, aug_image_dir, aug_gt_dir, num_augmentations=5, elastic=True):
+def augment_pair(paths, aug_image_dir, aug_gt_dir, num_augmentations=5, elastic=True):
+    """
+    Augment one image and its ground truth num_augmentations times, and save them.
+    """
+    img_path, gt_path = paths
+    # Load the images and ground truth
+    img = np.array(imread(img_path))
+    gt = np.array(imread(gt_path))
+
+    augmented = []
+    for i in range(num_augmentations):
+        # Randomize augmentation parameters
+        rotation_angle = random.uniform(-5, 5)  # Small rotation in degrees
+        scale_factor = random.uniform(0.95, 1.05)  # Slight zoom in/out
+        translation = [random.uniform(-5, 5), random.uniform(-5, 5)]  # Small translations
+
+        # Rigid part only, the elastic deformation is done below for all the augmentations at once
+        augmented.append(augment_image(img, gt, rotation_angle, scale_factor, translation, elastic=False))
+
+    if elastic:
+        # Drawn from `random`, so that the fields are reproducible as the other parameters
+        random_state = np.random.RandomState(random.randrange(2**32))
+
+        # The scaling changes the shape, so one batch per shape
+        by_shape = {}
+        for i, (aug_img, _) in enumerate(augmented):
+            by_shape.setdefault(aug_img.shape, []).append(i)
+        for indices in by_shape.values():
+            warped_imgs, warped_gts = elastic_transform_batch(np.stack([augmented[i][0] for i in indices]),
+                                                              np.stack([augmented[i][1] for i in indices]),
+                                                              alpha=20, sigma=4, random_state=random_state)
+            for i, warped_img, warped_gt in zip(indices, warped_imgs, warped_gts):
+                augmented[i] = (warped_img, warped_gt)
+
+    for i, (aug_img, aug_gt) in enumerate(augmented):
+        # Save augmented images
+        img_filename = img_path.stem + f"_aug{i:03d}.png"
+        gt_filename = gt_path.stem + f"_aug{i:03d}.png"
+        imsave(str(aug_image_dir / img_filename), aug_img)
+        imsave(str(aug_gt_dir / gt_filename), aug_gt)
+
+def augment_and_save(image_dir, gt_dir, aug_image_dir, aug_gt_dir, num_augmentations=5, elastic=True, process=1, seed=0):
     """
     Augment the dataset and save the augmented images in the same structure.
+    The slices are spread over `process` workers (-1: all the cores), each slice being seeded with seed + its index.
     """
     aug_image_dir.mkdir(parents=True, exist_ok=True)
     aug_gt_dir.mkdir(parents=True, exist_ok=True)
@@ -63,25 +155,9 @@ def augment_and_save(image_dir, gt_dir, aug_image_dir, aug_gt_dir, num_augmentat
     image_paths = sorted(list(image_dir.glob("*.png")))
     gt_paths = sorted(list(gt_dir.glob("*.png")))
 
-    for img_path, gt_path in tqdm(zip(image_paths, gt_paths), total=len(image_paths), desc="Augmenting data"):
-        # Load the images and ground truth
-        img = np.array(imread(img_path))
-        gt = np.array(imread(gt_path))
-
-        for i in range(num_augmentations):
-            # Randomize augmentation parameters
-            rotation_angle = random.uniform(-5, 5)  # Small rotation in degrees
-            scale_factor = random.uniform(0.95, 1.05)  # Slight zoom in/out
-            translation = [random.uniform(-5, 5), random.uniform(-5, 5)]  # Small translations
-
-            # Apply augmentations (with or without elastic deformation)
-            aug_img, aug_gt = augment_image(img, gt, rotation_angle, scale_factor, translation, elastic=elastic)
-
-            # Save augmented images
-            img_filename = img_path.stem + f"_aug{i:03d}.png"
-            gt_filename = gt_path.stem + f"_aug{i:03d}.png"
-            imsave(str(aug_image_dir / img_filename), aug_img)
-            imsave(str(aug_gt_dir / gt_filename), aug_gt)
+    pfun = partial(augment_pair, aug_image_dir=aug_image_dir, aug_gt_dir=aug_gt_dir,
+                   num_augmentations=num_augmentations, elastic=elastic)
+    pmap(pfun, list(zip(image_paths, gt_paths)), process=process, seed=seed, desc="Augmenting data")
 
 def main():
     parser = argparse.ArgumentParser(description='Augment dataset with realistic transformations.')
@@ -89,6 +165,8 @@ def main():
     parser.add_argument('--num_augmentations', type=int, default=5, help='Number of augmentations per image')
     parser.add_argument('--elastic', action='store_true', help='Apply elastic deformation')
     parser.add_argument('--run_on_preprocessed', action='store_true', help='Run the augmentations on the preprocessed data.')
+    parser.add_argument('--process', '-p', type=int, default=1, help='The number of cores to use for processing (-1: all)')
+    parser.add_argument('--seed', type=int, default=0, help='Base seed of the augmentations (seed + index of the slice)')
 
     args = parser.parse_args()
 
@@ -111,7 +189,7 @@ def main():
 
     # Augment and save the training set
     print("Augmenting training set...")
-    augment_and_save(train_img_dir, train_gt_dir, aug_train_img_dir, aug_train_gt_dir, args.num_augmentations, elastic=args.elastic)
+    augment_and_save(train_img_dir, train_gt_dir, aug_train_img_dir, aug_train_gt_dir, args.num_augmentations, elastic=args.elastic, process=args.process, seed=args.seed)
 
 
 if __name__ == "__main__":
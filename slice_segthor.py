@@ -24,12 +24,13 @@
 
 import pickle
 import random
+import shutil
 import argparse
 import warnings
 from pathlib import Path
 from functools import partial
 from multiprocessing import Pool
-from typing import Callable
+from typing import Callable, Iterable, Optional
 
 import numpy as np
 import nibabel as nib
@@ -37,6 +38,14 @@ from skimage.io import imsave
 from skimage.transform import resize
 
 from utils import map_, tqdm_
+from build_cache import BuildCache
+from dataset import PACKED_DIR, PackedWriter, build_slice_index, load_packed
+
+# Part of the build cache keys: bump it whenever the slicing itself changes, so that --incremental rebuilds
+SLICING_VERSION: int = 1
+
+# The folders slice_patient writes to, other steps (augmentation, preprocessing) add their own siblings
+SUBFOLDERS: list[str] = ["img", "gt"]
 
 
 def norm_arr(img: np.ndarray) -> np.ndarray:
@@ -80,8 +89,20 @@ def sanity_gt(gt, ct) -> bool:
 resize_: Callable = partial(resize, mode="constant", preserve_range=True, anti_aliasing=False)
 
 
-def slice_patient(id_: str, dest_path: Path, source_path: Path, shape: tuple[int, int],
-                  test_mode: bool = False) -> tuple[float, float, float]:
+def source_files(id_: str, source_path: Path, test_mode: bool = False) -> list[Path]:
+    if test_mode:
+        return [source_path / "test" / f"{id_}.nii.gz"]
+
+    id_path: Path = source_path / "train" / id_
+    return [id_path / f"{id_}.nii.gz", id_path / "GT_corrected.nii.gz"]
+
+
+def slice_volumes(id_: str, source_path: Path, shape: tuple[int, int],
+                  test_mode: bool = False, z_chunk: int = 32) -> tuple[np.ndarray, np.ndarray, tuple[float, float, float]]:
+    """
+    Load, normalize and resize one patient. Returns the (Z, *shape) uint8 image and label stacks, the labels being
+    class indices, and the voxel spacing.
+    """
     id_path: Path = source_path / ("train" if not test_mode else "test") / id_
 
     ct_path: Path = (id_path / f"{id_}.nii.gz") if not test_mode else (source_path / "test" / f"{id_}.nii.gz")
@@ -112,20 +133,38 @@ def slice_patient(id_: str, dest_path: Path, source_path: Path, shape: tuple[int
     to_slice_ct = norm_ct
     to_slice_gt = gt
 
-    for idz in range(z):
-        img_slice = resize_(to_slice_ct[:, :, idz], shape).astype(np.uint8)
-        gt_slice = resize_(to_slice_gt[:, :, idz], shape, order=0).astype(np.uint8)
-        assert img_slice.shape == gt_slice.shape
-        gt_slice *= 63
-        assert gt_slice.dtype == np.uint8, gt_slice.dtype
-        # assert set(np.unique(gt_slice)) <= set(range(5))
-        assert set(np.unique(gt_slice)) <= set([0, 63, 126, 189, 252]), np.unique(gt_slice)
+    # All the slices are resized at once, over the (x, y) axes only. As z is kept as is, this gives exactly the
+    # slice by slice resize. Chunks of z bound the size of the float64 intermediates of skimage.
+    img_slices: np.ndarray = np.zeros((z, *shape), dtype=np.uint8)
+    gt_slices: np.ndarray = np.zeros((z, *shape), dtype=np.uint8)
+    for start in range(0, z, z_chunk):
+        stop: int = min(start + z_chunk, z)
+
+        img_chunk = resize_(to_slice_ct[:, :, start:stop], (*shape, stop - start)).astype(np.uint8)
+        gt_chunk = resize_(to_slice_gt[:, :, start:stop], (*shape, stop - start), order=0).astype(np.uint8)
+
+        img_slices[start:stop] = np.moveaxis(img_chunk, -1, 0)
+        gt_slices[start:stop] = np.moveaxis(gt_chunk, -1, 0)
+
+    # Sanity checks, once for the whole volume
+    assert img_slices.shape == gt_slices.shape == (z, *shape)
+    assert set(np.unique(gt_slices)) <= set(range(5)), np.unique(gt_slices)
+
+    return img_slices, gt_slices, (dx, dy, dz)
+
+
+def slice_patient(id_: str, dest_path: Path, source_path: Path, shape: tuple[int, int],
+                  test_mode: bool = False) -> tuple[float, float, float]:
+    img_slices, gt_slices, spacing = slice_volumes(id_, source_path, shape, test_mode)
+
+    gt_slices = gt_slices * 63  # Already checked to be in range(5) by slice_volumes
+    assert gt_slices.dtype == np.uint8, gt_slices.dtype
 
+    for idz, (img_slice, gt_slice) in enumerate(zip(img_slices, gt_slices)):
         arrays: list[np.ndarray] = [img_slice, gt_slice]
 
-        subfolders: list[str] = ["img", "gt"]
-        assert len(arrays) == len(subfolders)
-        for save_subfolder, data in zip(subfolders,
+        assert len(arrays) == len(SUBFOLDERS)
+        for save_subfolder, data in zip(SUBFOLDERS,
                                         arrays):
             filename = f"{id_}_{idz:04d}.png"
 
@@ -136,7 +175,86 @@ def slice_patient(id_: str, dest_path: Path, source_path: Path, shape: tuple[int
                 warnings.filterwarnings("ignore", category=UserWarning)
                 imsave(str(save_path / filename), data)
 
-    return dx, dy, dz
+    return spacing
+
+
+def packed_patients(dest_path: Path) -> list[str]:
+    """
+    The patients of an existing packed store, in order. Empty when there is no store yet.
+    """
+    index_path: Path = dest_path / PACKED_DIR / "index.pkl"
+    if not index_path.exists():
+        return []
+
+    with open(index_path, 'rb') as f:
+        stems: list[str] = pickle.load(f)["stems"]
+
+    return list(dict.fromkeys(stem.rsplit('_', 1)[0] for stem in stems))
+
+
+def pack_split(split_ids: list[str], dest_path: Path, source_path: Path, shape: tuple[int, int],
+               test_mode: bool, process: int,
+               reuse: Optional[dict[str, tuple[float, float, float]]] = None) -> dict[str, tuple[float, float, float]]:
+    """
+    Slice all the patients of one split straight into a packed store (see dataset.PackedWriter). The volumes are
+    streamed back from the workers in order, so only a few patients are held in memory at once.
+
+    The patients in `reuse` (with their spacing) are not sliced again, but copied over from the existing store.
+    """
+    reuse = reuse or {}
+    todo: list[str] = [id_ for id_ in split_ids if id_ not in reuse]
+
+    old_ranges: dict[str, slice] = {}
+    if reuse:
+        old_imgs, old_gts, old_stems = load_packed(dest_path.parent, dest_path.name)
+        for i, stem in enumerate(old_stems):  # Slices of a patient are contiguous
+            id_ = stem.rsplit('_', 1)[0]
+            old_ranges[id_] = slice(old_ranges.get(id_, slice(i, i)).start, i + 1)
+        assert set(reuse) <= set(old_ranges)
+
+    pfun: Callable = partial(slice_volumes,
+                             source_path=source_path,
+                             shape=shape,
+                             test_mode=test_mode)
+
+    resolutions: dict[str, tuple[float, float, float]] = {}
+    # Written next to the existing store, which is still being read from
+    tmp_path: Path = dest_path / f"{PACKED_DIR}.tmp"
+    with PackedWriter(tmp_path, shape) as writer:
+        results: Iterable[tuple[np.ndarray, np.ndarray, tuple[float, float, float]]]
+        pool: Optional[Pool] = None
+        match process:
+            case 1:
+                results = map(pfun, todo)
+            case -1:
+                pool = Pool()
+                results = pool.imap(pfun, todo)
+            case _ as p:
+                pool = Pool(p)
+                results = pool.imap(pfun, todo)
+        results = iter(results)
+
+        for id_ in tqdm_(split_ids):
+            if id_ in reuse:
+                img_slices = np.asarray(old_imgs[old_ranges[id_]])
+                gt_slices = np.asarray(old_gts[old_ranges[id_]])
+                spacing = reuse[id_]
+            else:
+                img_slices, gt_slices, spacing = next(results)
+
+            writer.append([f"{id_}_{idz:04d}" for idz in range(len(img_slices))], img_slices, gt_slices)
+            resolutions[id_] = spacing
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if reuse:
+        del old_imgs, old_gts
+    shutil.rmtree(dest_path / PACKED_DIR, ignore_errors=True)
+    tmp_path.rename(dest_path / PACKED_DIR)
+
+    return resolutions
 
 
 def get_splits(src_path: Path, retains: int, fold: int) -> tuple[list[str], list[str], list[str]]:
@@ -164,9 +282,12 @@ def main(args: argparse.Namespace):
     src_path: Path = Path(args.source_dir)
     dest_path: Path = Path(args.dest_dir)
 
-    # Assume the clean up is done before calling the script
+    # Assume the clean up is done before calling the script, unless rebuilding incrementally
     assert src_path.exists()
-    assert not dest_path.exists()
+    assert args.incremental or not dest_path.exists()
+
+    cache: Optional[BuildCache] = BuildCache(dest_path) if args.incremental else None
+    built: set[str] = set()  # Cache entries of this build, the others are stale
 
     training_ids: list[str]
     validation_ids: list[str]
@@ -178,26 +299,69 @@ def main(args: argparse.Namespace):
     split_ids: list[str]
     for mode, split_ids in zip(["train", "val", "test"], [training_ids, validation_ids, test_ids]):
         dest_mode: Path = dest_path / mode
-        print(f"Slicing {len(split_ids)} pairs to {dest_mode}")
+        test_mode: bool = mode == 'test'
+
+        # The entries are named after the patient (and the store, when packed). A patient moving to another split
+        # changes its key, which discards its outputs in the previous split.
+        names: dict[str, str] = {id_: f"{PACKED_DIR}/{id_}" if args.packed else id_ for id_ in split_ids}
+        keys: dict[str, str] = {}
+        reuse: dict[str, tuple[float, float, float]] = {}
+        if cache is not None:
+            params = {"version": SLICING_VERSION, "shape": list(args.shape), "split": mode, "packed": args.packed}
+            for id_ in split_ids:
+                keys[id_] = cache.key(source_files(id_, src_path, test_mode), params)
+                if entry := cache.get(names[id_], keys[id_]):
+                    reuse[id_] = tuple(entry["spacing"])  # type: ignore
+                else:
+                    cache.discard(names[id_])
+            built |= set(names.values())
+
+            if args.packed:  # The slices of the reused patients are copied over from the existing store
+                stored: list[str] = packed_patients(dest_mode)
+                reuse = {id_: spacing for id_, spacing in reuse.items() if id_ in stored}
+        todo: list[str] = [id_ for id_ in split_ids if id_ not in reuse]
+        print(f"Slicing {len(todo)} pairs to {dest_mode}, reusing {len(reuse)} up-to-date ones")
 
-        pfun: Callable = partial(slice_patient,
-                                 dest_path=dest_mode,
-                                 source_path=src_path,
-                                 shape=tuple(args.shape),
-                                 test_mode=mode == 'test')
         resolutions: list[tuple[float, float, float]]
-        iterator = tqdm_(split_ids)
-        match args.process:
-            case 1:
-                resolutions = list(map(pfun, iterator))
-            case -1:
-                resolutions = Pool().map(pfun, iterator)
-            case _ as p:
-                resolutions = Pool(p).map(pfun, iterator)
-
-        for key, val in zip(split_ids, resolutions):
+        if args.packed:
+            if todo or packed_patients(dest_mode) != split_ids:
+                split_resolutions = pack_split(split_ids, dest_mode, src_path, tuple(args.shape),
+                                               test_mode=test_mode, process=args.process, reuse=reuse)
+            else:  # Nothing changed, the store is kept as is
+                split_resolutions = reuse
+            resolutions = [split_resolutions[id_] for id_ in todo]
+        else:
+            pfun: Callable = partial(slice_patient,
+                                     dest_path=dest_mode,
+                                     source_path=src_path,
+                                     shape=tuple(args.shape),
+                                     test_mode=test_mode)
+            iterator = tqdm_(todo)
+            match args.process:
+                case 1:
+                    resolutions = list(map(pfun, iterator))
+                case -1:
+                    resolutions = Pool().map(pfun, iterator)
+                case _ as p:
+                    resolutions = Pool(p).map(pfun, iterator)
+
+        if not args.packed:  # The packed stores write their own, see PackedWriter
+            build_slice_index(dest_mode / "gt")
+
+        resolution_dict |= reuse
+        for key, val in zip(todo, resolutions):
             resolution_dict[key] = val
 
+            if cache is not None:
+                outputs: list[Path] = [] if args.packed else sorted(path for sub in SUBFOLDERS
+                                                                    for path in (dest_mode / sub).glob(f"{key}_*.png"))
+                cache.put(names[key], keys[key], outputs, spacing=[float(d) for d in val])
+
+    if cache is not None:
+        for name in set(cache.entries) - built:  # Patients gone from the source folder
+            cache.discard(name)
+        cache.save()
+
     with open(dest_path / "spacing.pkl", 'wb') as f:
         pickle.dump(resolution_dict, f, pickle.HIGHEST_PROTOCOL)
         print(f"Saved spacing dictionnary to {f}")
@@ -214,6 +378,11 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--fold', type=int, default=0)
     parser.add_argument('--process', '-p', type=int, default=1,
                         help="The number of cores to use for processing")
+    parser.add_argument('--packed', action='store_true',
+                        help="Write each split as a packed, memory-mappable array store instead of PNG files")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Reuse an existing destination folder, and only slice again the patients whose "
+                             "volumes or slicing parameters changed since the last build (see build_cache.py)")
     args = parser.parse_args()
     random.seed(args.seed)
 
@@ -24,59 +24,60 @@
 
 import re
 import argparse
+from functools import partial
 from itertools import repeat
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Match, Pattern
+from typing import Callable, Match, Pattern
 
 import numpy as np
 import nibabel as nib
 from skimage.io import imread
-from skimage.transform import resize
+import torch
 from utils import map_, tqdm_
-from postprocessing import morphological_postprocessing, keep_largest_components, smooth_labels
+from postprocessing import DEFAULT_STEPS, postprocess
+from inference import resize_labels
 def get_z(image: Path) -> int:
     return int(image.stem.split('_')[-1])
 
 
 def merge_patient(id_: str, dest_folder: str, images: list[Path],
-                  idxes: list[int], K: int, source_pattern: str, post_processing: bool) -> None:
+                  K: int, source_pattern: str, post_processing: bool) -> None:
     # print(source_pattern.format(id_=id_))
     orig_nib = nib.load(source_pattern.format(id_=id_))
-    orig_shape = np.asarray(orig_nib.dataobj).shape
+    orig_shape = orig_nib.shape
     # print(orig_nib.affine)
 
     X, Y, Z = orig_shape
-    # assert Z == len(idxes)
+    # assert Z == len(images)
 
     res_arr: np.ndarray = np.zeros((X, Y, Z), dtype=np.int16)
 
-    for idx in idxes:
-        img: Path = images[idx]
+    zs: list[int] = map_(get_z, images)
+    stack: np.ndarray = np.stack(map_(imread, images), axis=-1)  # (W, H, n), in the same order as zs
+    assert stack.dtype == np.uint8
+    assert set(np.unique(stack)) <= set(range(K))
 
-        z = get_z(img)
-        img_arr = imread(img)
-        assert img_arr.dtype == np.uint8
-        assert set(np.unique(img_arr)) <= set(range(K))
+    # The whole stack is resized at once, with the nearest neighbour resize of the volume inference
+    resized: np.ndarray = resize_labels(torch.from_numpy(np.moveaxis(stack, -1, 0)), (X, Y))  # (X, Y, n)
 
-        resized: np.ndarray = resize(img_arr, (X, Y),
-                                     mode="constant",
-                                     preserve_range=True,
-                                     anti_aliasing=False,
-                                     order=0)
-
-        res_arr[:, :, z] = resized[...]
+    res_arr[:, :, zs] = resized[...]
 
     assert set(np.unique(res_arr)) <= set(range(K))
     assert orig_shape == res_arr.shape, (orig_shape, res_arr.shape)
 
     if post_processing:
-        res_arr = morphological_postprocessing(res_arr, operation="dilation", structure_size=1)
-        res_arr = keep_largest_components(res_arr)
-        res_arr = smooth_labels(res_arr, sigma=2)
+        res_arr = postprocess(res_arr, steps=DEFAULT_STEPS)  # Dilation, largest component, smoothing
 
     new_nib = nib.nifti1.Nifti1Image(res_arr, affine=orig_nib.affine, header=orig_nib.header)
     nib.save(new_nib, (Path(dest_folder) / id_).with_suffix(".nii.gz"))
 
+def star_merge(packed: tuple[Callable, str, list[Path]]) -> None:
+    # Top-level, hence picklable, unlike the lambda that was used with mmap_
+    pfun, id_, images = packed
+    pfun(id_, images=images)
+
+
 def main(args) -> None:
     images: list[Path] = list(Path(args.data_folder).glob("*.png"))
     grouping_regex: Pattern = re.compile(args.grp_regex)
@@ -102,9 +103,23 @@ def main(args) -> None:
 
     args.dest_folder.mkdir(parents=True, exist_ok=True)
 
-    for p in tqdm_(unique_patients):
-        merge_patient(p, args.dest_folder, images, idx_map[p], args.num_classes, args.source_scan_pattern, post_processing=args.post_processing)
-    # mmap_(lambda p: merge_patient(p, args.dest_folder, images, idx_map[p], K=args.num_classes), patients)
+    # Only the patient's own images are sent to the workers
+    patient_images: list[list[Path]] = [[images[i] for i in idx_map[p]] for p in unique_patients]
+    pfun: Callable = partial(merge_patient,
+                             dest_folder=args.dest_folder,
+                             K=args.num_classes,
+                             source_pattern=args.source_scan_pattern,
+                             post_processing=args.post_processing)
+    match args.process:
+        case 1:
+            for p, p_images in tqdm_(zip(unique_patients, patient_images), total=len(unique_patients)):
+                pfun(p, images=p_images)
+        case _ as n:
+            with Pool(None if n == -1 else n) as pool:
+                results = pool.imap_unordered(star_merge, [(pfun, p, p_images)
+                                                           for p, p_images in zip(unique_patients, patient_images)])
+                for _ in tqdm_(results, total=len(unique_patients)):
+                    pass
 
 
 def get_args() -> argparse.Namespace:
@@ -118,6 +133,8 @@ def get_args() -> argparse.Namespace:
 
     parser.add_argument('--num_classes', type=int, default=4)
     parser.add_argument('--post_processing', type=bool, default=False)
+    parser.add_argument('--process', '-p', type=int, default=1,
+                        help="The number of cores to use for processing (-1 for all of them)")
 
     args = parser.parse_args()
 
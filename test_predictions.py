@@ -1,13 +1,13 @@
 import argparse
-from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator
 from pathlib import Path
 from pprint import pprint
 import torch
 import numpy as np
-import torch.nn.functional as F
 from torchvision import transforms
-from utils import (probs2class, tqdm_, save_images)
-from torch.utils.data import DataLoader
+from utils import tqdm_
+from torch.utils.data import DataLoader, Sampler
 from dataset import SliceDataset
 from ShallowNet import shallowCNN
 from ENet import ENet
@@ -15,8 +15,7 @@ import nibabel as nib
 from PIL import Image
 from torchvision.transforms import InterpolationMode
 from ENet_kernelsize import kernel_ENet
-from utils import ( class2one_hot)
-from operator import itemgetter
+from inference import compile_for_inference, optimize_for_inference, predict_slices
 from tqdm import tqdm
 
 datasets_params: dict[str, dict[str, Any]] = {}
@@ -51,6 +50,31 @@ def save_3d_predictions_as_nii(predictions_3d, output_path, affine=np.eye(4)):
     nii_img = nib.Nifti1Image(predictions_3d, affine)
     nib.save(nii_img, output_path)
 
+def save_prediction(slice_pred: np.ndarray, dest: Path) -> None:
+    # Convert the prediction to an image and save
+    Image.fromarray(slice_pred * 63).save(dest)
+
+
+class PatientBatchSampler(Sampler[list[int]]):
+    """
+    Batches the slices patient by patient: each batch holds up to `batch_size` consecutive slices of one patient.
+    """
+    def __init__(self, stems: list[str], batch_size: int):
+        patients: dict[str, list[int]] = {}
+        for i, stem in enumerate(stems):
+            patients.setdefault('_'.join(stem.split('_')[:2]), []).append(i)
+
+        self.batches: list[list[int]] = [idxes[b:b + batch_size]
+                                         for idxes in patients.values()
+                                         for b in range(0, len(idxes), batch_size)]
+
+    def __iter__(self) -> Iterator[list[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
 def run_inference_on_test(args):
     # Load the trained model checkpoint
 
@@ -62,6 +86,9 @@ def run_inference_on_test(args):
     # Pick device
     device = torch.device("cuda") if args.gpu and torch.cuda.is_available() else torch.device("cpu")
     net.to(device)
+    net = optimize_for_inference(net, torch.rand((2, 1, 256, 256), device=device))
+    if args.compile:
+        net = compile_for_inference(net, (256, 256), args.batch_size, device)
 
     # Dataset paths
     root_dir = Path("data") / "SEGTHOR_test"
@@ -84,16 +111,17 @@ def run_inference_on_test(args):
         # {0, 51, 102, 153, 204, 255} for 6 classes
         # Very sketchy but that works here and that simplifies visualization
         lambda nd: nd / (255 / (K - 1)) if K != 5 else nd / 63,  # max <= 1 # Normalize the image
-        lambda nd: torch.tensor(nd, dtype=torch.int64)[None, ...],  # Add one dimension to simulate batch
-        lambda t: class2one_hot(t, K=K),  # Convert to one-hot encoding
-        itemgetter(0)
+        lambda nd: torch.tensor(nd, dtype=torch.uint8)  # Compact class map
     ])
     test_set = SliceDataset('test',
                             root_dir,
                             img_transform=img_transform,
                             gt_transform=gt_transform,
                             debug=False)
-    test_loader = DataLoader(test_set, batch_size=1, shuffle=False, num_workers=args.num_workers, collate_fn=custom_collate)
+    # Whole-patient batches, loaded by the workers while the network runs on the previous one
+    batch_sampler = PatientBatchSampler([Path(img_path).stem for img_path, _ in test_set.files], args.batch_size)
+    test_loader = DataLoader(test_set, batch_sampler=batch_sampler, num_workers=args.num_workers,
+                             pin_memory=device.type == "cuda", collate_fn=custom_collate)
 
     # Inference
     print(f">> Running inference on the test set...")
@@ -101,40 +129,43 @@ def run_inference_on_test(args):
     predictions_2d_dir = args.dest / "predictions_2d"
     predictions_2d_dir.mkdir(parents=True, exist_ok=True)
 
-    with torch.no_grad():
+    # The PNG encoding is done in background threads, overlapped with the next forward passes
+    with torch.inference_mode(), ThreadPoolExecutor(max_workers=args.save_workers) as saver:
+        saved: list[Future] = []
         for i, data in tqdm_(enumerate(test_loader), total=len(test_loader)):
-                img = data['images'].to(device)
                 stems = data['stems']
 
-                pred_logits = net(img)
-                pred_probs = F.softmax(1 * pred_logits, dim=1)
-                pred_seg = probs2class(pred_probs)  # Get class predictions
+                # Same batched forward + argmax as the NIfTI-to-NIfTI inference (inference.py)
+                pred_seg = predict_slices(net, data['images'], args.batch_size, device, pad=args.compile).numpy()
 
                 # Save the 2D prediction for each slice
-                for j in range(pred_seg.size(0)):
-                        stem = stems[j]
-            
+                for stem, slice_pred in zip(stems, pred_seg):
                         # Reconstructed image file name
                         patient_id_with_number = '_'.join(stem.split('_')[:2])  # 'Patient_41'
                         slice_idx = stem.split('_')[-1]  # Slice index
 
                         img_filename = f"{patient_id_with_number}_{slice_idx}.png"
 
-                        # Get prediction
-                        slice_pred = pred_seg[j].cpu().numpy()
+                        saved.append(saver.submit(save_prediction, slice_pred, predictions_2d_dir / img_filename))
 
-                        # Convert the prediction to an image and save
-                        img = Image.fromarray((slice_pred * 63).astype(np.uint8))  
-                        img.save(predictions_2d_dir / img_filename)  
+        # Raise the errors of the writes (disk full, ...), instead of leaving the predictions silently missing
+        for future in saved:
+                future.result()
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--dataset', default='SEGTHOR', choices=datasets_params.keys())
     parser.add_argument('--dest', type=Path, required=True, help="Destination directory to save predictions.")
-    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help="Maximum number of slices (all from the same patient) per forward pass.")
+    parser.add_argument('--save_workers', type=int, default=4,
+                        help="Number of threads writing the prediction PNGs.")
     parser.add_argument('--gpu', action='store_true')
     parser.add_argument('--model_checkpoint', type=Path, required=True, help="Path to the model checkpoint for inference.")
+    parser.add_argument('--compile', action='store_true',
+                        help="torch.compile the network, the short batches (end of a patient) being padded")
 
     args = parser.parse_args()
 
@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from augment import BatchAugmenter
+
+
+def batch(B=4, H=48, W=40):
+    generator = torch.Generator().manual_seed(0)
+    img = torch.rand((B, 1, H, W), generator=generator)
+    gt = torch.zeros((B, H, W), dtype=torch.uint8)
+    gt[:, 10:30, 8:20] = 1
+    gt[:, 20:40, 15:35] = 3
+    gt[:, 5:12, 25:38] = 4
+
+    return img, gt
+
+
+@pytest.mark.parametrize("augmenter", [BatchAugmenter(p_spatial=0, p_elastic=0, p_noise_contrast=0, p_blur_gamma=0),
+                                       BatchAugmenter(rotation=0, scale=0, translation=0, p_spatial=1,
+                                                      p_elastic=0, p_noise_contrast=0, p_blur_gamma=0)])
+def test_identity(augmenter):
+    img, gt = batch()
+
+    augmented_img, augmented_gt = augmenter(img, gt)
+
+    torch.testing.assert_close(augmented_img, img, rtol=0, atol=1e-5)  # The grid only rounds
+    assert torch.equal(augmented_gt, gt)
+
+
+def test_labels_stay_class_maps():
+    torch.manual_seed(0)
+    img, gt = batch(B=16)
+
+    augmented_img, augmented_gt = BatchAugmenter(p_spatial=1, p_elastic=1, p_noise_contrast=1, p_blur_gamma=1)(img, gt)
+
+    assert augmented_img.shape == img.shape and augmented_img.dtype == img.dtype
+    assert augmented_gt.shape == gt.shape and augmented_gt.dtype == torch.uint8
+    assert 0 <= augmented_img.min() and augmented_img.max() <= 1
+    assert set(augmented_gt.unique().tolist()) <= {0, 1, 3, 4}  # Nearest: no value in between two classes
+    assert not torch.equal(augmented_gt, gt)
+
+
+def test_same_warp_for_image_and_label():
+    # With the label painted into the image, the warped image still matches the warped label
+    torch.manual_seed(0)
+    _, gt = batch()
+    img = (gt[:, None] > 0).float()
+
+    augmented_img, augmented_gt = BatchAugmenter(p_spatial=1, p_elastic=1, p_noise_contrast=0, p_blur_gamma=0)(img, gt)
+
+    agreement = ((augmented_img[:, 0] > 0.5) == (augmented_gt > 0)).float().mean()
+    assert agreement > 0.98  # Only the bilinear edges may differ
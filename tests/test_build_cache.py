@@ -0,0 +1,81 @@
+import os
+
+from build_cache import BuildCache
+
+
+def build(cache, name, key, dest, content=b"slices"):
+    output = dest / f"{name}.npy"
+    output.write_bytes(content)
+    cache.put(name, key, [output], spacing=[1, 1, 2.5])
+
+    return output
+
+
+def test_key_follows_the_content_and_the_params(tmp_path):
+    source = tmp_path / "Patient_01.nii.gz"
+    source.write_bytes(b"ct")
+    cache = BuildCache(tmp_path / "dest")
+
+    key = cache.key([source], {"shape": [256, 256]})
+    assert cache.key([source], {"shape": [256, 256]}) == key
+    assert cache.key([source], {"shape": [512, 512]}) != key
+
+    source.write_bytes(b"other ct")
+    assert cache.key([source], {"shape": [256, 256]}) != key
+
+
+def test_unchanged_files_are_not_hashed_again(tmp_path):
+    source = tmp_path / "Patient_01.nii.gz"
+    source.write_bytes(b"ct")
+    cache = BuildCache(tmp_path / "dest")
+    key = cache.key([source], {})
+
+    # Same size and mtime: the recorded hash is trusted, even though the content differs
+    stat = source.stat()
+    source.write_bytes(b"CT")
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.key([source], {}) == key
+
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache.key([source], {}) != key
+
+
+def test_get_needs_the_key_and_the_outputs(tmp_path):
+    cache = BuildCache(tmp_path)
+    output = build(cache, "Patient_01", "abc", tmp_path)
+
+    assert cache.get("Patient_01", "abc")["spacing"] == [1, 1, 2.5]
+    assert cache.get("Patient_01", "def") is None
+    assert cache.get("Patient_02", "abc") is None
+
+    output.unlink()
+    assert cache.get("Patient_01", "abc") is None
+
+
+def test_discard_deletes_the_outputs(tmp_path):
+    cache = BuildCache(tmp_path)
+    output = build(cache, "Patient_01", "abc", tmp_path)
+
+    cache.discard("Patient_01")
+    assert not output.exists()
+    assert "Patient_01" not in cache.entries
+
+    cache.discard("Patient_01")  # Nothing left to forget
+
+
+def test_save_and_reload(tmp_path):
+    source = tmp_path / "Patient_01.nii.gz"
+    source.write_bytes(b"ct")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    cache = BuildCache(dest)
+    key = cache.key([source], {"shape": [256, 256]})
+    build(cache, "Patient_01", key, dest)
+    cache.save()
+
+    reloaded = BuildCache(dest)
+    assert reloaded.entries == cache.entries
+    assert reloaded.files == cache.files
+    assert reloaded.get("Patient_01", reloaded.key([source], {"shape": [256, 256]})) is not None
+    assert not (dest / "build_manifest.tmp").exists()
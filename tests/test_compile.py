@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from DeepLabV3 import DeepLabV3
+from ENet import ENET_PRESETS, ENet
+from ShallowNet import shallowCNN
+from utils import graph_breaks
+
+
+# Every network main.py can build
+NETS = {**{f"ENet-{preset}": lambda preset=preset: ENet(1, 5, preset=preset) for preset in ENET_PRESETS},
+        "ENet-kernelsize5": lambda: ENet(1, 5, kernelsize=5),
+        "shallowCNN": lambda: shallowCNN(1, 2),
+        "DeepLabV3": lambda: DeepLabV3(5, pretrained=False)}
+
+
+@pytest.mark.parametrize("name", NETS)
+def test_no_graph_break(name):
+    net = NETS[name]()
+    net.train()
+
+    assert graph_breaks(net, torch.rand(2, 1, 256, 256)) == []
+    assert net.training
+
+
+@pytest.mark.parametrize("name", NETS)
+def test_no_graph_break_in_training(name):
+    # compile_net only checks the eval forward, but --compile also runs the training one
+    net = NETS[name]()
+    net.train()
+
+    try:
+        explanation = torch._dynamo.explain(net)(torch.rand(2, 1, 64, 64))
+    finally:
+        torch._dynamo.reset()
+
+    assert explanation.graph_break_count == 0, [str(reason.reason) for reason in explanation.break_reasons]
@@ -0,0 +1,191 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from dataset import (SLICE_INDEX, PackedSliceDataset, PackedWriter, SliceDataset, batched_histograms,
+                     build_slice_index, histograms_to_classes, load_index, png_label_scale, save_index, slice_index)
+
+
+K = 5
+
+
+def class_maps(n=6, shape=(32, 32)):
+    rng = np.random.default_rng(0)
+    gts = rng.integers(0, K, size=(n, *shape), dtype=np.uint8)
+    gts[0] = 0  # Background only
+    gts[1, :, :16] = 0
+    return gts
+
+
+@pytest.fixture
+def sliced(tmp_path):
+    # The layout of slice_segthor.py: <root>/train/{img,gt}/Patient_XX_YYYY.png, labels stored as class * 63
+    gts = class_maps()
+    for folder in ["img", "gt"]:
+        (tmp_path / "train" / folder).mkdir(parents=True)
+    for z, gt in enumerate(gts):
+        stem = f"Patient_01_{z:04d}"
+        Image.fromarray(gt * 4).save(tmp_path / "train" / "img" / f"{stem}.png")
+        Image.fromarray(gt * 63).save(tmp_path / "train" / "gt" / f"{stem}.png")
+
+    return tmp_path, gts
+
+
+@pytest.fixture
+def packed(tmp_path):
+    gts = class_maps()
+    with PackedWriter(tmp_path / "train" / "packed", gts.shape[1:]) as writer:
+        writer.append([f"Patient_01_{z:04d}" for z in range(len(gts))], gts * 4, gts)
+
+    return tmp_path, gts
+
+
+def counts(gts):
+    return np.stack([np.bincount(gt.ravel(), minlength=K) for gt in gts])
+
+
+def test_histograms_to_classes():
+    hists = np.zeros((2, 256), dtype=np.int64)
+    hists[0, [0, 63, 126, 189, 252]] = [1, 2, 3, 4, 5]
+    hists[1, [0, 70, 255]] = [7, 8, 9]  # Between two encodings, the value rounds down as in the gt_transform
+
+    np.testing.assert_array_equal(histograms_to_classes(hists, K, png_label_scale(K)),
+                                  [[1, 2, 3, 4, 5], [7, 8, 0, 0, 9]])
+    np.testing.assert_array_equal(histograms_to_classes(hists, 2, png_label_scale(2)),
+                                  [[1 + 2 + 3 + 4 + 5, 0], [7 + 8, 9]])
+
+
+def test_batched_histograms():
+    gts = class_maps()
+
+    np.testing.assert_array_equal(batched_histograms(gts),
+                                  np.stack([np.bincount(gt.ravel(), minlength=256) for gt in gts]))
+
+
+def test_class_counts_of_the_png_labels(sliced):
+    root, gts = sliced
+    dataset = SliceDataset('train', root)
+
+    np.testing.assert_array_equal(dataset.class_counts(K), counts(gts))
+
+
+def test_class_counts_without_background(sliced):
+    root, gts = sliced
+    dataset = SliceDataset('train', root, remove_background=True)
+
+    assert len(dataset) == len(gts) - 1
+    np.testing.assert_array_equal(dataset.class_counts(K), counts(gts[1:]))
+
+
+def test_class_counts_of_the_packed_labels(packed):
+    root, gts = packed
+
+    np.testing.assert_array_equal(PackedSliceDataset('train', root).class_counts(K), counts(gts))
+    np.testing.assert_array_equal(PackedSliceDataset('train', root, remove_background=True).class_counts(K),
+                                  counts(gts[1:]))
+
+
+def test_slice_index_follows_the_files(sliced):
+    root, gts = sliced
+    gt_folder = root / "train" / "gt"
+    gt_paths = sorted(gt_folder.glob("*.png"))
+
+    metadata = slice_index(gt_paths[::-1])  # In the order asked for
+    np.testing.assert_array_equal(metadata["zs"], np.arange(len(gts))[::-1])
+    np.testing.assert_array_equal(metadata["foreground"], [True] * (len(gts) - 1) + [False])
+    assert set(metadata["patients"]) == {"Patient_01"}
+
+    index = load_index(gt_folder / SLICE_INDEX)
+    assert list(index["stems"]) == [p.stem for p in gt_paths]
+
+    # A rewritten label is decoded again
+    Image.fromarray(np.full_like(gts[0], 63)).save(gt_paths[0])
+    assert slice_index(gt_paths)["foreground"].all()
+    assert load_index(gt_folder / SLICE_INDEX)["foreground"].all()
+
+
+def test_slice_index_across_folders(sliced):
+    root, gts = sliced
+    other = root / "train" / "gt_aug"
+    other.mkdir()
+    Image.fromarray(np.zeros_like(gts[0])).save(other / "Patient_02_0000.png")
+
+    gt_paths = sorted((root / "train" / "gt").glob("*.png"))
+    metadata = slice_index([gt_paths[1], other / "Patient_02_0000.png", gt_paths[0]])
+
+    np.testing.assert_array_equal(metadata["patients"], ["Patient_01", "Patient_02", "Patient_01"])
+    np.testing.assert_array_equal(metadata["foreground"], [True, False, False])
+    assert (other / SLICE_INDEX).exists()
+
+
+def test_build_slice_index_drops_the_removed_slices(sliced):
+    root, gts = sliced
+    gt_folder = root / "train" / "gt"
+    build_slice_index(gt_folder)
+
+    (gt_folder / "Patient_01_0000.png").unlink()
+    build_slice_index(gt_folder)
+    assert len(load_index(gt_folder / SLICE_INDEX)["stems"]) == len(gts) - 1
+
+    for gt_path in gt_folder.glob("*.png"):
+        gt_path.unlink()
+    build_slice_index(gt_folder)
+    assert not (gt_folder / SLICE_INDEX).exists()
+
+
+def test_save_empty_index(tmp_path):
+    index_path = tmp_path / SLICE_INDEX
+    save_index(index_path, {})
+    assert not index_path.exists()
+
+    save_index(index_path, {"stems": np.array(["Patient_01_0000"]), "hists": np.ones((1, 256), dtype=np.int64)})
+    save_index(index_path, {"stems": np.array([], dtype=str), "hists": np.zeros((0, 256), dtype=np.int64)})
+    assert not index_path.exists()
+
+
+def test_packed_metadata_rebuilt_when_stale(packed):
+    root, gts = packed
+    (root / "train" / "packed" / SLICE_INDEX).unlink()
+
+    metadata = PackedSliceDataset('train', root).metadata()
+
+    np.testing.assert_array_equal(metadata["hists"], batched_histograms(gts))
+    np.testing.assert_array_equal(metadata["zs"], np.arange(len(gts)))
+    assert (root / "train" / "packed" / SLICE_INDEX).exists()
+
+
+def test_empty_split(tmp_path):
+    for folder in ["img", "gt"]:
+        (tmp_path / "train" / folder).mkdir(parents=True)
+
+    dataset = SliceDataset('train', tmp_path, remove_background=True)
+
+    assert len(dataset) == 0
+    assert dataset.class_counts(K).shape == (0, K)
+
+
+def test_empty_packed_store(tmp_path):
+    with PackedWriter(tmp_path / "train" / "packed", (32, 32)):
+        pass
+
+    dataset = PackedSliceDataset('train', tmp_path, remove_background=True)
+
+    assert len(dataset) == 0
+    assert dataset.class_counts(K).shape == (0, K)
+
+
+def test_read_only_dataset(sliced, packed, monkeypatch):
+    def read_only(path, *args, **kwargs):
+        raise PermissionError(f"Read-only file system: '{path}'")
+    monkeypatch.setattr(np, "savez_compressed", read_only)
+
+    root, gts = sliced
+    with pytest.warns(UserWarning, match="slice index"):
+        dataset = SliceDataset('train', root, remove_background=True)
+    assert len(dataset) == len(gts) - 1
+    assert not (root / "train" / "gt" / SLICE_INDEX).exists()
+
+    (root / "train" / "packed" / SLICE_INDEX).unlink()
+    with pytest.warns(UserWarning, match="slice index"):
+        dataset = PackedSliceDataset('train', root, remove_background=True)
+        np.testing.assert_array_equal(dataset.class_counts(K), counts(gts[1:]))
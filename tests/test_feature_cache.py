@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+
+from DeepLabV3 import DeepLabV3
+from dataset import PackedSliceDataset, PackedWriter
+from feature_cache import FeatureCache, cached_features
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    rng = np.random.default_rng(0)
+    imgs = rng.integers(0, 256, size=(5, 64, 64), dtype=np.uint8)
+    gts = rng.integers(0, 5, size=(5, 64, 64), dtype=np.uint8)
+    with PackedWriter(tmp_path / "train" / "packed", (64, 64)) as writer:
+        writer.append([f"Patient_01_{z:04d}" for z in range(5)], imgs, gts)
+
+    return PackedSliceDataset('train', tmp_path)
+
+
+@pytest.fixture
+def net():
+    torch.manual_seed(0)
+    return DeepLabV3(5, pretrained=False).eval()
+
+
+def test_build_and_reload(tmp_path, dataset, net):
+    features = cached_features(dataset, tmp_path, 'train', 'packed', net, torch.device("cpu"), batch_size=2)
+    path = tmp_path / "train" / "features" / "packed"
+
+    assert FeatureCache.valid(path, dataset.stems)
+    assert not FeatureCache.valid(path, dataset.stems[:-1])
+    assert not net.training
+
+    mtime = (path / "features.f16").stat().st_mtime_ns
+    reloaded = cached_features(dataset, tmp_path, 'train', 'packed', net, torch.device("cpu"))
+    assert (path / "features.f16").stat().st_mtime_ns == mtime  # Reused, not computed again
+    for i in range(len(dataset)):
+        torch.testing.assert_close(reloaded.cache[i], features.cache[i], rtol=0, atol=0)
+
+    # Only the labels are loaded, along with the features
+    item = reloaded[3]
+    assert set(item) == {"gts", "stems", "features"}
+    assert item["stems"] == dataset[3]["stems"]
+    torch.testing.assert_close(item["gts"], dataset[3]["gts"])
+
+
+def test_head_on_the_features_is_the_network(tmp_path, dataset, net):
+    features = cached_features(dataset, tmp_path, 'train', 'packed', net, torch.device("cpu"))
+    img = torch.stack([dataset[i]["images"] for i in range(len(dataset))])  # Grayscale slices, as main.py gives
+    cached = torch.stack([features[i]["features"] for i in range(len(dataset))])
+
+    with torch.inference_mode():
+        logits = net(img)
+        head_logits = net.head(cached.float(), img.shape[-2:])
+
+    assert head_logits.shape == logits.shape == (5, 5, 64, 64)
+    torch.testing.assert_close(head_logits, logits, rtol=1e-2, atol=1e-2)  # The features are stored in fp16
+
+
+def test_lru_eviction(tmp_path, dataset, net):
+    cache = FeatureCache.build(tmp_path / "features", net, dataset, torch.device("cpu"), lru_size=2)
+
+    first = cache[0]
+    cache[1]
+    assert cache[0] is first  # Kept, and now the most recent
+    cache[2]
+    assert list(cache.lru) == [0, 2]  # 1 was the least recently used
+    assert cache[1] is not None and list(cache.lru) == [2, 1]
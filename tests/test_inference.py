@@ -0,0 +1,115 @@
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+import pytest
+import torch
+from PIL import Image
+from torch import nn
+
+from DeepLabV3 import DeepLabV3
+from ENet import ENET_PRESETS, ENet
+from ShallowNet import shallowCNN
+from inference import optimize_for_inference, prepare_volume
+
+
+ROOT = Path(__file__).parents[1]
+SEGMENTATION = ROOT / "volumes" / "segthor" / "best_model_post_process_v5" / "Patient_01.nii.gz"
+VAL_IMGS = sorted((ROOT / "data").glob("SEGTHOR*/val/img"))
+
+# The networks that get optimized
+NETS = {**{f"ENet-{preset}": lambda preset=preset: ENet(1, 5, preset=preset) for preset in ENET_PRESETS},
+        "shallowCNN": lambda: shallowCNN(1, 5),
+        "DeepLabV3": lambda: DeepLabV3(5, pretrained=False)}
+
+
+@pytest.fixture(scope="module")
+def ct_slices():
+    """
+    No SegTHOR scan nor trained weights are shipped with the repository: CT-like slices are made from a predicted
+    segmentation, with roughly the Hounsfield units of each organ in a soft tissue body, then normalized and
+    resized as slice_segthor.py does.
+    """
+    rng = np.random.default_rng(0)
+    classes = np.asarray(nib.load(SEGMENTATION).dataobj) // 63
+    z = np.flatnonzero(classes.any(axis=(0, 1)))
+    classes = classes[:, :, np.linspace(z[0], z[-1], 8).astype(int)]
+
+    X, Y, _ = classes.shape
+    xx, yy = np.meshgrid(np.linspace(-1, 1, X), np.linspace(-1, 1, Y), indexing="ij")
+    body = (xx / 0.9) ** 2 + (yy / 0.7) ** 2 < 1
+
+    hu = np.array([40, 20, 50, -900, 200])  # Background (soft tissue), esophagus, heart, trachea, aorta
+    ct = np.where(body[..., None], hu[classes], -1000) + rng.normal(0, 20, classes.shape)
+
+    return prepare_volume(np.clip(ct, -1000, 3000).astype(np.int16), (256, 256))
+
+
+def trained_like(net: nn.Module, slices: torch.Tensor) -> nn.Module:
+    # Fresh BatchNorms are identities: give them the statistics of the slices and random affine parameters, so that
+    # the folding changes the convolutions as it would on a trained network
+    for module in net.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.momentum = None  # Cumulative average over the calibration batches
+            nn.init.uniform_(module.weight, 0.5, 1.5)
+            nn.init.uniform_(module.bias, -0.5, 0.5)
+
+    net.train()
+    with torch.no_grad():
+        for b in range(0, len(slices), 4):
+            net(slices[b:b + 4])
+
+    return net.eval()
+
+
+def check_folding(name: str, slices: torch.Tensor) -> None:
+    build = NETS[name]
+    torch.manual_seed(0)
+
+    # In float64 the rounding vanishes: the folded network gives the same logits, hence the same classes everywhere
+    x = slices[:4].double()
+    net = trained_like(build().double(), x)
+    optimized = optimize_for_inference(net, x, tolerance=0)
+    with torch.inference_mode():
+        logits = net(x)
+        torch.testing.assert_close(optimized(x), logits, rtol=0, atol=1e-10)
+
+    # In float32, only the rounding changes, within the tolerance of optimize_for_inference
+    x = slices
+    net = trained_like(build(), x)
+    optimized = optimize_for_inference(net, x)
+    with torch.inference_mode():
+        logits = net(x)
+        changed = logits.argmax(dim=1) != optimized(x).argmax(dim=1)
+    if not any(isinstance(m, nn.MaxUnpool2d) for m in net.modules()):
+        # Without max unpooling (ENet), the pixels that change class are ties of the original logits
+        top2 = logits.topk(2, dim=1).values
+        assert ((top2[:, 0] - top2[:, 1])[changed] < 1e-4).all()
+
+    assert not any(isinstance(m, (nn.BatchNorm2d, nn.Dropout, nn.Dropout2d)) for m in optimized.modules())
+
+
+@pytest.mark.parametrize("name", NETS)
+def test_same_argmax_after_folding(name, ct_slices):
+    check_folding(name, ct_slices)
+
+
+@pytest.mark.skipif(not VAL_IMGS, reason="No SegTHOR validation slices (data/SEGTHOR*/val/img)")
+@pytest.mark.parametrize("name", NETS)
+def test_same_argmax_on_validation_slices(name):
+    paths = sorted(VAL_IMGS[0].glob("*.png"))[::50][:8]
+    check_folding(name, torch.stack([torch.from_numpy(np.asarray(Image.open(p).convert('L'), dtype=np.float32))[None]
+                                     for p in paths]) / 255)
+
+
+def test_net_left_untouched():
+    net = ENet(1, 5)
+    net.train()
+    state = {k: v.clone() for k, v in net.state_dict().items()}
+
+    optimized = optimize_for_inference(net, torch.rand(2, 1, 64, 64))
+
+    assert net.training and not optimized.training
+    assert any(isinstance(m, nn.BatchNorm2d) for m in net.modules())
+    for k, v in net.state_dict().items():
+        torch.testing.assert_close(v, state[k], rtol=0, atol=0)
@@ -0,0 +1,112 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from metrics import MetricLog, MetricsWorker, compute_metrics
+from utils import class2one_hot
+from plot import load_epochs
+
+
+def run_epoch(log: MetricLog, e: int) -> None:
+    log.start_epoch(e)
+    log[0:2] = torch.full((2, 3), float(e))
+    log[2:4] = torch.full((2, 3), float(e) + 1)
+    log.flush()
+
+
+def test_running_mean_ignores_missing_values(tmp_path):
+    log = MetricLog(tmp_path, "dice_val", (4, 3))
+    log.start_epoch(0)
+    assert torch.isnan(log.mean()).all()  # Nothing computed yet
+
+    log[0:2] = torch.tensor([[1., 0., 0.5], [0., 0., 0.5]])
+    log[2:3] = torch.tensor([[1., float("nan"), 0.5]])
+    assert torch.allclose(log.mean(), torch.tensor([2 / 3, 0., 0.5]))
+
+
+def test_one_chunk_per_epoch(tmp_path):
+    log = MetricLog(tmp_path, "dice_val", (4, 3))
+    for e in range(3):
+        run_epoch(log, e)
+
+    assert sorted(p.name for p in (tmp_path / "dice_val").iterdir()) == ["0000.npy", "0001.npy", "0002.npy"]
+    epochs = list(load_epochs(tmp_path / "dice_val"))
+    assert len(epochs) == 3
+    assert all(chunk.shape == (4, 3) for chunk in epochs)
+    assert np.all(epochs[2][:2] == 2) and np.all(epochs[2][2:] == 3)
+
+
+def test_start_epoch_resets_the_values(tmp_path):
+    log = MetricLog(tmp_path, "loss_tra", (4,))
+    log.start_epoch(0)
+    log[0:4] = torch.tensor([1., 2., 3., 4.])
+
+    log.start_epoch(1)
+    log[0:1] = torch.tensor([10.])
+    assert math.isclose(log.mean().item(), 10.)
+    assert torch.isnan(log.values[1:]).all()
+
+
+def test_resume_drops_the_epochs_after_the_checkpoint(tmp_path):
+    # A run killed after flushing epoch 3 but with its last checkpoint at the end of epoch 1
+    log = MetricLog(tmp_path, "dice_val", (4, 3))
+    for e in range(4):
+        run_epoch(log, e)
+
+    # As runTraining --resume: a new log on the same folder, truncated to the epochs of the checkpoint
+    resumed = MetricLog(tmp_path, "dice_val", (4, 3))
+    resumed.truncate(2)
+    assert sorted(p.name for p in (tmp_path / "dice_val").iterdir()) == ["0000.npy", "0001.npy"]
+
+    for e in range(2, 5):
+        run_epoch(resumed, e)
+    epochs = list(load_epochs(tmp_path / "dice_val"))
+    assert len(epochs) == 5
+    assert [float(chunk[0, 0]) for chunk in epochs] == [0., 1., 2., 3., 4.]
+
+
+def random_batches(K=4, B=3, n=5):
+    # Blobs of classes, so that the surface distances are not all degenerate
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(n):
+        noise = torch.rand((B, K, 8, 8), generator=generator)
+        smooth = torch.nn.functional.interpolate(noise, size=(32, 32), mode="bilinear")
+        gt = smooth.argmax(dim=1).to(torch.uint8)
+        pred = torch.where(torch.rand((B, 32, 32), generator=generator) < 0.1, 0, gt).to(torch.uint8)
+        yield pred, gt
+
+
+def test_worker_gives_the_synchronous_metrics(tmp_path):
+    K, B, n = 4, 3, 5
+    names = ["dice", "iou", "hausdorff", "assd", "volsim"]
+    logs = {name: MetricLog(tmp_path, name, (B * n, K)) for name in names}
+    expected = {name: torch.zeros((B * n, K)) for name in names}
+    for log in logs.values():
+        log.start_epoch(0)
+
+    worker = MetricsWorker(K, workers=3)
+    for i, (pred, gt) in enumerate(random_batches(K, B, n)):
+        worker.submit(pred, gt, logs, i * B, surface=i % 2 == 0)
+        for name, values in compute_metrics(class2one_hot(pred.long(), K), class2one_hot(gt.long(), K),
+                                            surface=i % 2 == 0).items():
+            expected[name][i * B:(i + 1) * B] = values
+    worker.close()
+
+    for name in names:
+        torch.testing.assert_close(logs[name].values, expected[name], equal_nan=True)
+    assert logs["hausdorff"].values[B:2 * B].isnan().all()  # Skipped surface distances
+
+
+def test_wait_raises_the_worker_errors(tmp_path):
+    logs = {"dice": MetricLog(tmp_path, "dice", (2, 4))}  # The other logs are missing: the worker fails
+    worker = MetricsWorker(4)
+    pred, gt = next(random_batches(B=2))
+
+    worker.submit(pred, gt, logs, 0)
+    with pytest.raises(KeyError):
+        worker.wait()
+
+    worker.wait()  # Raised once, then forgotten
+    worker.close()
@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import intensity_augmentation
+import spatial_augmentation
+from parallel import pmap
+
+
+def draw(item):
+    return item, random.random(), np.random.rand()
+
+
+def test_draws_depend_on_the_item_only():
+    items = list(range(23))
+
+    sequential = pmap(draw, items, process=1, seed=3)
+    assert pmap(draw, items, process=4, seed=3) == sequential
+    assert pmap(draw, items, process=3, seed=3, chunksize=5) == sequential
+    assert [i for i, *_ in sequential] == items  # In the order of the items
+    assert pmap(draw, items, process=1, seed=4) != sequential
+
+
+@pytest.fixture
+def slices(tmp_path):
+    rng = np.random.default_rng(0)
+    for folder in ["img", "gt"]:
+        (tmp_path / folder).mkdir()
+    for z in range(6):
+        gt = np.zeros((48, 48), dtype=np.uint8)
+        gt[10:30, 12:40] = 63
+        img = rng.integers(0, 256, size=(48, 48), dtype=np.uint8)
+        Image.fromarray(img).save(tmp_path / "img" / f"Patient_01_{z:04d}.png")
+        Image.fromarray(gt).save(tmp_path / "gt" / f"Patient_01_{z:04d}.png")
+
+    return tmp_path
+
+
+def outputs(folder):
+    return {path.name: np.asarray(Image.open(path)) for path in sorted(folder.glob("*.png"))}
+
+
+def spatial(*dirs, **kwargs):
+    spatial_augmentation.augment_and_save(*dirs, num_augmentations=2, elastic=True, **kwargs)
+
+
+def intensity(*dirs, **kwargs):
+    intensity_augmentation.augment_and_save(*dirs, num_augmentations=2, **kwargs)
+
+
+@pytest.mark.parametrize("augment, n", [(spatial, 6 * 2), (intensity, 6 * 2 * 2)])
+def test_same_augmentations_whatever_the_processes(slices, augment, n):
+    runs = {}
+    for process in [1, 3]:
+        dest = slices / f"aug_{process}"
+        augment(slices / "img", slices / "gt", dest / "img", dest / "gt", process=process, seed=7)
+        runs[process] = outputs(dest / "img"), outputs(dest / "gt")
+
+    assert len(runs[1][0]) == n
+    for sequential, parallel in zip(runs[1], runs[3]):
+        assert sequential.keys() == parallel.keys()
+        for name in sequential:
+            np.testing.assert_array_equal(parallel[name], sequential[name])
@@ -0,0 +1,149 @@
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy.ndimage import gaussian_filter, label
+from skimage.morphology import ball, dilation, erosion
+
+from postprocessing import DEFAULT_STEPS, MORPHOLOGY, morphology, postprocess
+
+
+# The full-volume implementations postprocess replaces, one label after the other
+def keep_largest_components(volume):
+    refined_volume = np.zeros_like(volume)
+    for label_value in np.unique(volume):
+        if label_value == 0:
+            continue
+        labeled_array, _ = label(volume == label_value)
+        refined_volume[labeled_array == np.argmax(np.bincount(labeled_array.flat)[1:]) + 1] = label_value
+    return refined_volume
+
+
+def smooth_labels(volume, sigma=1):
+    smoothed_volume = np.zeros_like(volume)
+    for label_value in np.unique(volume):
+        if label_value == 0:
+            continue
+        smoothed_volume[gaussian_filter((volume == label_value).astype(float), sigma=sigma) > 0.5] = label_value
+    return smoothed_volume
+
+
+def dilate_labels(volume, structure_size):
+    refined_volume = np.zeros_like(volume)
+    for label_value in np.unique(volume):
+        if label_value == 0:
+            continue
+        refined_volume[dilation(volume == label_value, ball(structure_size))] = label_value
+    return refined_volume
+
+
+def default_chain(volume):
+    return smooth_labels(keep_largest_components(dilate_labels(volume, 1)), sigma=2)
+
+
+def synthetic_volume():
+    rng = np.random.default_rng(0)
+    volume = np.zeros((48, 40, 32), dtype=np.uint8)
+    volume[5:20, 5:25, 4:20] = 1
+    volume[30:36, 28:34, 20:26] = 1  # Second, smaller component
+    volume[18:30, 15:30, 10:28] = 2  # Overlaps the first one
+    volume[22:24, 20:22, 14:16] = 1  # Within label 2, swallowed by its dilation
+    volume[40:46, 2:12, 2:8] = 3
+    volume[2:8, 30:38, 24:30] = 4
+    volume[rng.random(volume.shape) < 0.01] = 4  # Speckles, each one a component
+    return volume
+
+
+@pytest.mark.parametrize("workers", [None, 1])
+def test_postprocess_is_the_label_by_label_chain(workers):
+    volume = synthetic_volume()
+
+    result = postprocess(volume, DEFAULT_STEPS, workers=workers)
+
+    assert result.dtype == volume.dtype
+    np.testing.assert_array_equal(result, default_chain(volume))
+
+
+def test_postprocess_float_volume():
+    # As given by load_nifti
+    volume = synthetic_volume().astype(np.float64)
+
+    np.testing.assert_array_equal(postprocess(volume, DEFAULT_STEPS), default_chain(volume))
+
+
+@pytest.mark.parametrize("step, reference", [(("dilation", 2), lambda v: dilate_labels(v, 2)),
+                                             (("largest", None), keep_largest_components),
+                                             (("smooth", 1), lambda v: smooth_labels(v, sigma=1))])
+def test_single_steps(step, reference):
+    volume = synthetic_volume()
+
+    np.testing.assert_array_equal(postprocess(volume, [step]), reference(volume))
+
+
+PREDICTIONS = Path(__file__).parents[1] / "volumes" / "segthor" / "best_model_post_process_v5"
+
+
+@pytest.mark.parametrize("path", sorted(PREDICTIONS.glob("*.nii.gz"))[:1])
+def test_postprocess_prediction(path):
+    # A real predicted volume, cropped around the organs and to 24 slices to keep the reference chain fast
+    volume = np.asarray(nib.load(path).dataobj)
+    x, y, z = (np.flatnonzero(volume.any(axis=axes)) for axes in [(1, 2), (0, 2), (0, 1)])
+    middle = (z[0] + z[-1]) // 2
+    volume = volume[x[0]:x[-1] + 1, y[0]:y[-1] + 1, middle - 12:middle + 12]
+    assert len(np.unique(volume)) > 2
+
+    np.testing.assert_array_equal(postprocess(volume, DEFAULT_STEPS), default_chain(volume))
+
+
+def blobs(shape=(24, 20, 16)):
+    rng = np.random.default_rng(1)
+    return gaussian_filter(rng.random(shape), 2) > 0.52
+
+
+def anisotropic_ball(radius, spacing):
+    # The voxels within radius (in mm) of the center, the structuring element the edt backend amounts to
+    half = [int(radius // s) for s in spacing]
+    grid = np.meshgrid(*(np.arange(-h, h + 1) * s for h, s in zip(half, spacing)), indexing="ij")
+    return sum(g ** 2 for g in grid) <= radius ** 2
+
+
+@pytest.mark.parametrize("operation", MORPHOLOGY)
+@pytest.mark.parametrize("radius", [1, 2, 3])
+def test_edt_backend_is_the_skimage_one(operation, radius):
+    mask = blobs()
+
+    np.testing.assert_array_equal(morphology(mask, operation, radius, backend="edt"),
+                                  morphology(mask, operation, radius, backend="skimage"))
+
+
+@pytest.mark.parametrize("backend", ["skimage", "edt"])
+def test_empty_masks(backend):
+    cube = np.zeros((9, 9, 9), dtype=bool)
+    cube[3:6, 3:6, 3:6] = True
+
+    # The erosion empties the cube, and the dilation must not bring anything back
+    assert not morphology(cube, "opening", 2, backend=backend).any()
+    assert not morphology(np.zeros_like(cube), "dilation", 3, backend=backend).any()
+    assert morphology(np.ones_like(cube), "erosion", 3, backend=backend).all()
+
+
+@pytest.mark.parametrize("operation", MORPHOLOGY)
+def test_edt_backend_with_spacing(operation):
+    mask = blobs()
+    spacing = (0.8, 0.8, 2.5)
+    footprint = anisotropic_ball(2.5, spacing)
+    dilate = lambda m: dilation(m, footprint)  # noqa: E731
+    erode = lambda m: erosion(m, footprint)  # noqa: E731
+    expected = {"dilation": lambda m: dilate(m), "erosion": lambda m: erode(m),
+                "closing": lambda m: erode(dilate(m)), "opening": lambda m: dilate(erode(m))}[operation](mask)
+
+    np.testing.assert_array_equal(morphology(mask, operation, 2.5, backend="edt", spacing=spacing), expected)
+
+
+@pytest.mark.parametrize("operation", MORPHOLOGY)
+def test_postprocess_backends_agree(operation):
+    volume = synthetic_volume()
+
+    np.testing.assert_array_equal(postprocess(volume, [(operation, 3)], backend="edt"),
+                                  postprocess(volume, [(operation, 3)], backend="skimage"))
@@ -0,0 +1,93 @@
+import json
+import argparse
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from inference import prepare_volume
+from slice_segthor import main, norm_arr, resize_, slice_volumes
+
+
+@pytest.fixture(scope="module")
+def source_path(tmp_path_factory):
+    # Smallest volume that passes sanity_ct/sanity_gt: 512x512 in-plane, at least 135 slices, all the 5 classes
+    rng = np.random.default_rng(0)
+    x, y, z = 512, 512, 139
+
+    ct = rng.integers(-1000, 1500, size=(x, y, z), dtype=np.int16)
+    gt = np.zeros((x, y, z), dtype=np.uint8)
+    for k, (cx, cy) in enumerate([(100, 300), (256, 256), (400, 150), (300, 420)], start=1):
+        gt[cx - 40:cx + 40, cy - 30:cy + 30, 10 * k:10 * k + 60] = k
+
+    id_path = tmp_path_factory.mktemp("segthor") / "train" / "Patient_01"
+    id_path.mkdir(parents=True)
+    affine = np.diag([0.98, 0.98, 2.5, 1])
+    nib.save(nib.Nifti1Image(ct, affine), id_path / "Patient_01.nii.gz")
+    nib.save(nib.Nifti1Image(gt, affine), id_path / "GT_corrected.nii.gz")
+
+    return id_path.parents[1]
+
+
+@pytest.fixture(scope="module")
+def slice_by_slice(source_path):
+    # The resize as done before the chunking, one z index at a time
+    shape = (256, 256)
+    id_path = source_path / "train" / "Patient_01"
+    ct = norm_arr(np.asarray(nib.load(id_path / "Patient_01.nii.gz").dataobj))
+    gt = np.asarray(nib.load(id_path / "GT_corrected.nii.gz").dataobj).astype(np.uint8)
+
+    img_slices = np.stack([resize_(ct[:, :, idz], shape).astype(np.uint8) for idz in range(ct.shape[-1])])
+    gt_slices = np.stack([resize_(gt[:, :, idz], shape, order=0).astype(np.uint8) for idz in range(gt.shape[-1])])
+
+    return img_slices, gt_slices
+
+
+@pytest.mark.parametrize("z_chunk", [1, 32, 500])
+def test_chunked_resize_is_the_slice_resize(source_path, slice_by_slice, z_chunk):
+    expected_img, expected_gt = slice_by_slice
+
+    img_slices, gt_slices, spacing = slice_volumes("Patient_01", source_path, (256, 256), z_chunk=z_chunk)
+
+    assert img_slices.dtype == gt_slices.dtype == np.uint8
+    assert img_slices.shape == gt_slices.shape == (139, 256, 256)
+    np.testing.assert_array_equal(img_slices, expected_img)
+    np.testing.assert_array_equal(gt_slices, expected_gt)
+    assert spacing == pytest.approx((0.98, 0.98, 2.5))
+
+
+@pytest.mark.parametrize("shape", [(256, 256), (300, 200)])
+def test_inference_input_is_the_sliced_one(source_path, shape):
+    # segment_volume feeds prepare_volume(ct) to the network, in place of the slice_volumes PNGs of the training
+    img_slices, _, _ = slice_volumes("Patient_01", source_path, shape)
+    ct = np.asarray(nib.load(source_path / "train" / "Patient_01" / "Patient_01.nii.gz").dataobj)
+
+    net_input = prepare_volume(ct, shape)
+    assert net_input.shape == (139, 1, *shape)
+    assert 0 <= net_input.min() <= net_input.max() <= 1
+
+    gray = (net_input[:, 0] * 255).round().numpy().astype(np.int16)
+    diff = np.abs(gray - img_slices)
+    if shape == (256, 256):
+        # Integer factor: the bilinear samples fall on the same pixel pairs, identical to the PNGs
+        assert diff.max() == 0
+    else:
+        # Otherwise the float32 interpolation can land on the other side of the uint8 truncation
+        assert diff.max() <= 1
+        assert (diff > 0).mean() < 1e-2
+
+
+def test_incremental_outputs_are_the_slices(source_path, tmp_path):
+    # The preprocessing and the augmentations write their PNGs next to img/ and gt/, with the same names
+    sibling = tmp_path / "train" / "img_preprocessed" / "Patient_01_0000.png"
+    sibling.parent.mkdir(parents=True)
+    sibling.write_bytes(b"")
+
+    for shape in [[256, 256], [128, 128]]:  # The second build discards the outputs of the first one
+        main(argparse.Namespace(source_dir=source_path, dest_dir=tmp_path, shape=shape, retains=0, fold=0,
+                                process=1, packed=False, incremental=True))
+
+        entry = json.loads((tmp_path / "build_manifest.json").read_text())["entries"]["Patient_01"]
+        assert sorted(entry["outputs"]) == [f"train/{sub}/Patient_01_{z:04d}.png"
+                                            for sub in ["gt", "img"] for z in range(139)]
+        assert sibling.exists()
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from spatial_augmentation import elastic_transform_batch, elastic_transform_pair
+
+
+def slices(n=4, shape=(40, 36)):
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(n, *shape), dtype=np.uint8)
+    labels = np.zeros((n, *shape), dtype=np.uint8)
+    labels[:, 8:30, 5:20] = 63
+    labels[:, 15:35, 12:30] = 189
+    return images, labels
+
+
+@pytest.mark.parametrize("step", [None, 1])
+def test_batch_is_the_per_slice_transform(step):
+    images, labels = slices()
+
+    warped_images, warped_labels = elastic_transform_batch(images, labels, alpha=20, sigma=4,
+                                                           random_state=np.random.RandomState(0), step=step)
+
+    # The fields of the batch are drawn in one go, as the slice by slice ones with the same random state
+    random_state = np.random.RandomState(0)
+    for image, label, warped_image, warped_label in zip(images, labels, warped_images, warped_labels):
+        expected_image, expected_label = elastic_transform_pair(image, label, alpha=20, sigma=4,
+                                                                random_state=random_state, step=step)
+        np.testing.assert_array_equal(warped_image, expected_image)
+        np.testing.assert_array_equal(warped_label, expected_label)
+
+
+def test_labels_keep_their_values():
+    images, labels = slices()
+
+    warped_images, warped_labels = elastic_transform_batch(images, labels, alpha=20, sigma=4,
+                                                           random_state=np.random.RandomState(0))
+
+    assert warped_images.shape == images.shape and warped_images.dtype == images.dtype
+    assert warped_labels.dtype == labels.dtype
+    assert set(np.unique(warped_labels)) <= {0, 63, 189}  # Nearest neighbour
+    assert not np.array_equal(warped_labels, labels)
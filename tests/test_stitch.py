@@ -0,0 +1,53 @@
+import argparse
+
+import numpy as np
+import nibabel as nib
+import pytest
+from PIL import Image
+from skimage.transform import resize
+
+from stitch import main
+
+
+SHAPES = {"Patient_01": (300, 280, 7), "Patient_02": (512, 512, 5)}
+
+
+@pytest.fixture
+def predictions(tmp_path):
+    rng = np.random.default_rng(0)
+    (tmp_path / "slices").mkdir()
+    (tmp_path / "scans").mkdir()
+    for id_, shape in SHAPES.items():
+        nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.int16), np.diag([0.9, 0.9, 2.5, 1])),
+                 tmp_path / "scans" / f"{id_}.nii.gz")
+        for z in range(shape[-1]):
+            Image.fromarray(rng.integers(0, 4, size=(256, 256), dtype=np.uint8)).save(
+                tmp_path / "slices" / f"{id_}_{z:04d}.png")
+
+    return tmp_path
+
+
+def slice_by_slice(folder, id_):
+    # The stitching as done before the pool and the batched resize
+    X, Y, Z = SHAPES[id_]
+    volume = np.zeros((X, Y, Z), dtype=np.int16)
+    for z in range(Z):
+        img = np.asarray(Image.open(folder / f"{id_}_{z:04d}.png"))
+        volume[:, :, z] = resize(img, (X, Y), mode="constant", preserve_range=True, anti_aliasing=False, order=0)
+
+    return volume
+
+
+@pytest.mark.parametrize("process", [1, 2])
+def test_stitch_is_the_slice_by_slice_one(predictions, process):
+    dest = predictions / f"stitched_{process}"
+    main(argparse.Namespace(data_folder=predictions / "slices",
+                            source_scan_pattern=str(predictions / "scans" / "{id_}.nii.gz"),
+                            dest_folder=dest, grp_regex=r"(Patient_\d\d)_\d\d\d\d", num_classes=4,
+                            post_processing=False, process=process))
+
+    for id_ in SHAPES:
+        stitched = nib.load(dest / f"{id_}.nii.gz")
+        assert stitched.shape == SHAPES[id_]
+        np.testing.assert_array_equal(np.asarray(stitched.dataobj), slice_by_slice(predictions / "slices", id_))
+        np.testing.assert_array_equal(stitched.affine, nib.load(predictions / "scans" / f"{id_}.nii.gz").affine)
@@ -0,0 +1,26 @@
+from test_predictions import PatientBatchSampler
+
+
+def test_batches_never_mix_patients():
+    stems = [f"Patient_41_{z:04d}" for z in range(5)] + [f"Patient_42_{z:04d}" for z in range(3)]
+    sampler = PatientBatchSampler(stems, batch_size=2)
+
+    assert list(sampler) == [[0, 1], [2, 3], [4], [5, 6], [7]]
+    assert len(sampler) == 5
+
+
+def test_every_slice_once_in_order():
+    # Sorted stems, as SliceDataset lists them: every patient is one contiguous run of slices
+    stems = [f"Patient_{p:02d}_{z:04d}" for p in range(40, 44) for z in range(7 + p)]
+    sampler = PatientBatchSampler(stems, batch_size=16)
+
+    batches = list(sampler)
+    assert [i for batch in batches for i in batch] == list(range(len(stems)))
+    assert all(1 <= len(batch) <= 16 for batch in batches)
+    assert all(len({stems[i][:10] for i in batch}) == 1 for batch in batches)
+
+
+def test_batch_larger_than_the_patients():
+    stems = ["Patient_41_0000", "Patient_41_0001", "Patient_42_0000"]
+
+    assert list(PatientBatchSampler(stems, batch_size=64)) == [[0, 1], [2]]
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from scipy.spatial.distance import directed_hausdorff
+
+from utils import assd_coef, class2one_hot, hausdorff_coef, hd95_coef, surface_distances
+
+
+# The point-wise definitions surface_distances replaces: Sobel boundary points, and all the pairwise distances
+def boundary_points(mask):
+    sobel_x = torch.tensor([[1., 0, -1], [2, 0, -2], [1, 0, -1]])[None, None]
+    sobel_y = torch.tensor([[1., 2, 1], [0, 0, 0], [-1, -2, -1]])[None, None]
+    grad_x = F.conv2d(mask[None, None].float(), sobel_x, padding=1)
+    grad_y = F.conv2d(mask[None, None].float(), sobel_y, padding=1)
+
+    return torch.nonzero(torch.sqrt(grad_x ** 2 + grad_y ** 2)[0, 0] > 0).numpy()
+
+
+def reference_distances(label, pred, percentile=95):
+    B, K, *_ = label.shape
+    hd, hd_perc, assd = np.zeros((B, K)), np.zeros((B, K)), np.zeros((B, K))
+    for b in range(B):
+        for k in range(K):
+            label_points, pred_points = boundary_points(label[b, k]), boundary_points(pred[b, k])
+            if not len(label_points) or not len(pred_points):
+                continue  # 0, as before
+            hd[b, k] = max(directed_hausdorff(label_points, pred_points)[0],
+                           directed_hausdorff(pred_points, label_points)[0])
+            pred_to_label = [np.min(np.linalg.norm(label_points - p, axis=1)) for p in pred_points]
+            label_to_pred = [np.min(np.linalg.norm(pred_points - p, axis=1)) for p in label_points]
+            hd_perc[b, k] = np.percentile(np.concatenate((pred_to_label, label_to_pred)), percentile)
+            assd[b, k] = (np.mean(pred_to_label) + np.mean(label_to_pred)) / 2
+
+    return hd, hd_perc, assd
+
+
+def random_segmentations(K=4, B=4, size=24, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    noise = torch.rand((B, K, size // 4, size // 4), generator=generator)
+    label = F.interpolate(noise, size=(size, size), mode="bilinear").argmax(dim=1)
+    pred = label.clone()
+    pred[torch.rand((B, size, size), generator=generator) < 0.05] = K - 1  # Speckles, far from the boundaries
+
+    return class2one_hot(label, K), class2one_hot(pred, K)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_surface_distances_are_the_pointwise_ones(seed):
+    label, pred = random_segmentations(seed=seed)
+
+    for value, expected in zip(surface_distances(label, pred), reference_distances(label, pred)):
+        np.testing.assert_allclose(value.numpy(), expected, rtol=1e-5)
+
+
+def test_empty_masks():
+    label, pred = random_segmentations()
+    pred[0] = 0
+    pred[0, 0] = 1  # Only background predicted: the other classes are empty
+    label[1] = 0
+    label[1, 2] = 1  # A ground truth with only one class
+
+    hd, hd95, assd = surface_distances(label, pred)
+    expected_hd, expected_hd95, expected_assd = reference_distances(label, pred)
+
+    assert (hd[0, 1:] == 0).all() and (assd[0, 1:] == 0).all()
+    np.testing.assert_allclose(hd.numpy(), expected_hd, rtol=1e-5)
+    np.testing.assert_allclose(hd95.numpy(), expected_hd95, rtol=1e-5)
+    np.testing.assert_allclose(assd.numpy(), expected_assd, rtol=1e-5)
+
+
+def test_kept_layouts():
+    label, pred = random_segmentations()
+    hd, hd95, assd = surface_distances(label, pred)
+
+    torch.testing.assert_close(hausdorff_coef(label, pred), hd.T)
+    torch.testing.assert_close(assd_coef(label, pred), assd.T)
+    torch.testing.assert_close(hd95_coef(label, pred), hd95)
@@ -22,20 +22,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import warnings
 from pathlib import Path
 from functools import partial
 from multiprocessing import Pool
 from contextlib import AbstractContextManager
-from typing import Callable, Iterable, List, Set, Tuple, TypeVar, cast
+from typing import Any, Callable, Iterable, List, Set, Tuple, TypeVar, cast
 
 import torch
 import torch.nn.functional as F
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
-from torch import Tensor, einsum
+from torch import nn, Tensor, einsum
 import numpy as np
-from scipy.spatial.distance import directed_hausdorff
+from scipy.ndimage import distance_transform_edt
 
 tqdm_ = partial(tqdm, dynamic_ncols=True,
                 leave=True,
@@ -65,12 +66,48 @@ def starmmap_(fn: Callable[[Tuple[A]], B], iter: Iterable[Tuple[A]]) -> List[B]:
     return Pool().starmap(fn, iter)
 
 
+# Validation level for the assert utils below
+# simplex, sset and one_hot are asserted several times per batch on the training hot path, and sset forces a
+# device sync and a full sort. The level decides whether they are actually evaluated:
+#   - full: always (the default)
+#   - sampled: only on one training step out of `every`, steps being counted by validation_step()
+#   - off: never, the checks then always pass
+# Unlike `python -O`, this leaves every other assert in place.
+VALIDATION_LEVELS: tuple[str, ...] = ("off", "sampled", "full")
+_validation: dict[str, Any] = {"level": "full", "every": 100, "step": 0}
+
+
+def set_validation(level: str, every: int = 100) -> None:
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(level)
+    assert every >= 1, every
+
+    _validation.update(level=level, every=every, step=0)
+
+
+def validation_step() -> None:
+    _validation["step"] += 1
+
+
+def checks_enabled() -> bool:
+    match _validation["level"]:
+        case "full":
+            return True
+        case "sampled":
+            return _validation["step"] % _validation["every"] == 0
+        case _:
+            return False
+
+
 # Assert utils
 def uniq(a: Tensor) -> Set:
     return set(torch.unique(a.cpu()).numpy())
 
 
 def sset(a: Tensor, sub: Iterable) -> bool:
+    if not checks_enabled():
+        return True
+
     return uniq(a).issubset(sub)
 
 
@@ -79,6 +116,9 @@ def eq(a: Tensor, b) -> bool:
 
 
 def simplex(t: Tensor, axis=1) -> bool:
+    if not checks_enabled():
+        return True
+
     _sum = cast(Tensor, t.sum(axis).type(torch.float32))
     _ones = torch.ones_like(_sum, dtype=torch.float32)
     return torch.allclose(_sum, _ones)
@@ -127,6 +167,49 @@ def probs2one_hot(probs: Tensor) -> Tensor:
     return res
 
 
+# torch.compile
+# The compiled graphs are specialized on the input shapes (dynamic=False): a short last batch would trigger a
+# recompilation, hence the padding to the full batch size, the extra outputs being dropped afterward.
+def pad_batch(t: Tensor, size: int) -> Tensor:
+    b, *shape = t.shape
+    assert b <= size, (b, size)
+    if b == size:
+        return t
+
+    return torch.cat((t, t[-1:].expand(size - b, *shape)))
+
+
+def graph_breaks(net: nn.Module, sample: Tensor) -> list[str]:
+    """
+    The reasons of the graph breaks torch.compile hits in the forward of `net`, traced on `sample` (in eval
+    mode, without gradients, so the BatchNorm statistics are left untouched). Empty if it is captured as one graph.
+    """
+    training: bool = net.training
+    net.eval()
+    try:
+        with torch.no_grad():
+            explanation = torch._dynamo.explain(net)(sample)
+    finally:
+        net.train(training)
+        torch._dynamo.reset()
+
+    return [str(reason.reason) for reason in explanation.break_reasons]
+
+
+def compile_net(net: nn.Module, sample: Tensor, **kwargs) -> nn.Module:
+    """
+    The compiled forward of `net`, with static shapes. The compiled module shares the parameters of `net`, which
+    should still be used for the state dicts (the compiled one prefixes all the keys with `_orig_mod.`).
+    """
+    breaks: list[str] = graph_breaks(net, sample)
+    if breaks:
+        warnings.warn(f"{net.__class__.__name__} has {len(breaks)} graph breaks: {breaks}")
+    else:
+        print(f">> {net.__class__.__name__} is captured as a single graph")
+
+    return torch.compile(net, dynamic=False, **kwargs)
+
+
 # Save the raw predictions
 def save_images(segs: Tensor, names: Iterable[str], root: Path) -> None:
         for seg, name in zip(segs, names):
@@ -246,71 +329,94 @@ def boundary_points(tensor: torch.Tensor) -> torch.Tensor:
     
     return boundary_points_list
 
-def meta_hausdorff(sum_str: str, label: torch.Tensor, pred: torch.Tensor) -> torch.Tensor:
+def boundary_maps(tensor: Tensor) -> Tensor:
+    """
+    Boundary maps of every class at once, with the same Sobel definition as `boundary_points`:
+    a pixel is on the boundary as soon as one of the two gradients is non-zero.
+
+    Args:
+        tensor (torch.Tensor): A binary mask of shape (B, K, H, W).
+
+    Returns:
+        torch.Tensor: A boolean tensor of shape (B, K, H, W).
+    """
+    b, k, *img_shape = tensor.shape
+
+    sobel = torch.tensor([[[1, 0, -1], [2, 0, -2], [1, 0, -1]],
+                          [[1, 2, 1], [0, 0, 0], [-1, -2, -1]]], dtype=torch.float32, device=tensor.device)
+
+    grads = F.conv2d(tensor.reshape(b * k, 1, *img_shape).float(), sobel[:, None, ...], padding=1)
+
+    return (grads != 0).any(dim=1).reshape(b, k, *img_shape)
+
+
+def surface_distances(label: Tensor, pred: Tensor, percentile: float = 95) -> tuple[Tensor, Tensor, Tensor]:
+    """
+    Hausdorff distance, its `percentile`-th percentile variant (HD95) and ASSD, for every sample and class of a batch.
+
+    Rather than comparing every boundary point with every other one, each boundary map is turned into a Euclidean
+    distance transform, which directly gives the distance from any pixel to the closest boundary point of the
+    other map. The numbers are the same as the point-wise definitions. As before, the distances are 0 when one
+    of the two boundaries is empty.
+
+    Returns:
+        Three float32 tensors of shape (B, K): HD, HD95 and ASSD.
+    """
     assert label.shape == pred.shape
     assert one_hot(label)
     assert one_hot(pred)
 
-    hausdorff_distances = []
-    for class_idx in range(label.shape[1]):
-        # Extract boundary points for each class
-        label_boundaries = boundary_points(label[:, class_idx:class_idx+1])
-        pred_boundaries = boundary_points(pred[:, class_idx:class_idx+1])
+    label_bounds: np.ndarray = boundary_maps(label).cpu().numpy()
+    pred_bounds: np.ndarray = boundary_maps(pred).cpu().numpy()
 
-        batch_hausdorff = []
-        for b in range(len(label_boundaries)):
-            if len(label_boundaries[b]) > 0 and len(pred_boundaries[b]) > 0:
-                # Convert the boundary points to numpy arrays
-                label_points = label_boundaries[b][0].cpu().numpy()
-                pred_points = pred_boundaries[b][0].cpu().numpy()
+    b, k, *_ = label.shape
+    hd = np.zeros((b, k), dtype=np.float32)
+    hd_perc = np.zeros((b, k), dtype=np.float32)
+    assd = np.zeros((b, k), dtype=np.float32)
 
-                # Compute Hausdorff Distance for each class
-                hd_label_to_pred = directed_hausdorff(label_points, pred_points)[0]
-                hd_pred_to_label = directed_hausdorff(pred_points, label_points)[0]
+    valid: np.ndarray = label_bounds.any(axis=(2, 3)) & pred_bounds.any(axis=(2, 3))
+    for i, c in np.argwhere(valid):
+        label_bound: np.ndarray = label_bounds[i, c]
+        pred_bound: np.ndarray = pred_bounds[i, c]
 
-                batch_hausdorff.append(max(hd_label_to_pred, hd_pred_to_label))
-            else:
-                # If no boundary points exist for this class, set distance to zero
-                batch_hausdorff.append(0.0)
+        # Distance of every pred boundary point to the label boundary, and vice versa
+        pred_to_label: np.ndarray = distance_transform_edt(~label_bound)[pred_bound]
+        label_to_pred: np.ndarray = distance_transform_edt(~pred_bound)[label_bound]
 
-        hausdorff_distances.append(batch_hausdorff)
+        hd[i, c] = max(pred_to_label.max(), label_to_pred.max())
+        hd_perc[i, c] = np.percentile(np.concatenate((pred_to_label, label_to_pred)), percentile)
+        assd[i, c] = (pred_to_label.mean() + label_to_pred.mean()) / 2
 
-    return torch.tensor(hausdorff_distances)
+    return torch.from_numpy(hd), torch.from_numpy(hd_perc), torch.from_numpy(assd)
+
+
+surface_coef = surface_distances
+
+
+def meta_hausdorff(sum_str: str, label: torch.Tensor, pred: torch.Tensor) -> torch.Tensor:
+    # Kept with its original (K, B) layout
+    hd, _, _ = surface_distances(label, pred)
+
+    return hd.transpose(0, 1)
 
 
 hausdorff_coef = partial(meta_hausdorff, "bk...->bk")
 
-# ASSD
-def meta_assd(sum_str: str, label: torch.Tensor, pred: torch.Tensor) -> torch.Tensor:
-    assert label.shape == pred.shape
-    assert one_hot(label)
-    assert one_hot(pred)
 
-    assd_distances = []
-    for class_idx in range(label.shape[1]):
-        # Extract boundary points for each class
-        label_boundaries = boundary_points(label[:, class_idx:class_idx+1])
-        pred_boundaries = boundary_points(pred[:, class_idx:class_idx+1])
+def meta_hd95(sum_str: str, label: torch.Tensor, pred: torch.Tensor) -> torch.Tensor:
+    _, hd95, _ = surface_distances(label, pred, percentile=95)
 
-        batch_assd = []
-        for b in range(len(label_boundaries)):
-            if len(label_boundaries[b]) > 0 and len(pred_boundaries[b]) > 0:
-                # Convert the boundary points to numpy arrays
-                label_points = label_boundaries[b][0].cpu().numpy()
-                pred_points = pred_boundaries[b][0].cpu().numpy()
+    return hd95
 
-                # Compute ASSD for each class
-                hd_label_to_pred = np.mean([np.min(np.linalg.norm(label_points - point, axis=1)) for point in pred_points])
-                hd_pred_to_label = np.mean([np.min(np.linalg.norm(pred_points - point, axis=1)) for point in label_points])
 
-                batch_assd.append((hd_label_to_pred + hd_pred_to_label) / 2)
-            else:
-                # If no boundary points exist for this class, set distance to zero
-                batch_assd.append(0.0)
+hd95_coef = partial(meta_hd95, "bk...->bk")
 
-        assd_distances.append(batch_assd)
+# ASSD
+def meta_assd(sum_str: str, label: torch.Tensor, pred: torch.Tensor) -> torch.Tensor:
+    # Kept with its original (K, B) layout
+    _, _, assd = surface_distances(label, pred)
 
-    return torch.tensor(assd_distances)
+    return assd.transpose(0, 1)
 
 assd_coef = partial(meta_assd, "bk...->bk")
 